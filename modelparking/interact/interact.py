@@ -16,6 +16,7 @@ optParser.add_option("--debug", action="store_true", default=False, help="enable
 optParser.add_option("--sumoPort", type="int", default=8813, help="SUMO listening port")
 optParser.add_option("--sumoAddress", type="string", default="127.0.0.1", help="SUMO IP address")
 optParser.add_option("--netFile", type="string", default="map_clean3.net.xml", help="location of the SUMO network file")
+optParser.add_option("--subscribe", action="store_true", default=False, help="poll vehicle states through TraCI subscriptions")
 
 (options, args) = optParser.parse_args()
 
@@ -43,12 +44,24 @@ sumoPort=options.sumoPort
 # Load SUMO libs
 sys.path.append(sumoTools)
 import traci
+import traci.constants as tc
+
+# Count TraCI round-trips: every command (or batch of commands) is a single
+# request/response exchange in Connection._sendExact()
+traciRoundTrips = 0
+_traciSendExact = traci.connection.Connection._sendExact
+def countedSendExact(self):
+	global traciRoundTrips
+	traciRoundTrips += 1
+	return _traciSendExact(self)
+traci.connection.Connection._sendExact = countedSendExact
 
 # Load our own modules
 sys.path.append("modules/")
 import tripgen
 tripgen.setup(netfile=netFileLocation, fringefactor=fringeFactor, mindistance=minDistance, seed=options.seed)
 import parkstat
+import vehreg
 
 # Open connection to sumo
 print("Connecting to {:s}:{:d}... ".format(sumoHost, sumoPort), end='')
@@ -68,6 +81,7 @@ print(" {:d} POIs".format(traci.poi.getIDCount()) )
 
 
 debug = options.debug
+useSubscriptions = options.subscribe
 startTime = options.startTime
 stopTime = options.stopTime
 maxNewVehiclesPerSecond = options.maxPerSecond
@@ -92,7 +106,7 @@ print("Forcing {:d} parking events from {:d}h{:02d}m to {:d}h{:02d}m".format(
 
 
 def addNewVehicles(count):
-	global nextVehicleID, globalActiveVehicleIDs
+	global nextVehicleID, vehicleRegistry
 
 	while count > 0:
 		count -= 1
@@ -109,7 +123,7 @@ def addNewVehicles(count):
 		# Add the vehicle
 		traci.vehicle.add(vehicleName, routeName)
 		# Track the vehicle
-		globalActiveVehicleIDs.append(vehicleName)
+		vehicleRegistry.add(vehicleName)
 		# Debug
 		if debug: print("{:.1f}\tAdd vehicle {:8s}\tsource {:12s}\tsink {:12s}".format(nowTime/timeMultiplier, vehicleName, newTrip[0], newTrip[1]) )
 
@@ -117,75 +131,98 @@ def addNewVehicles(count):
 
 
 def randomParkVehicles(count):
-	global globalActiveVehicleIDs, globalParkedVehicleIDs
+	global vehicleRegistry
 
 	# Draw #count random vehicles (must all be different)
-	vehIDsToPark = []
-	while True:
-		newIndex = random.randrange(0, len(globalActiveVehicleIDs), 1)
-		newParkID = globalActiveVehicleIDs[newIndex]
-		if newParkID not in vehIDsToPark:
-			vehIDsToPark.append(newParkID)
-			if len(vehIDsToPark) == count:
-				break
+	vehIDsToPark = vehicleRegistry.drawActive(count)
 
 	# Park the vehicles
 	for parkVehID in vehIDsToPark:
 		traci.vehicle.remove(parkVehID)
-		globalActiveVehicleIDs.remove(parkVehID)
-		globalParkedVehicleIDs.append(parkVehID)
+		vehicleRegistry.remove(parkVehID)
 
 	# Add new active vehicles to compensate
-	if len(globalActiveVehicleIDs) < targetActiveVehicleCount:
+	if vehicleRegistry.activeCount() < targetActiveVehicleCount:
 		addNewVehicles(count)
 
 
 
 
+# In subscription mode, SUMO returns the departed and arrived vehicle sets, and the
+# road and route of every subscribed vehicle, in the response to simulationStep().
+# We subscribe to new vehicles as they depart, so no further round-trips are
+# needed to poll vehicle states.
+def subscribeToSimulation():
+	traci.simulation.subscribe([tc.VAR_DEPARTED_VEHICLES_IDS, tc.VAR_ARRIVED_VEHICLES_IDS])
+
+
+# Returns the vehicles that departed and arrived on the last simulation step
+def getDepartedAndArrivedVehicles():
+	if useSubscriptions:
+		simulationResults = traci.simulation.getSubscriptionResults()
+		departedIDs = simulationResults[tc.VAR_DEPARTED_VEHICLES_IDS]
+		arrivedIDs = simulationResults[tc.VAR_ARRIVED_VEHICLES_IDS]
+		for departedVeh in departedIDs:
+			# The response to a subscription carries the current values, so the
+			# vehicle's road and route are available on the step it departs
+			traci.vehicle.subscribe(departedVeh, [tc.VAR_ROAD_ID, tc.VAR_EDGES])
+		return departedIDs, arrivedIDs
+	return traci.simulation.getDepartedIDList(), traci.simulation.getArrivedIDList()
+
+
+# Returns a vehicle's current road and route
+# Vehicles still waiting to be inserted are on no road ('')
+def getVehicleState(vehID):
+	if useSubscriptions:
+		vehicleResults = traci.vehicle.getSubscriptionResults(vehID)
+		if not vehicleResults:
+			return '', ()
+		return vehicleResults[tc.VAR_ROAD_ID], vehicleResults[tc.VAR_EDGES]
+	return traci.vehicle.getRoadID(vehID), traci.vehicle.getRoute(vehID)
+
+
 def updateVehicleLists():
-	global globalActiveVehicleIDs, globalParkedVehicleIDs, uncontrolledParkings, reachedStability
+	global vehicleRegistry, uncontrolledParkings, reachedStability
 
-	sumoVehicleList = traci.vehicle.getIDList()
+	departedIDs, arrivedIDs = getDepartedAndArrivedVehicles()
 
-	# Check vehicles going from parked to active (SUMO limitation)
-	if reachedStability:
-		for sumoActiveVeh in sumoVehicleList:
-			if sumoActiveVeh in globalParkedVehicleIDs:
-				print("{:.1f}\t[info] Assumed parked vehicle {:s} is now active.".format(nowTime/timeMultiplier, sumoActiveVeh))
-				globalActiveVehicleIDs.append(sumoActiveVeh)
-				globalParkedVehicleIDs.remove(sumoActiveVeh)
-				if uncontrolledParkings > 0:
-					uncontrolledParkings -= 1
+	# Vehicles going from parked to active are only accepted once stable (SUMO limitation),
+	# active vehicles out of the network (arrived, or still waiting for insertion) are parked
+	unparkedIDs, parkedIDs = vehicleRegistry.reconcile(departedIDs, arrivedIDs, allowUnpark=reachedStability)
+
+	for unparkedVeh in unparkedIDs:
+		print("{:.1f}\t[info] Assumed parked vehicle {:s} is now active.".format(nowTime/timeMultiplier, unparkedVeh))
+		if uncontrolledParkings > 0:
+			uncontrolledParkings -= 1
 
-	# Vehicles now missing from the active list are parked
-	for gActiveVeh in globalActiveVehicleIDs:
-		if gActiveVeh not in sumoVehicleList:
-			globalActiveVehicleIDs.remove(gActiveVeh)
-			globalParkedVehicleIDs.append(gActiveVeh)
-			if reachedStability:
-				uncontrolledParkings += 1
+	if reachedStability:
+		uncontrolledParkings += len(parkedIDs)
 
 
 
 ## Main loop
 reachedStability = False
-globalActiveVehicleIDs = []
-globalParkedVehicleIDs = []
+vehicleRegistry = vehreg.VehicleRegistry()
 uncontrolledParkings = 0
 
+if useSubscriptions:
+	subscribeToSimulation()
+
 while nowTime < ((stopTime-startTime)*timeMultiplier):
+	# Round-trips made on this step
+	traciRoundTrips = 0
+
 	## Update vehicle lists
 	updateVehicleLists()
 
 	## Reroute vehicles near their arrival spots to another destination
-	for actVID in globalActiveVehicleIDs:
+	for actVID in vehicleRegistry.active:
 		# Our criteria (not ideal) is finding a vehicle on its third-to-last (or lower) destination edge.
 		# Sometimes the vehicle will reach its destination edge and be removed in a single timestep,
 		# so we try to reroute it on its third-to-last edge.
 		# We thank SUMO devs for making it ridiculously convoluted to change vehicle arrival behavior.
-		vehCurrentEdge = traci.vehicle.getRoadID(actVID)
-		vehRoute = traci.vehicle.getRoute(actVID)
-		if ( vehCurrentEdge == vehRoute[-1] ) or ( vehCurrentEdge == vehRoute[-2] ) or ( vehCurrentEdge == vehRoute[-3] ):
+		vehCurrentEdge, vehRoute = getVehicleState(actVID)
+		if vehCurrentEdge in vehRoute[-3:]:
 			# Get a new destination, forcing current road as the source
 			newTripForcingSource = tripgen.makeNewTripWithSource(vehCurrentEdge)
 			# Reroute vehicle
@@ -193,9 +230,9 @@ while nowTime < ((stopTime-startTime)*timeMultiplier):
 
 
 	## Add new vehicles to near the target number of active vehicles
-	if len(globalActiveVehicleIDs) < targetActiveVehicleCount:
+	if vehicleRegistry.activeCount() < targetActiveVehicleCount:
 		# Find how many vehicles are missing and limit new additions to maxNewVehiclesPerSecond
-		numberOfNewVehicles = targetActiveVehicleCount - len(globalActiveVehicleIDs)
+		numberOfNewVehicles = targetActiveVehicleCount - vehicleRegistry.activeCount()
 		numberOfNewVehicles = maxNewVehiclesPerSecond if numberOfNewVehicles>maxNewVehiclesPerSecond else numberOfNewVehicles
 		addNewVehicles(count = numberOfNewVehicles)
 
@@ -209,7 +246,7 @@ while nowTime < ((stopTime-startTime)*timeMultiplier):
 	if actualTime in parkingEvents:
 		willPark = parkingEvents[actualTime]
 		if willPark > 0:
-			print("{:.1f}\t[info] ActualTime {:.1f} will park {:d} uncontrolled {:d} parked {:d}".format(nowTime/timeMultiplier, actualTime, willPark, uncontrolledParkings, len(globalParkedVehicleIDs)))
+			print("{:.1f}\t[info] ActualTime {:.1f} will park {:d} uncontrolled {:d} parked {:d}".format(nowTime/timeMultiplier, actualTime, willPark, uncontrolledParkings, vehicleRegistry.parkedCount()))
 			# Count any uncontrolled parkings towards the number of parking events we must execute
 			if uncontrolledParkings > 0:
 				deltaParkings = willPark-uncontrolledParkings
@@ -236,7 +273,7 @@ while nowTime < ((stopTime-startTime)*timeMultiplier):
 	traci.simulationStep()
 	nowTime = traci.simulation.getCurrentTime()
 
-	print("{:.1f}\t{:d} vehicles, {:d} parking events, {:.2f}% done".format(nowTime/timeMultiplier, len(globalActiveVehicleIDs), len(globalParkedVehicleIDs), nowTime/((stopTime-startTime)*timeMultiplier)*100.0 ) )
+	print("{:.1f}\t{:d} vehicles, {:d} parking events, {:d} round-trips, {:.2f}% done".format(nowTime/timeMultiplier, vehicleRegistry.activeCount(), vehicleRegistry.parkedCount(), traciRoundTrips, nowTime/((stopTime-startTime)*timeMultiplier)*100.0 ) )
 # Main loop (end)
 
 traci.close()
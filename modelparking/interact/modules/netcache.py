@@ -0,0 +1,93 @@
+import os, sys, shutil, hashlib
+import numpy
+
+# Compact snapshot of a SUMO network, holding only what the trip generator needs:
+# edge IDs, the coordinates of each edge's from and to nodes, fringe flags and the
+# bounding box diameter. Each table is a .npy file that is memory-mapped on load.
+# Snapshots live in '<netfile>.snapshot.<digest>/', keyed by the net file's contents,
+# so a changed network is rebuilt automatically.
+
+snapshotTables = ['edgeIDs', 'fromCoords', 'toCoords', 'fringeIncoming', 'fringeOutgoing', 'bboxDiameter']
+
+
+class NetSnapshot:
+	def __init__(self, digest, tables):
+		self.digest = digest
+		self.edgeIDs = tables['edgeIDs']
+		self.fromCoords = tables['fromCoords']
+		self.toCoords = tables['toCoords']
+		self.fringeIncoming = tables['fringeIncoming']
+		self.fringeOutgoing = tables['fringeOutgoing']
+		self.bboxDiameter = float(tables['bboxDiameter'][0])
+
+	def edgeCount(self):
+		return len(self.edgeIDs)
+
+
+# Returns the SHA-1 digest of a file's contents
+def fileDigest(filename):
+	digest = hashlib.sha1()
+	with open(filename, 'rb') as fileHandle:
+		for chunk in iter(lambda: fileHandle.read(1<<20), b''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+def snapshotDirectory(netfile, digest):
+	return "{:s}.snapshot.{:s}".format(netfile, digest[:16])
+
+
+# Parse the net XML with sumolib and extract the snapshot tables
+def parseNet(netfile):
+	import sumolib
+	sumoNet = sumolib.net.readNet(netfile)
+	edges = sumoNet.getEdges()
+
+	return {
+		'edgeIDs': numpy.array([edge.getID() for edge in edges]),
+		'fromCoords': numpy.array([edge.getFromNode().getCoord()[:2] for edge in edges], dtype=numpy.float64),
+		'toCoords': numpy.array([edge.getToNode().getCoord()[:2] for edge in edges], dtype=numpy.float64),
+		'fringeIncoming': numpy.array([edge.is_fringe(edge._incoming) for edge in edges], dtype=numpy.bool_),
+		'fringeOutgoing': numpy.array([edge.is_fringe(edge._outgoing) for edge in edges], dtype=numpy.bool_),
+		'bboxDiameter': numpy.array([sumoNet.getBBoxDiameter()], dtype=numpy.float64)
+	}
+
+
+# Write the snapshot tables, going through a temporary directory so that
+# concurrent runs never see a partial snapshot
+def writeSnapshot(directory, tables):
+	temporaryDirectory = "{:s}.{:d}.tmp".format(directory, os.getpid())
+	os.makedirs(temporaryDirectory, exist_ok=True)
+	for tableName in snapshotTables:
+		numpy.save(os.path.join(temporaryDirectory, tableName + '.npy'), tables[tableName])
+	try:
+		os.rename(temporaryDirectory, directory)
+	except OSError:
+		# Another run got there first
+		shutil.rmtree(temporaryDirectory, ignore_errors=True)
+
+
+def readSnapshot(directory):
+	return {tableName: numpy.load(os.path.join(directory, tableName + '.npy'), mmap_mode='r') for tableName in snapshotTables}
+
+
+# Load the snapshot of a network, rebuilding it if the network has changed.
+# Returns the snapshot and whether it had to be rebuilt.
+def load(netfile):
+	digest = fileDigest(netfile)
+	directory = snapshotDirectory(netfile, digest)
+
+	if os.path.isdir(directory):
+		try:
+			return NetSnapshot(digest, readSnapshot(directory)), False
+		except (OSError, ValueError) as error:
+			print("Warning: Discarding unreadable network snapshot: {:s}".format(str(error)), file=sys.stderr)
+			shutil.rmtree(directory, ignore_errors=True)
+
+	tables = parseNet(netfile)
+	try:
+		writeSnapshot(directory, tables)
+	except OSError as error:
+		print("Warning: Could not write network snapshot: {:s}".format(str(error)), file=sys.stderr)
+
+	return NetSnapshot(digest, tables), True
@@ -1,30 +1,73 @@
-import sys, math
-import csv
+import sys, os, math
+import numpy
 
 parkingProbabilitiesFile='modules/perSecondArrayNorm.csv'
 
+# Parking probability density (in 1-second intervals, 24-hour, Chicago2007),
+# parsed once into arrays of times and probabilities
+parkingDensity = None
+
+# Load the parking probability density, reading the compressed file directly if present.
+def loadParkingDensity(filename=parkingProbabilitiesFile):
+	global parkingDensity
+
+	if parkingDensity is None:
+		if os.path.isfile(filename + '.gz'):
+			filename = filename + '.gz'
+		pdfdata = numpy.loadtxt(filename, delimiter=',', ndmin=2)
+		parkingDensity = (pdfdata[:,0].astype(numpy.int64), pdfdata[:,1])
+
+	return parkingDensity
+
+
+# Distribute a number of events with the sequential remainder scheme: each second
+# gets floor(probability*events + remainder), and the fractional part carries over.
+def remainderCounts(probabilities, numberOfEvents):
+	counts = numpy.zeros(len(probabilities), dtype=numpy.int64)
+	remainder = 0
+	for index, probability in enumerate(probabilities.tolist()):
+		numParkingEvents = probability*numberOfEvents+remainder
+		counts[index] = int( math.modf(numParkingEvents)[1] )
+		remainder = math.modf(numParkingEvents)[0]
+	return counts
+
+
+# Vectorized version of the remainder scheme: the events up to each second are the
+# floor of the cumulative sum, so each second gets the difference between floors.
+# Rounding can only differ from the sequential scheme where a cumulative sum lies
+# within accumulated rounding error of an integer; in that case we fall back to it.
+def cumulativeFloorCounts(probabilities, numberOfEvents):
+	if len(probabilities) == 0:
+		return numpy.zeros(0, dtype=numpy.int64)
+
+	cumulativeEvents = numpy.cumsum(probabilities*numberOfEvents)
+	floors = numpy.floor(cumulativeEvents)
+
+	tolerance = 4*len(probabilities)*numpy.finfo(numpy.float64).eps*max(abs(cumulativeEvents[-1]), 1.0)
+	nearestIntegers = numpy.rint(cumulativeEvents)
+	if numpy.any( (numpy.abs(cumulativeEvents-nearestIntegers) <= tolerance) & (nearestIntegers != 0) ):
+		return remainderCounts(probabilities, numberOfEvents)
+
+	return numpy.diff(floors, prepend=0).astype(numpy.int64)
+
+
+# Returns the times and number of parking events on each second of [startTime,endTime[
+def distributeEventsArray(numberOfEvents, startTime=10800, endTime=75600):
+	times, probabilities = loadParkingDensity()
+	window = (times >= startTime) & (times < endTime)
+	return times[window], cumulativeFloorCounts(probabilities[window], numberOfEvents)
+
+
 # This routine distributes a number of parking events over a particular
 # timeframe, returning a dictionary array of how many parking events
 # should occur on each second. Expects time in seconds, matching
 # real-life time.
 def distributeEvents(numberOfEvents, startTime=10800, endTime=75600):
-	parkingEventDictionary = {}
-
-	# Import parking probability density (in 1-second intervals, 24-hour, Chicago2007)
-	csvfile=open(parkingProbabilitiesFile, newline='')
-	pdfdata = csv.reader(csvfile, delimiter=',')
-
-	# Go through probability data and perform necessary calculations
-	remainder=0
-	for row in pdfdata:
-		csvTime=int(row[0])
-		if csvTime < startTime:
-			continue
-		elif csvTime >= endTime:
-			break
-
-		numParkingEvents = float(row[1])*numberOfEvents+remainder
-		parkingEventDictionary[csvTime] = int( math.modf(numParkingEvents)[1] )
-		remainder = math.modf(numParkingEvents)[0]
+	times, counts = distributeEventsArray(numberOfEvents, startTime=startTime, endTime=endTime)
+	return dict(zip(times.tolist(), counts.tolist()))
+
 
-	return parkingEventDictionary
+# Distribute parking events for a list of (numberOfEvents, startTime, endTime)
+# tuples, returning one dictionary per tuple as in distributeEvents()
+def distributeEventsBatch(schedules):
+	return [distributeEvents(numberOfEvents, startTime=startTime, endTime=endTime) for (numberOfEvents, startTime, endTime) in schedules]
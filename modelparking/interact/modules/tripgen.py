@@ -1,5 +1,6 @@
-import random, sys, math, bisect
-import sumolib, route2trips
+import random, sys, os, time, hashlib, resource
+import numpy
+import netcache
 
 tripGenerator = None
 minTripDistance = 100
@@ -9,107 +10,152 @@ minTripDistance = 100
 ### CLASSES ###
 ###############
 
-# Euclidean distance between two coordinates in the plane
-def euclidean(a, b):
-    return math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2)
-
+# Trip generator with precomputed sink tables.
+# Drawing a source and a sink edge independently and rejecting pairs shorter than
+# 'mindistance' yields each valid pair with probability proportional to
+# sourceWeight*sinkWeight. We obtain the same distribution directly: for every
+# source edge we keep the cumulative weights of its valid sinks only, and draw
+# sources in proportion to their weight times the total weight of their valid sinks.
+# Edges are stored in CSR form: the sinks of source 'i' are at [offsets[i]:offsets[i+1]].
 class RandomTripGenerator:
-	def __init__(self, net, source_generator, sink_generator):
-		self.source_generator = source_generator
-		self.sink_generator = sink_generator
-		self.net = net
-
-	def getTrip(self, mindistance, maxtries=1000):
-		for i in range(maxtries):
-			source_edge = self.source_generator.get()
-			sink_edge = self.sink_generator.get()
-			destCoord = sink_edge.getToNode().getCoord()
-
-			coords = ([source_edge.getFromNode().getCoord()] + [destCoord])
-			distance = sum([euclidean(p, q) for p, q in zip(coords[:-1], coords[1:])])
-
-			# This breaks the for cycle when a match is found
-			if distance >= mindistance:
-				return source_edge.getID(), sink_edge.getID()
+	def __init__(self, edgeIDs, sinkOffsets, sinkIndices, sinkCumWeights, sourceCumWeights):
+		self.edgeIDs = edgeIDs
+		self.edgeIndex = {edgeID: index for index, edgeID in enumerate(edgeIDs)}
+		self.sinkOffsets = sinkOffsets
+		self.sinkIndices = sinkIndices
+		self.sinkCumWeights = sinkCumWeights
+		self.sourceCumWeights = sourceCumWeights
+		self.sourceTotalWeight = float(sourceCumWeights[-1]) if len(sourceCumWeights) else 0.0
+
+	# Draw a sink for source edge index 'source', or None if it has no valid sinks
+	def getSinkIndex(self, source):
+		start, end = self.sinkOffsets[source], self.sinkOffsets[source+1]
+		if start == end:
+			return None
+		r = random.random() * self.sinkCumWeights[end-1]
+		position = min(int(numpy.searchsorted(self.sinkCumWeights[start:end], r, side='right')), end-start-1)
+		return self.sinkIndices[start+position]
+
+	def getTrip(self):
+		if self.sourceTotalWeight == 0:
+			return None
+		r = random.random() * self.sourceTotalWeight
+		source = min(int(numpy.searchsorted(self.sourceCumWeights, r, side='right')), len(self.sourceCumWeights)-1)
+		sink = self.getSinkIndex(source)
+		return self.edgeIDs[source], self.edgeIDs[sink]
 
 	# Get a new trip pair forcing a source edge
-	def getTripWithSource(self, sourceEdge, mindistance, maxtries=1000):
-		source_edge = self.net.getEdge(sourceEdge)
-		for i in range(maxtries):
-			sink_edge = self.sink_generator.get()
-			destCoord = sink_edge.getToNode().getCoord()
-
-			coords = ([source_edge.getFromNode().getCoord()] + [destCoord])
-			distance = sum([euclidean(p, q) for p, q in zip(coords[:-1], coords[1:])])
-
-			# This breaks the for cycle when a match is found
-			if distance >= mindistance:
-				return source_edge.getID(), sink_edge.getID()
-
-class InvalidGenerator(Exception):
-    pass
-
-class RandomEdgeGenerator:
-    def __init__(self, net, weight_fun):
-        self.net = net
-        self.weight_fun = weight_fun
-        self.cumulative_weights = []
-        self.total_weight = 0
-        for edge in self.net._edges:
-            self.total_weight += weight_fun(edge)
-            self.cumulative_weights.append(self.total_weight)
-        if self.total_weight == 0:
-            raise InvalidGenerator()
-
-    def get(self):
-        r = random.random() * self.total_weight
-        index = bisect.bisect(self.cumulative_weights, r)
-        return self.net._edges[index]
-
+	def getTripWithSource(self, sourceEdge):
+		sink = self.getSinkIndex(self.edgeIndex[sourceEdge])
+		if sink is None:
+			return None
+		return sourceEdge, self.edgeIDs[sink]
 
 ################
 ### ROUTINES ###
 ################
 
-def get_prob_fun(fringe_factor, fringe_bonus, fringe_forbidden):
-	def edge_probability(edge):
-		if fringe_bonus is None and edge.is_fringe():
-			return 0  # not suitable as intermediate way point
-		if fringe_forbidden is not None and edge.is_fringe(getattr(edge, fringe_forbidden)):
-			return 0  # the wrong kind of fringe
-		prob = 1
-		if (fringe_factor != 1.0
-				and fringe_bonus is not None
-				and edge.is_fringe(getattr(edge, fringe_bonus))):
-			prob *= fringe_factor
-		return prob
+# Edge weights for every edge in a network snapshot, from its fringe flags
+# 'fringe_bonus' and 'fringe_forbidden' are "_incoming" or "_outgoing" (or None)
+def get_edge_weights(net, fringe_factor, fringe_bonus, fringe_forbidden):
+	fringe = {"_incoming": net.fringeIncoming, "_outgoing": net.fringeOutgoing}
+
+	weights = numpy.ones(net.edgeCount(), dtype=numpy.float64)
+	if (fringe_factor != 1.0 and fringe_bonus is not None):
+		weights[fringe[fringe_bonus]] = fringe_factor
+	if fringe_bonus is None:
+		weights[net.fringeIncoming | net.fringeOutgoing] = 0  # not suitable as intermediate way point
+	if fringe_forbidden is not None:
+		weights[fringe[fringe_forbidden]] = 0  # the wrong kind of fringe
+
+	return weights
+
+
+
+
+# Build the sink tables of every source edge.
+# 'fromCoords' and 'toCoords' hold the coordinates of each edge's from and to nodes;
+# a trip is valid if the distance between the source's from node and the sink's to
+# node is at least 'mindistance'. Sources are processed in blocks to bound memory.
+def buildSinkTables(fromCoords, toCoords, sourceWeights, sinkWeights, mindistance, blockSize=256):
+	edgeCount = len(sinkWeights)
+	candidates = numpy.flatnonzero(sinkWeights > 0)
+	candidateX = toCoords[candidates, 0]
+	candidateY = toCoords[candidates, 1]
+	candidateWeights = sinkWeights[candidates]
+
+	sinkOffsets = numpy.zeros(edgeCount+1, dtype=numpy.int64)
+	sinkTotals = numpy.zeros(edgeCount, dtype=numpy.float64)
+	sinkIndexBlocks = []
+	sinkCumWeightBlocks = []
+	for blockStart in range(0, edgeCount, blockSize):
+		block = fromCoords[blockStart:blockStart+blockSize]
+		deltaX = candidateX[None,:] - block[:,0,None]
+		deltaY = candidateY[None,:] - block[:,1,None]
+		# Same arithmetic as math.sqrt(dx**2 + dy**2), so boundary cases match
+		validSinks = numpy.sqrt(deltaX*deltaX + deltaY*deltaY) >= mindistance
+		for row in range(validSinks.shape[0]):
+			source = blockStart+row
+			cumWeights = numpy.cumsum(candidateWeights[validSinks[row]])
+			sinkIndexBlocks.append(candidates[validSinks[row]])
+			sinkCumWeightBlocks.append(cumWeights)
+			sinkOffsets[source+1] = sinkOffsets[source] + len(cumWeights)
+			if len(cumWeights):
+				sinkTotals[source] = cumWeights[-1]
+
+	sinkIndices = numpy.concatenate(sinkIndexBlocks).astype(numpy.int32) if sinkIndexBlocks else numpy.zeros(0, dtype=numpy.int32)
+	sinkCumWeights = numpy.concatenate(sinkCumWeightBlocks) if sinkCumWeightBlocks else numpy.zeros(0)
+	sourceCumWeights = numpy.cumsum(sourceWeights * sinkTotals)
+
+	return sinkOffsets, sinkIndices, sinkCumWeights, sourceCumWeights
+
+
+
+
+# Load the sink tables from the cache, or build and cache them.
+# Tables are keyed by the network file's hash, the fringe factor and the minimum distance.
+def loadSinkTables(netfile, netDigest, fringefactor, mindistance, fromCoords, toCoords, sourceWeights, sinkWeights):
+	cacheKey = hashlib.sha1("{:s}:{!r}:{!r}".format(netDigest, float(fringefactor), float(mindistance)).encode()).hexdigest()
+	cacheFile = "{:s}.sinks.{:s}.npz".format(netfile, cacheKey[:16])
+
+	if os.path.isfile(cacheFile):
+		with numpy.load(cacheFile) as cached:
+			return cached['sinkOffsets'], cached['sinkIndices'], cached['sinkCumWeights'], cached['sourceCumWeights']
+
+	tables = buildSinkTables(fromCoords, toCoords, sourceWeights, sinkWeights, mindistance)
+	try:
+		# Write to a temporary file first, so concurrent runs never read a partial cache
+		temporaryFile = "{:s}.{:d}.tmp.npz".format(cacheFile, os.getpid())
+		numpy.savez(temporaryFile, sinkOffsets=tables[0], sinkIndices=tables[1], sinkCumWeights=tables[2], sourceCumWeights=tables[3])
+		os.replace(temporaryFile, cacheFile)
+	except OSError as error:
+		print("Warning: Could not cache sink tables: {:s}".format(str(error)), file=sys.stderr)
 
-	# Return a pre-configured function
-	return edge_probability
+	return tables
 
 
 
 
 def makeNewTrip():
-	global tripGenerator, minTripDistance
+	global tripGenerator
 
 	if tripGenerator == None:
 		print("Error: Set up a trip generator first.", file=sys.stderr)
 		return
 
-	return tripGenerator.getTrip(mindistance=minTripDistance)
+	return tripGenerator.getTrip()
 
 
 
 
 def makeNewTripWithSource(sourceEdgeID):
-	global tripGenerator, minTripDistance
+	global tripGenerator
 
 	if tripGenerator == None:
 		print("Error: Set up a trip generator first.", file=sys.stderr)
 		return
 
-	return tripGenerator.getTripWithSource(sourceEdge=sourceEdgeID, mindistance=minTripDistance)
+	return tripGenerator.getTripWithSource(sourceEdge=sourceEdgeID)
 
 
 
@@ -120,24 +166,33 @@ def setup(netfile="map.net.xml", seed=31337, fringefactor=1.0, mindistance=100):
 	# Init random seed
 	random.seed(seed)
 
-	# Read net XML data
-	sumoNet = sumolib.net.readNet(netfile)
+	# Load the network snapshot (parsing the net XML only if it changed)
+	loadStartTime = time.time()
+	sumoNet, rebuilt = netcache.load(netfile)
+	loadTime = time.time() - loadStartTime
+	print("Network: {:d} edges {:s} in {:.1f} ms, peak RSS {:.1f} MB".format(
+		sumoNet.edgeCount(),
+		"parsed from XML" if rebuilt else "loaded from snapshot",
+		loadTime*1000,
+		resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024 ))
 
 	# Check whether mindistance is valid based on the size of this network
-	bboxDiameter = sumoNet.getBBoxDiameter()
+	bboxDiameter = sumoNet.bboxDiameter
 	if minTripDistance > bboxDiameter:
 		print("Error: Cannot achieve a minimum trip length of {:d} in a network with diameter {:f}.".format(minTripDistance, bboxDiameter), file=sys.stderr)
 		sys.exit(1)
 
 	## Ready a trip generator
-	# Setup generators for source and sink edges
-	try:
-		source_generator = RandomEdgeGenerator(sumoNet, get_prob_fun(fringefactor, "_incoming", "_outgoing"))
-		sink_generator = RandomEdgeGenerator(sumoNet, get_prob_fun(fringefactor, "_outgoing", "_incoming"))
-	except InvalidGenerator:
+	# Edge coordinates and weights for source and sink edges
+	edgeIDs = sumoNet.edgeIDs.tolist()
+	sourceWeights = get_edge_weights(sumoNet, fringefactor, "_incoming", "_outgoing")
+	sinkWeights = get_edge_weights(sumoNet, fringefactor, "_outgoing", "_incoming")
+
+	if sourceWeights.sum() == 0 or sinkWeights.sum() == 0:
 		print("Error: No valid edges for generating source or destination", file=sys.stderr)
 		sys.exit(1)
 
-	tripGenerator = RandomTripGenerator(sumoNet, source_generator, sink_generator)
+	sinkTables = loadSinkTables(netfile, sumoNet.digest, fringefactor, mindistance, sumoNet.fromCoords, sumoNet.toCoords, sourceWeights, sinkWeights)
+	tripGenerator = RandomTripGenerator(edgeIDs, *sinkTables)
 
 
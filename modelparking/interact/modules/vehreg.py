@@ -0,0 +1,92 @@
+import random
+
+# A registry of the vehicles we control, split into active and parked sets.
+# Both sets are dictionaries with no values: lookups and transitions are O(1),
+# and iteration follows insertion order, so random draws over the active set
+# are reproducible for a given seed.
+# As with the vehicle lists it replaces, active vehicles that are not in the
+# network (those waiting for insertion, and those that arrived) are counted as
+# parked, and parked vehicles in the network become active again once allowed.
+# The vehicles in the network are tracked from the departed and arrived lists,
+# along with the active ones out of it and the parked ones in it.
+class VehicleRegistry:
+	def __init__(self):
+		self.active = {}
+		self.parked = {}
+		self.running = {}
+		self.activeIdle = {}
+		self.parkedRunning = {}
+
+	def isActive(self, vehID):
+		return vehID in self.active
+
+	def isParked(self, vehID):
+		return vehID in self.parked
+
+	def activeCount(self):
+		return len(self.active)
+
+	def parkedCount(self):
+		return len(self.parked)
+
+	# Track a new active vehicle, not in the network until it departs
+	def add(self, vehID):
+		self.active[vehID] = None
+		self.activeIdle[vehID] = None
+
+	# Move a vehicle from the active to the parked set
+	def park(self, vehID):
+		del self.active[vehID]
+		self.activeIdle.pop(vehID, None)
+		self.parked[vehID] = None
+		if vehID in self.running:
+			self.parkedRunning[vehID] = None
+
+	# Move a vehicle from the parked to the active set
+	def unpark(self, vehID):
+		del self.parked[vehID]
+		self.parkedRunning.pop(vehID, None)
+		self.active[vehID] = None
+		if vehID not in self.running:
+			self.activeIdle[vehID] = None
+
+	# Park an active vehicle removed from the network
+	def remove(self, vehID):
+		self.running.pop(vehID, None)
+		self.park(vehID)
+
+	# Draw #count different active vehicles at random (without replacement)
+	def drawActive(self, count):
+		count = min(count, len(self.active))
+		return random.sample(list(self.active), count)
+
+	# Reconcile the registry with the vehicles that departed and arrived on the
+	# last simulation step, in O(departed+arrived+changed). Vehicles unknown to
+	# the registry are ignored. Parked vehicles in the network are made active
+	# (only when 'allowUnpark' is set, in ID order), then active vehicles out of
+	# the network are parked. Returns both, in that order.
+	def reconcile(self, departedIDs, arrivedIDs, allowUnpark=True):
+		for vehID in departedIDs:
+			if vehID not in self.active and vehID not in self.parked:
+				continue
+			self.running[vehID] = None
+			self.activeIdle.pop(vehID, None)
+			if vehID in self.parked:
+				self.parkedRunning[vehID] = None
+		for vehID in arrivedIDs:
+			self.running.pop(vehID, None)
+			self.parkedRunning.pop(vehID, None)
+			if vehID in self.active:
+				self.activeIdle[vehID] = None
+
+		unparked = []
+		if allowUnpark:
+			unparked = sorted(self.parkedRunning)
+			for vehID in unparked:
+				self.unpark(vehID)
+
+		parked = list(self.activeIdle)
+		for vehID in parked:
+			self.park(vehID)
+
+		return unparked, parked
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# This script provisions the per-worker databases (gisdb0..gisdbN) that the simulation runner pins its
+# workers to (see 'scripts/templates/simulationPool.py'). Instead of loading the shapefile into every
+# database, the buildings are loaded and indexed once, into a template database ('gisdb' by default, as in
+# 'scripts/vars'), and each worker database is then copied from it with CREATE DATABASE ... TEMPLATE, a
+# file-level copy. Copies run in parallel, each on its own connection.
+#
+# usage: ./provisionDatabases.py [options] provision [workers]    load the template if needed, create gisdb0..gisdb{workers-1}
+#        ./provisionDatabases.py [options] clear                  clear vehicles, RSUs and parked cars from every worker database
+#        ./provisionDatabases.py [options] verify                 check the spatial index and feature counts of every worker database
+#
+# Every worker database is verified after being created or cleared: its 'buildings' table must have a GiST
+# index on 'geom', the same number of buildings as the template, and no leftover dynamic features.
+# Connection settings come from the 'gis' dictionary of a configuration file, and can be overridden.
+# It talks to the server through 'psql', and loads the shapefile through 'shp2pgsql'.
+
+import concurrent.futures
+import optparse
+import os
+import plistlib
+import re
+import subprocess
+import sys
+
+# Requires Python >3.5
+assert sys.version_info >= (3,5)
+
+
+defaultShapefile = os.path.join('data', 'shapefile_porto_srid4326.shp')
+buildingsTable = 'buildings'
+# 'feattyp' of buildings and of the features gissumo adds while simulating (GIS.FeatureType in 'src/gis.swift')
+buildingFeatureType = 9790
+dynamicFeatureTypes = [2222, 2223, 2224]
+
+
+class DatabaseError(Exception):
+	pass
+
+
+class GISServer:
+	def __init__(self, host='localhost', port=5432, user='root', password=''):
+		self.host = host
+		self.port = port
+		self.user = user
+		self.password = password
+
+	# Run SQL on a database through psql, one statement at a time (so that CREATE DATABASE and VACUUM
+	# run outside of a transaction). Returns the rows of the output, as lists of fields.
+	def run(self, database, sql, timeout=None):
+		psqlEnvironment = dict(os.environ, PGPASSWORD=str(self.password))
+		psqlCommand = ['psql', '--host', str(self.host), '--port', str(self.port), '--username', str(self.user),
+			'--dbname', database, '--tuples-only', '--no-align', '--field-separator', '\t', '--quiet', '--no-psqlrc', '--set', 'ON_ERROR_STOP=1']
+		try:
+			result = subprocess.run(psqlCommand, input=sql.encode(), env=psqlEnvironment, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+		except (OSError, subprocess.SubprocessError) as error:
+			raise DatabaseError("Unable to run psql on {:s}: {}".format(database, error))
+		if result.returncode != 0:
+			raise DatabaseError("Query on {:s} failed: {:s}".format(database, result.stderr.decode().strip()))
+		return [line.split('\t') for line in result.stdout.decode().splitlines() if line]
+
+	def value(self, database, sql):
+		rows = self.run(database, sql)
+		return rows[0][0] if rows else None
+
+	def databases(self):
+		return set(row[0] for row in self.run('postgres', "SELECT datname FROM pg_database;"))
+
+	def workerDatabases(self, prefix):
+		pattern = re.compile('^' + re.escape(prefix) + '([0-9]+)$')
+		return sorted((database for database in self.databases() if pattern.match(database)), key=lambda database: int(pattern.match(database).group(1)))
+
+
+# Create the template database and load the buildings into it, indexed, as '01setupPostGIS.sh' does
+def loadTemplate(server, template, shapefile):
+	if not os.path.isfile(shapefile):
+		raise DatabaseError("Shapefile {:s} not found.".format(shapefile))
+	try:
+		buildingsSql = subprocess.check_output(['shp2pgsql', '-d', '-D', '-i', '-s', '4326', '-I', shapefile, buildingsTable], stderr=subprocess.DEVNULL)
+	except (OSError, subprocess.SubprocessError) as error:
+		raise DatabaseError("Unable to convert {:s} with shp2pgsql: {}".format(shapefile, error))
+
+	server.run('postgres', "CREATE DATABASE {:s} OWNER \"{:s}\" TEMPLATE DEFAULT;".format(template, server.user))
+	server.run(template, "CREATE EXTENSION IF NOT EXISTS postgis;")
+	server.run(template, buildingsSql.decode())
+	# Accept all geometries, otherwise adding POINTs will fail; index the feature type every query filters on
+	server.run(template, "ALTER TABLE {0:s} ALTER COLUMN geom TYPE geometry(Geometry,4326);\n"
+		"CREATE INDEX {0:s}_feattyp_idx ON {0:s} (feattyp);\n"
+		"VACUUM ANALYZE {0:s};\n".format(buildingsTable))
+
+
+# Remove the features gissumo adds while simulating, left behind by runs that didn't finish
+def clearDynamicFeatures(server, database):
+	server.run(database, "DELETE FROM {:s} WHERE feattyp IN ({:s});\nVACUUM ANALYZE {:s};\n".format(buildingsTable, ",".join("'{:d}'".format(featureType) for featureType in dynamicFeatureTypes), buildingsTable))
+
+
+# Feature counts of a database's buildings table, by 'feattyp'
+def featureCounts(server, database):
+	return {int(float(featureType)): int(count) for featureType, count in server.run(database, "SELECT feattyp, COUNT(gid) FROM {:s} WHERE feattyp IS NOT NULL GROUP BY feattyp;".format(buildingsTable))}
+
+
+# Problems with a database, compared with the template's building count (empty if none)
+def verifyDatabase(server, database, buildingCount):
+	problems = []
+	gistIndexes = server.value(database, "SELECT COUNT(*) FROM pg_indexes WHERE tablename='{:s}' AND indexdef ILIKE '%USING gist%(geom)%';".format(buildingsTable))
+	if gistIndexes is None or int(gistIndexes) == 0:
+		problems.append("no GiST index on {:s}.geom".format(buildingsTable))
+	counts = featureCounts(server, database)
+	if counts.get(buildingFeatureType, 0) != buildingCount:
+		problems.append("{:d} buildings, template has {:d}".format(counts.get(buildingFeatureType, 0), buildingCount))
+	leftover = sum(counts.get(featureType, 0) for featureType in dynamicFeatureTypes)
+	if leftover > 0:
+		problems.append("{:d} leftover vehicle, RSU or parked car features".format(leftover))
+	return problems
+
+
+# Create (or recreate) a worker database from the template
+def createWorker(server, database, template, recreate):
+	if recreate:
+		server.run('postgres', "DROP DATABASE IF EXISTS {:s};".format(database))
+	server.run('postgres', "CREATE DATABASE {:s} OWNER \"{:s}\" TEMPLATE {:s};".format(database, server.user, template))
+
+
+# Run a function on every worker database in parallel, then verify each one. Returns True if all are sound.
+def forEachWorker(server, databases, buildingCount, processes, action=None):
+	def provisionOne(database):
+		if action is not None:
+			action(database)
+		return verifyDatabase(server, database, buildingCount)
+
+	sound = True
+	with concurrent.futures.ThreadPoolExecutor(max(1, min(processes, len(databases)))) as executor:
+		futures = {database: executor.submit(provisionOne, database) for database in databases}
+		for database in databases:
+			try:
+				problems = futures[database].result()
+			except DatabaseError as error:
+				problems = [str(error)]
+			print("{:s}\t{:s}".format(database, "ok" if not problems else "; ".join(problems)), flush=True)
+			sound &= not problems
+	return sound
+
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage="%prog [options] provision [workers]\n       %prog [options] clear\n       %prog [options] verify")
+	parser.add_option("-c", "--config", dest="configFile", default=None, help="take connection settings from the 'gis' dictionary of a configuration file", metavar="FILE")
+	parser.add_option("--host", dest="host", default=None, help="GIS server host [default: localhost]")
+	parser.add_option("--port", dest="port", type="int", default=None, help="GIS server port [default: 5432]")
+	parser.add_option("--user", dest="user", default=None, help="GIS server user [default: root]")
+	parser.add_option("--password", dest="password", default=None, help="GIS server password (default: $PGPASSWORD)")
+	parser.add_option("-t", "--template", dest="template", default='gisdb', help="template database, holding the buildings [default: %default]", metavar="NAME")
+	parser.add_option("-s", "--shapefile", dest="shapefile", default=defaultShapefile, help="building shapefile to load into a new template [default: %default]", metavar="FILE")
+	parser.add_option("--prefix", dest="prefix", default='gisdb', help="prefix of the worker databases [default: %default]")
+	parser.add_option("-p", "--parallel", dest="parallel", type="int", default=4, help="number of databases worked on at once [default: %default]", metavar="N")
+	parser.add_option("--reload", dest="reload", action="store_true", default=False, help="drop and reload the template database")
+	parser.add_option("--recreate", dest="recreate", action="store_true", default=False, help="drop and recreate existing worker databases")
+	(options, args) = parser.parse_args()
+
+	if len(args) == 0 or args[0] not in ['provision', 'clear', 'verify'] or (args[0] == 'provision' and (len(args) != 2 or not args[1].isdigit())):
+		parser.print_usage()
+		sys.exit(1)
+
+	gisConfig = {}
+	if options.configFile is not None:
+		with open(options.configFile, 'rb') as configFileHandle:
+			gisConfig = plistlib.load(configFileHandle, fmt=plistlib.FMT_XML).get('gis', {})
+	server = GISServer(
+		options.host or gisConfig.get('host', 'localhost'),
+		options.port or gisConfig.get('port', 5432),
+		options.user or gisConfig.get('user', 'root'),
+		options.password if options.password is not None else gisConfig.get('password', os.environ.get('PGPASSWORD', '')))
+	# Configurations name the worker database they were last run on (gisdb7), so never take the template from them
+	template = options.template
+	if not re.match('^[a-z_][a-z0-9_]*$', template + options.prefix):
+		print("Error: Database names must be lowercase letters, digits and underscores.")
+		sys.exit(1)
+	if re.match('^' + re.escape(options.prefix) + '[0-9]+$', template):
+		print("Error: Template database {:s} is named like a worker database, and would be cleared or copied onto itself.".format(template))
+		sys.exit(1)
+
+	try:
+		databases = server.databases()
+		if args[0] == 'provision':
+			if options.reload and template in databases:
+				server.run('postgres', "DROP DATABASE {:s};".format(template))
+				databases.discard(template)
+			if template not in databases:
+				print("Loading {:s} into template database {:s}.".format(options.shapefile, template), flush=True)
+				loadTemplate(server, template, options.shapefile)
+			# Clones copy whatever the template holds, including leftover features
+			clearDynamicFeatures(server, template)
+		elif template not in databases:
+			print("Error: No template database {:s}, provision it first.".format(template))
+			sys.exit(1)
+
+		buildingCount = featureCounts(server, template).get(buildingFeatureType, 0)
+		if buildingCount == 0:
+			print("Error: No buildings in template database {:s}.".format(template))
+			sys.exit(1)
+
+		if args[0] == 'provision':
+			workerDatabases = ["{:s}{:d}".format(options.prefix, worker) for worker in range(int(args[1]))]
+			existing = [database for database in workerDatabases if database in databases]
+			# Existing databases are only cleared, unless recreated; new ones are copied from the template
+			action = lambda database: createWorker(server, database, template, options.recreate) if options.recreate or database not in databases else clearDynamicFeatures(server, database)
+			print("Provisioning {:d} worker databases from {:s} ({:d} buildings), {:d} already present.".format(len(workerDatabases), template, buildingCount, len(existing)), flush=True)
+		else:
+			workerDatabases = [database for database in server.workerDatabases(options.prefix) if database != template]
+			action = (lambda database: clearDynamicFeatures(server, database)) if args[0] == 'clear' else None
+	except DatabaseError as error:
+		print("Error:", error)
+		sys.exit(1)
+
+	if not forEachWorker(server, workerDatabases, buildingCount, options.parallel, action):
+		sys.exit(1)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# This script converts SUMO floating car data ('--fcd-output', optionally with '--fcd-output.geo') from XML
+# into the TSV that gissumo reads, as 'tools/floatingCarDataXML2TSV' does, with the same output:
+#   ./fcdXML2TSV.py [file.fcd.xml or file.fcd.xml.gz] [-o file.fcd.tsv]
+#
+# The XML is streamed through an expat parser, which keeps no elements in memory. Large files are cut at
+# '<timestep' boundaries into chunks that a pool of processes converts in parallel; each chunk is parsed
+# with the header of the file (declaration and root element) in front, and the TSV of the chunks is
+# written in order. Plain files are read by the workers at their offsets, compressed files are decompressed
+# once and their chunks handed to the workers. An output file ending in '.gz' is written as one gzip
+# member per chunk, compressed by the workers.
+
+import collections
+import gzip
+import multiprocessing
+import optparse
+import os
+import sys
+import time
+import xml.parsers.expat
+
+# Requires Python >3.5
+assert sys.version_info >= (3,5)
+
+
+tsvHeader = "time\tid\txgeo\tygeo\n"
+rootElement = b'<fcd-export'
+timestepElement = b'<timestep'
+rootClosing = b'</fcd-export>'
+
+defaultChunkSize = 32<<20
+readSize = 1<<20
+
+
+# Output file of a floating car data file, named as 'floatingCarDataXML2TSV' does
+def tsvPath(fcdFile):
+	return fcdFile.replace('.xml', '.tsv')
+
+
+# Position of the next element with the given tag name in a buffer, or -1
+def findElement(buffer, tag, start=0, end=None):
+	end = len(buffer) if end is None else end
+	position = buffer.find(tag, start, end)
+	while position != -1:
+		nextByte = buffer[position+len(tag):position+len(tag)+1]
+		if nextByte in (b' ', b'\t', b'\n', b'\r', b'>', b'/'):
+			return position
+		position = buffer.find(tag, position+1, end)
+	return -1
+
+
+# Position of the last timestep element that starts in buffer[start:end], or -1
+def findLastTimestep(buffer, start, end):
+	position = buffer.rfind(timestepElement, start, end)
+	while position != -1 and findElement(buffer, timestepElement, position, position+len(timestepElement)+1) != position:
+		position = buffer.rfind(timestepElement, start, position)
+	return position
+
+
+# Convert part of a floating car data file to TSV lines.
+# The chunk must start at a timestep (or hold the whole file) and is parsed after the file's 'header', everything
+# before the first timestep. Chunks other than the last are closed with the root element's closing tag.
+# Returns the TSV bytes, the first and last timestep times (None without timesteps) and the counts of timesteps and vehicles.
+def convertChunk(header, data, isLast, compress=False):
+	lines = []
+	state = {'depth': 0, 'isFcd': False, 'inTimestep': False, 'time': None, 'firstTime': None, 'lastTime': -sys.float_info.max, 'timesteps': 0}
+
+	def startElement(name, attributes):
+		state['depth'] += 1
+		depth = state['depth']
+		if depth == 1:
+			state['isFcd'] = (name == 'fcd-export')
+		elif depth == 2 and name == 'timestep' and state['isFcd']:
+			try:
+				timestepTime = float(attributes['time'])
+			except (KeyError, ValueError):
+				raise ValueError("Invalid timestep entry.")
+			# We assume the FCD data is provided to us sorted; if not, fail
+			if state['lastTime'] >= timestepTime:
+				raise ValueError("Floating car data not sorted in time.")
+			state['lastTime'] = timestepTime
+			if state['firstTime'] is None:
+				state['firstTime'] = timestepTime
+			state['time'] = repr(timestepTime)
+			state['inTimestep'] = True
+			state['timesteps'] += 1
+		elif depth == 3 and name == 'vehicle' and state['inTimestep']:
+			try:
+				vehicleId = int(attributes['id'])
+				if vehicleId < 0 or vehicleId >= 1<<64:
+					raise ValueError
+				lines.append("{:s}\t{:d}\t{!r}\t{!r}\n".format(state['time'], vehicleId, float(attributes['x']), float(attributes['y'])))
+			except (KeyError, ValueError):
+				raise ValueError("Unable to convert vehicle properties: {:s}".format(" ".join('{:s}="{:s}"'.format(*attribute) for attribute in attributes.items())))
+
+	def endElement(name):
+		if state['depth'] == 2:
+			state['inTimestep'] = False
+		state['depth'] -= 1
+
+	parser = xml.parsers.expat.ParserCreate()
+	parser.StartElementHandler = startElement
+	parser.EndElementHandler = endElement
+	try:
+		parser.Parse(header, False)
+		parser.Parse(data, False)
+		parser.Parse(b'' if isLast else rootClosing, True)
+	except xml.parsers.expat.ExpatError as error:
+		raise ValueError("Unable to parse XML data: {:s}".format(str(error)))
+
+	tsvData = "".join(lines).encode()
+	if compress:
+		tsvData = gzip.compress(tsvData, compresslevel=6)
+	lastTime = state['lastTime'] if state['firstTime'] is not None else None
+	return tsvData, state['firstTime'], lastTime, state['timesteps'], len(lines)
+
+
+# Convert the chunk of a plain floating car data file in [start, end)
+def convertFileChunk(fcdFile, header, start, end, isLast, compress=False):
+	with open(fcdFile, 'rb') as fcdFileHandle:
+		fcdFileHandle.seek(start)
+		data = fcdFileHandle.read(end-start)
+	return convertChunk(header, data, isLast, compress)
+
+
+# Cut a plain floating car data file into chunks of about 'chunkSize' bytes, at timestep boundaries.
+# Returns the header and a list of (start, end) offsets.
+def splitFile(fcdFile, chunkSize=defaultChunkSize):
+	fileSize = os.path.getsize(fcdFile)
+	with open(fcdFile, 'rb') as fcdFileHandle:
+		# The header ends at the first timestep after the root element
+		buffer = b''
+		firstTimestep = -1
+		while firstTimestep == -1:
+			block = fcdFileHandle.read(readSize)
+			if not block:
+				return b'', [(0, fileSize)]
+			buffer += block
+			root = findElement(buffer, rootElement)
+			if root != -1:
+				firstTimestep = findElement(buffer, timestepElement, root)
+		header = buffer[:firstTimestep]
+
+		boundaries = [firstTimestep]
+		while boundaries[-1] + chunkSize < fileSize:
+			# Look for the next timestep past the chunk size
+			position = boundaries[-1] + chunkSize
+			nextTimestep = -1
+			while nextTimestep == -1 and position < fileSize:
+				fcdFileHandle.seek(position)
+				block = fcdFileHandle.read(readSize + len(timestepElement) + 1)
+				nextTimestep = findElement(block, timestepElement)
+				if nextTimestep != -1:
+					nextTimestep += position
+				position += readSize
+			if nextTimestep == -1:
+				break
+			boundaries.append(nextTimestep)
+	boundaries.append(fileSize)
+	return header, list(zip(boundaries[:-1], boundaries[1:]))
+
+
+# Cut a stream of floating car data into chunks of about 'chunkSize' bytes, at timestep boundaries.
+# Yields the header first, then the chunks.
+def splitStream(fcdFileHandle, chunkSize=defaultChunkSize):
+	buffer = b''
+	firstTimestep = -1
+	while firstTimestep == -1:
+		block = fcdFileHandle.read(readSize)
+		if not block:
+			yield b''
+			yield buffer
+			return
+		buffer += block
+		root = findElement(buffer, rootElement)
+		if root != -1:
+			firstTimestep = findElement(buffer, timestepElement, root)
+	yield buffer[:firstTimestep]
+	blocks = [buffer[firstTimestep:]]
+	blocksSize = len(blocks[0])
+
+	for block in iter(lambda: fcdFileHandle.read(readSize), b''):
+		blocks.append(block)
+		blocksSize += len(block)
+		if blocksSize >= chunkSize + readSize:
+			# Cut at the last timestep that starts past the chunk size, keeping the rest for the next chunk
+			buffer = b''.join(blocks)
+			cut = findLastTimestep(buffer, chunkSize, len(buffer) - len(timestepElement) - 1)
+			if cut > 0:
+				yield buffer[:cut]
+				buffer = buffer[cut:]
+			blocks = [buffer]
+			blocksSize = len(buffer)
+	yield b''.join(blocks)
+
+
+# Convert a floating car data file (plain or gzip-compressed XML) to a TSV file, in parallel.
+# Returns the counts of timesteps and vehicles and the size of the XML read.
+def convertFile(fcdFile, tsvFile, processes=None, chunkSize=defaultChunkSize):
+	compress = tsvFile.endswith('.gz')
+	processes = processes if processes is not None else multiprocessing.cpu_count()
+	pool = multiprocessing.Pool(processes) if processes > 1 else None
+
+	# Jobs to convert each chunk, generated lazily; compressed files are decompressed as the jobs are taken
+	if fcdFile.endswith('.gz'):
+		fcdFileHandle = gzip.open(fcdFile, 'rb')
+		chunks = splitStream(fcdFileHandle, chunkSize)
+		header = next(chunks)
+		def jobs():
+			data = next(chunks)
+			for nextData in chunks:
+				yield convertChunk, (header, data, False, compress), len(data)
+				data = nextData
+			yield convertChunk, (header, data, True, compress), len(data)
+	else:
+		fcdFileHandle = None
+		header, offsets = splitFile(fcdFile, chunkSize)
+		def jobs():
+			for chunkIndex, (start, end) in enumerate(offsets):
+				yield convertFileChunk, (fcdFile, header, start, end, chunkIndex == len(offsets)-1, compress), end-start
+
+	# Keep at most two chunks per process in flight, writing the results in order
+	totals = {'timesteps': 0, 'vehicles': 0, 'xmlBytes': len(header)}
+	lastTime = [None]
+	def writeResult(result, tsvFileHandle):
+		tsvData, chunkFirstTime, chunkLastTime, timesteps, vehicles = result
+		if chunkFirstTime is not None:
+			if lastTime[0] is not None and lastTime[0] >= chunkFirstTime:
+				raise ValueError("Floating car data not sorted in time.")
+			lastTime[0] = chunkLastTime
+		tsvFileHandle.write(tsvData)
+		totals['timesteps'] += timesteps
+		totals['vehicles'] += vehicles
+
+	partFile = tsvFile + '.part'
+	try:
+		with open(partFile, 'wb') as tsvFileHandle:
+			tsvFileHandle.write(gzip.compress(tsvHeader.encode()) if compress else tsvHeader.encode())
+			pending = collections.deque()
+			for function, arguments, xmlBytes in jobs():
+				totals['xmlBytes'] += xmlBytes
+				if pool is None:
+					writeResult(function(*arguments), tsvFileHandle)
+					continue
+				pending.append(pool.apply_async(function, arguments))
+				while len(pending) >= 2*processes:
+					writeResult(pending.popleft().get(), tsvFileHandle)
+			while pending:
+				writeResult(pending.popleft().get(), tsvFileHandle)
+		os.replace(partFile, tsvFile)
+	finally:
+		if pool is not None:
+			pool.terminate()
+		if fcdFileHandle is not None:
+			fcdFileHandle.close()
+		if os.path.isfile(partFile):
+			os.remove(partFile)
+
+	return totals
+
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage="%prog [file.fcd.xml or file.fcd.xml.gz]")
+	parser.add_option("-o", "--output", dest="tsvFile", default=None, help="write TSV to file, gzip-compressed if it ends in .gz (default: input name with .xml replaced by .tsv)", metavar="FILE")
+	parser.add_option("-p", "--processes", dest="processes", type="int", default=None, help="number of processes converting chunks (default: one per core)", metavar="N")
+	parser.add_option("--chunk-size", dest="chunkSize", type="int", default=defaultChunkSize>>20, help="size of the chunks of XML handed to each process, in MB [default: %default]", metavar="MB")
+	(options, args) = parser.parse_args()
+
+	if len(args) != 1 or not (args[0].endswith('.fcd.xml') or args[0].endswith('.fcd.xml.gz')):
+		print("Error: Please supply a .fcd.xml or .fcd.xml.gz floating car data file.")
+		sys.exit(1)
+	fcdFile = args[0]
+
+	if not os.path.isfile(fcdFile):
+		print("Error: Unable to open floating car data file.")
+		sys.exit(1)
+
+	tsvFile = options.tsvFile if options.tsvFile is not None else tsvPath(fcdFile)
+
+	startTime = time.time()
+	try:
+		totals = convertFile(fcdFile, tsvFile, options.processes, max(options.chunkSize, 1)<<20)
+	except (OSError, EOFError, ValueError) as error:
+		print("Error:", error)
+		sys.exit(1)
+	elapsedTime = max(time.time() - startTime, 1e-6)
+
+	print("Converted {:d} timesteps and {:d} vehicle entries to {:s}.".format(totals['timesteps'], totals['vehicles'], tsvFile))
+	print("Read {:.1f} MB of XML ({:.1f} MB on disk) in {:.2f}s: {:.1f} MB/s.".format(totals['xmlBytes']/1e6, os.path.getsize(fcdFile)/1e6, elapsedTime, totals['xmlBytes']/1e6/elapsedTime))
@@ -38,14 +38,19 @@ if [ -d ${VISDIR} ]; then
 fi
 mkdir -p ${VISDIR}
 
-touch statfilelist
-for SIMULATIONLOG in $(find ${SIMDIR} -maxdepth 3 -type f -name 'entityCount.log'); do
-	printf "${SIMULATIONLOG}\n" >> statfilelist
-done
-
-# Call swift interpreter
-swift $(dirname $0)/analyzeColumnByTime.swift statfilelist roadsideUnits > ${VISDIR}/${VISNAME}.data
-rm -rf statfilelist
+# Use the data precomputed by analyzeStatistics.py, if a package provides it
+if [ -n "${STATSDATADIR}" ] && [ -f ${STATSDATADIR}/actRsuCnt.data ]; then
+	cp ${STATSDATADIR}/actRsuCnt.data ${VISDIR}/${VISNAME}.data
+else
+	touch statfilelist
+	for SIMULATIONLOG in $(find ${SIMDIR} -maxdepth 3 -type f -name 'entityCount.log'); do
+		printf "${SIMULATIONLOG}\n" >> statfilelist
+	done
+
+	# Call swift interpreter
+	swift $(dirname $0)/analyzeColumnByTime.swift statfilelist roadsideUnits > ${VISDIR}/${VISNAME}.data
+	rm -rf statfilelist
+fi
 
 # Copy over gnuplot scaffold script
 cp $(dirname $0)/${VISNAME}.gnuplot ${VISDIR}/
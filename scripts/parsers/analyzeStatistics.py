@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# This script computes the data for the package parsers in a single pass over a folder of simulations.
+# Each statistics log is read once, on a pool of processes, and every metric taken from it is computed
+# together. Logs are read through their columnar copies (see statsCache), converting them on first use.
+# The '.data' files it writes match the output of 'analyzeColumnByTime.swift' and
+# 'binCoverageEvolution.swift', so the parser scripts can plot them as they are.
+#
+# usage: ./analyzeStatistics.py [folder with simulations] [output folder]
+
+import math
+import multiprocessing
+import optparse
+import os
+import sys
+
+import statsCache
+
+# Requires Python >3.5
+assert sys.version_info >= (3,5)
+
+
+# Statistics by time of a log column, as computed by analyzeColumnByTime.swift: (data file name, log, column)
+columnStatistics = [
+	('actVehCnt', 'entityCount.log', 'vehicles'),
+	('actRsuCnt', 'entityCount.log', 'roadsideUnits'),
+	('covCell', 'cityCoverageEvolution.log', '%covered'),
+	('meanSig', 'signalAndSaturationEvolution.log', 'meanSig'),
+	('meanSat', 'signalAndSaturationEvolution.log', 'meanSat'),
+	('sigToSat', 'signalAndSaturationEvolution.log', 'sigToSat')
+]
+
+# Coverage evolution in time bins, as computed by binCoverageEvolution.swift: (data file name, log, binning width in seconds)
+coverageBinning = [
+	('covOverTime_300', 'cityCoverageEvolution.log', 300)
+]
+
+# Statistics logs are found up to this depth in the simulation folder ('<simulation>/stats/<log>')
+logSearchDepth = 3
+
+
+# Find the statistics logs with a given name, in the same order as 'find -maxdepth 3 -name'
+def findStatsLogs(simDir, logName, maxDepth=logSearchDepth):
+	logFiles = []
+	baseDepth = simDir.rstrip(os.sep).count(os.sep)
+	for dirpath, dirnames, filenames in os.walk(simDir):
+		depth = dirpath.rstrip(os.sep).count(os.sep) - baseDepth
+		if depth >= maxDepth-1:
+			dirnames[:] = []
+		if logName in filenames:
+			logFiles.append(os.path.join(dirpath, logName))
+	return logFiles
+
+
+# Parse one statistics log (in a worker process), extracting (time, value) samples
+# for the requested columns and, if requested, its coverage entries.
+# Also returns the bytes read for each column, the parse time and how the log was read.
+def parseStatsLog(logJob):
+	logFile, columns, parseCoverage, useCache = logJob
+	statsColumns = statsCache.load(logFile, None if parseCoverage else ['time'] + columns, useCache)
+
+	times = [float(time) for time in statsColumns.column('time').tolist()]
+	samples = {}
+	for column in columns:
+		samples[column] = list(zip(times, [float(value) for value in statsColumns.column(column).tolist()]))
+
+	# time	#covered	%covered	meanSig	stdevSig	0cells	1cells	2cells	3cells	4cells	5cells
+	coverage = None
+	if parseCoverage:
+		coverageColumns = [column.tolist() for column in statsColumns.columns[:11]]
+		coverage = [(float(row[0]), int(row[1]), float(row[2]), float(row[3]), float(row[4]), [int(field) for field in row[5:11]]) for row in zip(*coverageColumns)]
+
+	return samples, coverage, statsColumns.columnBytes, statsColumns.parseTime, statsColumns.source
+
+
+# Add up floats in order, as Swift's reduce(0,+) does
+def sequentialSum(values):
+	total = 0.0
+	for value in values:
+		total += value
+	return total
+
+
+# Per-time mean, stdev, variance, min, max and count of a list of (time, value) samples,
+# formatted as analyzeColumnByTime.swift
+def formatColumnStatistics(timeSamples):
+	dataDictionary = {}
+	for time, value in timeSamples:
+		dataDictionary.setdefault(time, []).append(value)
+
+	outputLines = ["\t".join(["time", "mean", "stdev", "var", "min", "max", "count"])]
+	for time in sorted(dataDictionary):
+		samples = dataDictionary[time]
+		count = float(len(samples))
+		mean = sequentialSum(samples)/count
+		# Maximum likelihood estimator (over N)
+		variance = sequentialSum([(sample-mean)**2 for sample in samples])/count
+		outputLines.append("\t".join(repr(value) for value in [time, mean, math.sqrt(variance), variance, min(samples), max(samples), count]))
+	return "\n".join(outputLines) + "\n"
+
+
+# Average the coverage entries in time bins, formatted as binCoverageEvolution.swift
+def formatCoverageBins(coverageData, binningWidth):
+	coverageData = sorted(coverageData, key=lambda coverage: coverage[0])
+
+	firstBin = int(coverageData[0][0] - math.fmod(coverageData[0][0], binningWidth))
+	lastBin = int(coverageData[-1][0] - math.fmod(coverageData[-1][0], binningWidth))
+
+	outputLines = ["\t".join(["time", "#covered", "%covered", "meanSig", "stdevSig", "0cells", "1cells", "2cells", "3cells", "4cells", "5cells"]), ""]
+	countStart = 0
+	for bin in range(firstBin, lastBin+1, binningWidth):
+		entries = 0
+		cellsCovered = 0
+		percentCellsCovered = 0.0
+		meanSignal = 0.0
+		stdevSignal = 0.0
+		coverageByStrength = [0]*6
+
+		# As in binCoverageEvolution.swift, each bin starts at the last entry of the previous bin
+		for index in range(countStart, len(coverageData)):
+			time, inCellsCovered, inPercentCellsCovered, inMeanSignal, inStdevSignal, inCoverageByStrength = coverageData[index]
+			if time >= bin+binningWidth:
+				break
+			cellsCovered += inCellsCovered
+			percentCellsCovered += inPercentCellsCovered
+			meanSignal += inMeanSignal
+			stdevSignal += inStdevSignal
+			coverageByStrength = [cells+inCells for cells, inCells in zip(coverageByStrength, inCoverageByStrength)]
+			entries += 1
+			countStart = index
+
+		outputLines.append("\t".join([str(bin), str(cellsCovered//entries), repr(percentCellsCovered/entries), repr(meanSignal/entries), repr(stdevSignal/entries)] + [str(cells//entries) for cells in coverageByStrength]))
+	return "\n".join(outputLines) + "\n"
+
+
+# Compute every metric over a folder of simulations, returning a dictionary of data file names and contents,
+# and a dictionary of (logs read, bytes read, parse time, log sources) for each data file
+def analyzeSimulations(simDir, processes=None, useCache=True):
+	# Gather the logs to read, and what to extract from each of them
+	logNames = []
+	for _, logName, _ in columnStatistics + coverageBinning:
+		if logName not in logNames:
+			logNames.append(logName)
+
+	logFiles = {logName: findStatsLogs(simDir, logName) for logName in logNames}
+	logJobs = []
+	for logName in logNames:
+		columns = [column for (_, columnLog, column) in columnStatistics if columnLog == logName]
+		parseCoverage = any(coverageLog == logName for (_, coverageLog, _) in coverageBinning)
+		logJobs += [(logFile, columns, parseCoverage, useCache) for logFile in logFiles[logName]]
+
+	# Read every log once
+	with multiprocessing.Pool(processes) as pool:
+		parsedLogs = dict(zip([logFile for (logFile, _, _, _) in logJobs], pool.map(parseStatsLog, logJobs, chunksize=1)))
+
+	# What it took to read the columns of each data file: the whole log, when parsed
+	# as text, or just the columns it needs from the columnar copy
+	def readCost(logName, columns):
+		bytesRead = 0
+		parseTime = 0.0
+		sources = set()
+		for logFile in logFiles[logName]:
+			_, _, columnBytes, logParseTime, source = parsedLogs[logFile]
+			bytesRead += statsCache.readBytes(columnBytes, source, columns)
+			parseTime += logParseTime
+			sources.add(source)
+		return (len(logFiles[logName]), bytesRead, parseTime, sources)
+
+	# Merge the logs in the order they were found
+	dataFiles = {}
+	readCosts = {}
+	for dataName, logName, column in columnStatistics:
+		if len(logFiles[logName]) == 0:
+			continue
+		timeSamples = []
+		for logFile in logFiles[logName]:
+			timeSamples += parsedLogs[logFile][0][column]
+		dataFiles[dataName] = formatColumnStatistics(timeSamples)
+		readCosts[dataName] = readCost(logName, ['time', column])
+
+	for dataName, logName, binningWidth in coverageBinning:
+		coverageData = []
+		for logFile in logFiles[logName]:
+			coverageData += parsedLogs[logFile][1]
+		if len(coverageData) == 0:
+			continue
+		dataFiles[dataName] = formatCoverageBins(coverageData, binningWidth)
+		readCosts[dataName] = readCost(logName, None)
+
+	return dataFiles, readCosts
+
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage="%prog [folder with simulations] [output folder]")
+	parser.add_option("-p", "--processes", dest="processes", type="int", default=None, help="number of processes reading logs (default: one per core)", metavar="N")
+	parser.add_option("--text", dest="useCache", action="store_false", default=True, help="parse the logs as text, without their columnar copies")
+	(options, args) = parser.parse_args()
+
+	if len(args) != 2:
+		parser.print_usage()
+		sys.exit(1)
+	simDir, outputDir = args
+
+	if not os.path.isdir(simDir):
+		print("Error: Simulations folder not present.")
+		sys.exit(1)
+
+	try:
+		dataFiles, readCosts = analyzeSimulations(simDir, options.processes, options.useCache)
+	except (ValueError, IndexError) as error:
+		print("Error: Can't interpret statistics files:", error)
+		sys.exit(1)
+
+	os.makedirs(outputDir, exist_ok=True)
+	for dataName, dataContents in sorted(dataFiles.items()):
+		with open(os.path.join(outputDir, dataName + '.data'), 'w') as dataFileHandle:
+			dataFileHandle.write(dataContents)
+		logCount, bytesRead, parseTime, sources = readCosts[dataName]
+		print("Wrote {:s}.data ({:d} logs, {:.0f} kB read, {:.3f}s parsing, {:s})".format(dataName, logCount, bytesRead/1024, parseTime, '/'.join(sorted(sources))))
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# This module loads the cell maps written by GISSUMO into NumPy arrays, and reduces the final city maps
+# of a set of simulations into heatmaps.
+#
+# Cell maps are written as 'tlc<x>;<y>' (the coordinates of the top-left cell) followed by one line per
+# row of cells, one character per cell (CellMap.description in 'src/cellmap.swift'). Obstruction masks
+# and other payloads use 'p' between rows and ';' between cells instead. Cell coordinates grow eastwards
+# in x and northwards in y, so row r and column c of a map hold cell (tlc.x+c, tlc.y-r).
+#
+# The reducer goes through the 'finalCityCoverageMap', 'finalCitySaturationMap' and 'finalCityEntitiesMap'
+# logs of every simulation once, keeping per-cell counts of each value, so its memory does not grow with
+# the number of simulations. It writes mean and percentile heatmaps as gnuplot matrices (masked cells
+# are NaN) and as a '.npz' file:
+#   ./cellMaps.py [folder with simulations] [output folder] [-m obstructionMask.payload]
+
+import multiprocessing
+import optparse
+import os
+import sys
+
+import numpy
+
+# Requires Python >3.5
+assert sys.version_info >= (3,5)
+
+
+# Final city maps with one digit per cell, and the map of entities ('V'ehicles, 'P'arked cars, 'R'oadside units)
+numericMapLogs = ['finalCityCoverageMap.log', 'finalCitySaturationMap.log']
+entitiesMapLog = 'finalCityEntitiesMap.log'
+entityTypes = ['V', 'P', 'R']
+
+defaultPercentiles = [10, 50, 90]
+
+
+class CellMap:
+	def __init__(self, topLeftCell, cells):
+		self.topLeftCell = topLeftCell
+		self.cells = cells
+
+	def size(self):
+		return (self.cells.shape[1], self.cells.shape[0])
+
+	# Copy of the cells in the frame of another map (top-left cell and (x,y) size), filling cells outside this map
+	def aligned(self, topLeftCell, size, fill):
+		alignedCells = numpy.full((size[1], size[0]), fill, dtype=self.cells.dtype)
+		bounds = overlapBounds(self.topLeftCell, self.size(), topLeftCell, size)
+		if bounds is not None:
+			(sourceRows, sourceColumns), (targetRows, targetColumns) = bounds
+			alignedCells[targetRows, targetColumns] = self.cells[sourceRows, sourceColumns]
+		return alignedCells
+
+
+# Overlap of two maps, as (row, column) slices into the first map and into the second map, or None
+def overlapBounds(topLeftCell, size, otherTopLeftCell, otherSize):
+	xStart = max(topLeftCell[0], otherTopLeftCell[0])
+	xEnd = min(topLeftCell[0]+size[0], otherTopLeftCell[0]+otherSize[0])
+	yStart = min(topLeftCell[1], otherTopLeftCell[1])
+	yEnd = max(topLeftCell[1]-size[1], otherTopLeftCell[1]-otherSize[1])
+	if xStart >= xEnd or yStart <= yEnd:
+		return None
+	slices = lambda tlc: (slice(tlc[1]-yStart, tlc[1]-yEnd), slice(xStart-tlc[0], xEnd-tlc[0]))
+	return slices(topLeftCell), slices(otherTopLeftCell)
+
+
+# Smallest frame (top-left cell and size) containing two frames
+def unionFrame(topLeftCell, size, otherTopLeftCell, otherSize):
+	xStart = min(topLeftCell[0], otherTopLeftCell[0])
+	xEnd = max(topLeftCell[0]+size[0], otherTopLeftCell[0]+otherSize[0])
+	yStart = max(topLeftCell[1], otherTopLeftCell[1])
+	yEnd = min(topLeftCell[1]-size[1], otherTopLeftCell[1]-otherSize[1])
+	return (xStart, yStart), (xEnd-xStart, yStart-yEnd)
+
+
+def parseTopLeftCell(header):
+	if not header.startswith(b'tlc'):
+		raise ValueError("Missing 'tlc' header.")
+	x, y = header[3:].split(b';')
+	return (int(x), int(y))
+
+
+# Unicode code points of a byte string, without going through each character
+def codePoints(data):
+	rawBytes = numpy.frombuffer(data, dtype=numpy.uint8)
+	if len(rawBytes) == 0 or rawBytes.max() < 0x80:
+		return rawBytes
+	return numpy.frombuffer(data.decode('utf-8').encode('utf-32-le'), dtype='<u4')
+
+
+# Parse a cell map description into its top-left cell and an array with the code point of each cell
+def parseCellMap(data):
+	header, _, body = data.strip(b'\n').partition(b'\n')
+	topLeftCell = parseTopLeftCell(header)
+
+	codes = codePoints(body)
+	newlines = numpy.flatnonzero(codes == ord('\n'))
+	width = int(newlines[0]) if len(newlines) > 0 else len(codes)
+	rows = len(newlines)+1
+	# Every row must be as wide as the first: cells with more than one character can't be told apart
+	if len(codes) != rows*(width+1)-1 or not numpy.array_equal(newlines, numpy.arange(width, len(codes), width+1)):
+		raise ValueError("Rows of different widths, cells must be single characters.")
+	cells = numpy.append(codes, ord('\n')).reshape(rows, width+1)[:,:width]
+	return CellMap(topLeftCell, cells)
+
+
+# Parse a cell map payload ('tlc<x>;<y>p<cell>;<cell>;...p<cell>;...') with single-character cells
+def parseCellMapPayload(data):
+	data = data.strip()
+	header, _, body = data.partition(b'p')
+	topLeftCell = parseTopLeftCell(header)
+
+	codes = codePoints(body)
+	rowBreaks = numpy.flatnonzero(codes == ord('p'))
+	rowLength = int(rowBreaks[0]) if len(rowBreaks) > 0 else len(codes)
+	width = (rowLength+1)//2
+	rows = len(rowBreaks)+1
+	if len(codes) != rows*(rowLength+1)-1 or not numpy.all(codes[1::2] == numpy.where(numpy.arange(1, len(codes), 2) % (rowLength+1) == rowLength, ord('p'), ord(';'))):
+		raise ValueError("Malformed payload, cells must be single characters.")
+	return CellMap(topLeftCell, codes[0::2].reshape(rows, width))
+
+
+def readCellMap(mapFile):
+	with open(mapFile, 'rb') as mapFileHandle:
+		return parseCellMap(mapFileHandle.read())
+
+
+# Convert a map with one digit per cell (as code points) into integers
+def numericCellMap(cellMap, source='map'):
+	digits = cellMap.cells.astype(numpy.int16) - ord('0')
+	if digits.size > 0 and (digits.min() < 0 or digits.max() > 9):
+		raise ValueError("Non-digit cells in {:s}.".format(source))
+	return CellMap(cellMap.topLeftCell, digits.astype(numpy.int8))
+
+
+# Read a map with one digit per cell into integers
+def readNumericCellMap(mapFile):
+	return numericCellMap(readCellMap(mapFile), mapFile)
+
+
+# Read an obstruction mask payload into a map of open ('O') cells
+def readObstructionMask(maskFile):
+	with open(maskFile, 'rb') as maskFileHandle:
+		mask = parseCellMapPayload(maskFileHandle.read())
+	return CellMap(mask.topLeftCell, mask.cells == ord('O'))
+
+
+# Per-cell counts of each value, over a frame that grows to contain every map added to it
+class CellValueCounts:
+	def __init__(self, valueCount, outsideValue=0, topLeftCell=None, size=None):
+		self.valueCount = valueCount
+		# Value counted for cells outside a map
+		self.outsideValue = outsideValue
+		# Fixed frame, if given (e.g. the obstruction mask's); maps are cropped to it
+		self.fixedFrame = topLeftCell is not None
+		self.topLeftCell = topLeftCell
+		self.counts = None if topLeftCell is None else numpy.zeros((size[1], size[0], valueCount), dtype=numpy.uint32)
+		self.maps = 0
+
+	def size(self):
+		return (self.counts.shape[1], self.counts.shape[0])
+
+	# Move to a larger frame; cells new to the frame were outside every previous map
+	def resize(self, topLeftCell, size):
+		counts = numpy.zeros((size[1], size[0], self.valueCount), dtype=numpy.uint32)
+		counts[:,:,self.outsideValue] = self.maps
+		if self.counts is not None:
+			sourceSlices, targetSlices = overlapBounds(self.topLeftCell, self.size(), topLeftCell, size)
+			counts[targetSlices] = self.counts[sourceSlices]
+		self.topLeftCell, self.counts = topLeftCell, counts
+
+	# Count the values (0 to valueCount-1) of a map's cells
+	def add(self, cellMap):
+		if self.counts is None:
+			self.resize(cellMap.topLeftCell, cellMap.size())
+		elif not self.fixedFrame:
+			topLeftCell, size = unionFrame(self.topLeftCell, self.size(), cellMap.topLeftCell, cellMap.size())
+			if (topLeftCell, size) != (self.topLeftCell, self.size()):
+				self.resize(topLeftCell, size)
+
+		values = cellMap.aligned(self.topLeftCell, self.size(), self.outsideValue)
+		for value in range(self.valueCount):
+			self.counts[:,:,value] += (values == value)
+		self.maps += 1
+
+	# Mean value of each cell
+	def mean(self):
+		return (self.counts*numpy.arange(self.valueCount)).sum(axis=2)/max(self.maps, 1)
+
+	# Value of each cell at a percentile (0 to 100), with the 'lower' method of numpy.percentile
+	def percentile(self, percentile):
+		cumulativeCounts = numpy.cumsum(self.counts, axis=2)
+		rank = int(numpy.floor(percentile/100*(self.maps-1))) if self.maps > 0 else 0
+		return numpy.argmax(cumulativeCounts > rank, axis=2)
+
+	# Fraction of maps in which each cell had a value
+	def fraction(self, value):
+		return self.counts[:,:,value]/max(self.maps, 1)
+
+
+# Find the final city map logs of a folder of simulations
+def findMapLogs(simDir):
+	mapLogs = []
+	for dirpath, dirnames, filenames in os.walk(simDir):
+		mapLogs += [os.path.join(dirpath, file) for file in sorted(filenames) if file in numericMapLogs + [entitiesMapLog]]
+	return mapLogs
+
+
+# Load a final city map (in a worker process): digits for numeric maps, and
+# 1, 2, 3 for each entity type (0 for no entity) for the map of entities.
+# Returns the map, or None and the reason it couldn't be read.
+def loadMapLog(mapLog):
+	try:
+		if os.path.basename(mapLog) == entitiesMapLog:
+			cellMap = readCellMap(mapLog)
+			entities = numpy.zeros(cellMap.cells.shape, dtype=numpy.int8)
+			for entityIndex, entityType in enumerate(entityTypes):
+				entities[cellMap.cells == ord(entityType)] = entityIndex+1
+			return mapLog, CellMap(cellMap.topLeftCell, entities), None
+		return mapLog, readNumericCellMap(mapLog), None
+	except (OSError, ValueError) as error:
+		return mapLog, None, str(error)
+
+
+# Reduce the final city maps of a folder of simulations into per-cell value counts, by log name.
+# With a mask, maps are cropped to its frame. Maps that can't be read (e.g. saturation maps with
+# cells covered by 10 or more RSUs, written with two digits) are skipped. Returns the value counts
+# and the number of maps skipped.
+def reduceMaps(simDir, mask=None, processes=None):
+	valueCounts = {}
+	for logName in numericMapLogs + [entitiesMapLog]:
+		valueCount = len(entityTypes)+1 if logName == entitiesMapLog else 10
+		if mask is not None:
+			valueCounts[logName] = CellValueCounts(valueCount, topLeftCell=mask.topLeftCell, size=mask.size())
+		else:
+			valueCounts[logName] = CellValueCounts(valueCount)
+
+	skippedMaps = 0
+	with multiprocessing.Pool(processes) as pool:
+		for mapLog, cellMap, error in pool.imap(loadMapLog, findMapLogs(simDir)):
+			if cellMap is None:
+				print("Warning: Skipping {:s}: {:s}".format(mapLog, error), file=sys.stderr)
+				skippedMaps += 1
+				continue
+			valueCounts[os.path.basename(mapLog)].add(cellMap)
+
+	return {logName: counts for logName, counts in valueCounts.items() if counts.maps > 0}, skippedMaps
+
+
+# Heatmaps of a log's value counts, by name: mean and percentiles of numeric maps, and the fraction
+# of maps with each entity type for the map of entities. Cells blocked in the mask are NaN.
+def heatmaps(logName, counts, mask=None, percentiles=defaultPercentiles):
+	mapName = logName[len('finalCity'):-len('Map.log')].lower()
+	if logName == entitiesMapLog:
+		maps = {"{:s}.{:s}".format(mapName, entityType): counts.fraction(entityIndex+1) for entityIndex, entityType in enumerate(entityTypes)}
+	else:
+		maps = {mapName + '.mean': counts.mean()}
+		for percentile in percentiles:
+			maps["{:s}.p{:d}".format(mapName, percentile)] = counts.percentile(percentile).astype(numpy.float64)
+
+	if mask is not None:
+		for heatmap in maps.values():
+			heatmap[~mask.cells] = numpy.nan
+	return maps
+
+
+# Write a heatmap as a gnuplot matrix, with its top-left cell in a comment
+def writeMatrix(matrixFile, heatmap, topLeftCell):
+	numpy.savetxt(matrixFile, heatmap, fmt='%.6g', delimiter=' ', header="tlc{:d};{:d}".format(*topLeftCell))
+
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage="%prog [folder with simulations] [output folder]")
+	parser.add_option("-m", "--mask", dest="maskFile", default=None, help="obstruction mask payload; maps are cropped to it and blocked cells left out", metavar="FILE")
+	parser.add_option("--percentiles", dest="percentiles", default=",".join(str(percentile) for percentile in defaultPercentiles), help="percentile heatmaps to compute [default: %default]", metavar="LIST")
+	parser.add_option("-p", "--processes", dest="processes", type="int", default=None, help="number of processes reading maps (default: one per core)", metavar="N")
+	(options, args) = parser.parse_args()
+
+	if len(args) != 2:
+		parser.print_usage()
+		sys.exit(1)
+	simDir, outputDir = args
+
+	if not os.path.isdir(simDir):
+		print("Error: Simulations folder not present.")
+		sys.exit(1)
+
+	try:
+		percentiles = [int(percentile) for percentile in options.percentiles.split(',') if percentile]
+		mask = readObstructionMask(options.maskFile) if options.maskFile is not None else None
+		valueCounts, skippedMaps = reduceMaps(simDir, mask, options.processes)
+	except (OSError, ValueError) as error:
+		print("Error:", error)
+		sys.exit(1)
+
+	if len(valueCounts) == 0:
+		print("Error: No final city maps found.")
+		sys.exit(1)
+
+	os.makedirs(outputDir, exist_ok=True)
+	arrays = {}
+	for logName, counts in sorted(valueCounts.items()):
+		for heatmapName, heatmap in sorted(heatmaps(logName, counts, mask, percentiles).items()):
+			writeMatrix(os.path.join(outputDir, heatmapName + '.data'), heatmap, counts.topLeftCell)
+			arrays[heatmapName] = heatmap
+		arrays[logName[:-len('.log')] + '.topLeftCell'] = numpy.array(counts.topLeftCell)
+		print("Reduced {:d} maps of {:s} ({:d}x{:d} cells).".format(counts.maps, logName, *counts.size()))
+	numpy.savez_compressed(os.path.join(outputDir, 'heatmaps.npz'), **arrays)
+	if skippedMaps > 0:
+		print("Skipped {:d} unreadable maps.".format(skippedMaps))
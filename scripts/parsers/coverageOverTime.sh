@@ -39,14 +39,19 @@ if [ -d ${VISDIR} ]; then
 fi
 mkdir -p ${VISDIR}
 
-touch statfilelist
-for SIMULATIONLOG in $(find ${SIMDIR} -maxdepth 3 -type f -name 'cityCoverageEvolution.log'); do
-	printf "${SIMULATIONLOG}\n" >> statfilelist
-done
-
-# Call swift interpreter
-swift $(dirname $0)/binCoverageEvolution.swift statfilelist ${BINNING} > ${VISDIR}/${VISNAME}.data
-rm -rf statfilelist
+# Use the data precomputed by analyzeStatistics.py, if a package provides it
+if [ -n "${STATSDATADIR}" ] && [ -f ${STATSDATADIR}/covOverTime_${BINNING}.data ]; then
+	cp ${STATSDATADIR}/covOverTime_${BINNING}.data ${VISDIR}/${VISNAME}.data
+else
+	touch statfilelist
+	for SIMULATIONLOG in $(find ${SIMDIR} -maxdepth 3 -type f -name 'cityCoverageEvolution.log'); do
+		printf "${SIMULATIONLOG}\n" >> statfilelist
+	done
+
+	# Call swift interpreter
+	swift $(dirname $0)/binCoverageEvolution.swift statfilelist ${BINNING} > ${VISDIR}/${VISNAME}.data
+	rm -rf statfilelist
+fi
 
 # Copy over gnuplot scaffold script
 cp $(dirname $0)/${VISNAME}.gnuplot ${VISDIR}/
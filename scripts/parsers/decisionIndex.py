@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# This module indexes the 'decisionDetailWPM' and 'decisionDetailCCE' logs, which hold every election with
+# the maps it considered, so that a single decision can be read without going through the whole log.
+#
+# A log is scanned once (memory-mapped), and an index with the byte range of each decision is kept next
+# to it, as '<log>.index.npz', together with the time, parked car ID, 1-hop and 2-hop neighbor counts and
+# number of combinations evaluated of each decision. An index is rebuilt when its log changes.
+#
+# WPM decisions start with '<time> Parked car <id> deciding, neighborMaps: (d1: <n>, d2: <n>)'. CCE decisions
+# start with '=== DECISION ON PARKED CAR ID <id> ===' and carry no time or neighbor depths: their times are
+# taken from 'decisionCCE.log', when present, and their neighbor count is the number of received maps.
+#
+# Run on its own, it indexes a log (or every detail log in a folder of simulations) and lists the decisions
+# that match a query:
+#   ./decisionIndex.py [log or folder] [--from t1] [--to t2] [--min-d1 n] [--id parkedCarID] [--show]
+
+import mmap
+import optparse
+import os
+import re
+import sys
+
+import numpy
+
+import cellMaps
+import statsCache
+
+# Requires Python >3.5
+assert sys.version_info >= (3,5)
+
+
+wpmDetailLog = 'decisionDetailWPM.log'
+cceDetailLog = 'decisionDetailCCE.log'
+cceDecisionLog = 'decisionCCE.log'
+indexSuffix = '.index.npz'
+
+# Indexed fields of each decision
+indexFields = ['time', 'id', 'd1', 'd2', 'combinations', 'offset', 'length']
+
+wpmDecisionPattern = re.compile(rb'^(\S+) Parked car (\d+) deciding, neighborMaps: \(d1: (\d+), d2: (\d+)\)$', re.M)
+wpmCombinationCountPattern = re.compile(rb'^Evaluating (\d+) solutions at parked car', re.M)
+wpmPanelPattern = re.compile(rb'^(Depth 2 Signal \| Saturation \| Reference maps|Signal \| Saturation \| Reference map for combination (\[.*\]))$', re.M)
+wpmScorePattern = re.compile(rb'^(Combination|Combinations ordered by score:)', re.M)
+cceDecisionPattern = re.compile(rb'^=== DECISION ON PARKED CAR ID (\d+) ===$', re.M)
+cceSectionPattern = re.compile(rb'^== (Received Maps:|Self Coverage Map|Local Map of Coverage|Local Map of Saturation|dNew .*)$', re.M)
+cellMapHeaderPattern = re.compile(rb'tlc-?\d+;-?\d+\n')
+
+# Single maps of a CCE decision: (section title, map name)
+cceMapSections = [(b'Self Coverage Map', 'self'), (b'Local Map of Coverage', 'coverage'), (b'Local Map of Saturation', 'saturation')]
+
+
+def indexFile(logFile):
+	return logFile + indexSuffix
+
+
+# Type of a detail log, by its name
+def logType(logFile):
+	if os.path.basename(logFile).startswith(cceDetailLog[:-len('.log')]):
+		return 'cce'
+	return 'wpm'
+
+
+# Byte ranges (start, end) of the matches of a decision header pattern, each decision ending where the next begins
+def decisionRanges(data, pattern):
+	matches = list(pattern.finditer(data))
+	ends = [match.start() for match in matches[1:]] + [len(data)]
+	return [(match, end) for match, end in zip(matches, ends)]
+
+
+# Scan a WPM detail log, returning a list of index fields for each decision
+def scanWPM(data):
+	decisions = []
+	for match, end in decisionRanges(data, wpmDecisionPattern):
+		# Decisions without 1-hop neighbors evaluate no combinations
+		combinationCount = wpmCombinationCountPattern.search(data, match.end(), end)
+		combinations = int(combinationCount.group(1)) if combinationCount is not None else 0
+		decisions.append([float(match.group(1)), int(match.group(2)), int(match.group(3)), int(match.group(4)), combinations, match.start(), end-match.start()])
+	return decisions
+
+
+# Scan a CCE detail log, returning a list of index fields for each decision
+def scanCCE(data, decisionTimes):
+	decisions = []
+	for match, end in decisionRanges(data, cceDecisionPattern):
+		selfMapSection = data.find(b'\n== Self Coverage Map', match.end(), end)
+		receivedMaps = len(cellMapHeaderPattern.findall(data, match.end(), selfMapSection if selfMapSection >= 0 else end))
+		decisions.append([numpy.nan, int(match.group(1)), receivedMaps, -1, 0, match.start(), end-match.start()])
+
+	# Times of each decision, from 'decisionCCE.log', written in the same order
+	if decisionTimes is not None:
+		times, ids = decisionTimes
+		if len(ids) == len(decisions) and all(decision[1] == decisionID for decision, decisionID in zip(decisions, ids)):
+			for decision, time in zip(decisions, times):
+				decision[0] = time
+	return decisions
+
+
+# Times and parked car IDs of the decisions in the 'decisionCCE.log' next to a CCE detail log, or None
+def readDecisionTimes(logFile):
+	decisionLog = os.path.join(os.path.dirname(logFile), cceDecisionLog)
+	if not os.path.isfile(decisionLog):
+		return None
+	try:
+		statsColumns = statsCache.load(decisionLog, ['time', 'id'])
+	except (OSError, ValueError):
+		return None
+	return [float(time) for time in statsColumns.column('time').tolist()], [int(decisionID) for decisionID in statsColumns.column('id').tolist()]
+
+
+# Scan a detail log and write its index, going through a temporary file so that readers never see a partial index
+def buildIndex(logFile):
+	signature = statsCache.sourceSignature(logFile)
+	with open(logFile, 'rb') as logFileHandle:
+		if signature['size'] == 0:
+			decisions = []
+		else:
+			with mmap.mmap(logFileHandle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+				decisions = scanCCE(data, readDecisionTimes(logFile)) if logType(logFile) == 'cce' else scanWPM(data)
+
+	columns = list(zip(*decisions)) if decisions else [[]]*len(indexFields)
+	arrays = {field: numpy.array(column, dtype=numpy.float64 if field == 'time' else numpy.int64) for field, column in zip(indexFields, columns)}
+	arrays['source'] = numpy.array([signature['size'], signature['mtime']], dtype=numpy.int64)
+
+	temporaryFile = "{:s}.{:d}.tmp".format(indexFile(logFile), os.getpid())
+	with open(temporaryFile, 'wb') as indexFileHandle:
+		numpy.savez(indexFileHandle, **arrays)
+	os.replace(temporaryFile, indexFile(logFile))
+	return arrays
+
+
+# Read the index of a detail log, or None if it is missing or out of date
+def readIndex(logFile):
+	try:
+		with numpy.load(indexFile(logFile)) as indexArchive:
+			arrays = {field: indexArchive[field] for field in indexFields + ['source']}
+	except (OSError, KeyError, ValueError):
+		return None
+	signature = statsCache.sourceSignature(logFile)
+	if arrays['source'].tolist() != [signature['size'], signature['mtime']]:
+		return None
+	return arrays
+
+
+# Parse a WPM panel of maps ('<signal> | <saturation> | <reference>', with zeroes and blocked cells
+# blanked) into signal and saturation digits and a map of open reference cells
+def parseWPMPanel(panel):
+	rows = [row.split(b' | ') for row in panel.split(b'\n') if row]
+	if any(len(row) != 3 for row in rows):
+		raise ValueError("Malformed map panel.")
+	maps = []
+	for panelIndex in range(3):
+		width = max(len(row[panelIndex]) for row in rows)
+		cells = numpy.array([list(row[panelIndex].ljust(width)) for row in rows], dtype=numpy.uint8).reshape(len(rows), width)
+		if panelIndex == 2:
+			maps.append(cells == ord('O'))
+		else:
+			maps.append(numpy.where(cells == ord(' '), 0, cells.astype(numpy.int16) - ord('0')).astype(numpy.int8))
+	return maps
+
+
+class Decision:
+	def __init__(self, index, position):
+		self.index = index
+		self.position = position
+		for field in indexFields:
+			setattr(self, field, index.arrays[field][position].item())
+
+	# Text of the decision, as written in the log
+	def text(self):
+		return self.index.read(self.offset, self.length).decode('utf-8')
+
+	# Maps embedded in the decision, parsed on request. For WPM decisions, a list of
+	# (combination, signal, saturation, reference) for each map panel, the depth 2
+	# panel having no combination. For CCE decisions, a dictionary with the 'received'
+	# maps and the 'self', 'coverage' and 'saturation' maps, as cellMaps.CellMap of digits
+	# (as cellMaps.readNumericCellMap returns them).
+	def maps(self):
+		data = self.index.read(self.offset, self.length)
+		if self.index.type == 'wpm':
+			panels = []
+			for match in wpmPanelPattern.finditer(data):
+				panelEnd = wpmScorePattern.search(data, match.end())
+				panelEnd = panelEnd.start() if panelEnd is not None else len(data)
+				nextPanel = wpmPanelPattern.search(data, match.end())
+				if nextPanel is not None:
+					panelEnd = min(panelEnd, nextPanel.start())
+				combination = [value == 'true' for value in match.group(2).decode()[1:-1].split(', ')] if match.group(2) else None
+				panels.append([combination] + parseWPMPanel(data[match.end():panelEnd]))
+			return panels
+
+		sections = {}
+		sectionMatches = list(cceSectionPattern.finditer(data))
+		for match, nextMatch in zip(sectionMatches, sectionMatches[1:] + [None]):
+			sections[match.group(1)] = data[match.end():nextMatch.start() if nextMatch is not None else len(data)]
+		# Received maps are written back to back, each 'tlc' header following the previous map's last row
+		receivedData = sections.get(b'Received Maps:', b'')
+		mapStarts = [match.start() for match in cellMapHeaderPattern.finditer(receivedData)]
+		maps = {'received': [cellMaps.numericCellMap(cellMaps.parseCellMap(receivedData[start:end]), 'a received map') for start, end in zip(mapStarts, mapStarts[1:] + [len(receivedData)])]}
+		for sectionName, mapName in cceMapSections:
+			if sectionName in sections:
+				maps[mapName] = cellMaps.numericCellMap(cellMaps.parseCellMap(sections[sectionName].strip(b'\n')), 'the {:s} map'.format(mapName))
+		return maps
+
+
+class DecisionIndex:
+	def __init__(self, logFile, rebuild=False):
+		self.logFile = logFile
+		self.type = logType(logFile)
+		self.arrays = None if rebuild else readIndex(logFile)
+		self.built = self.arrays is None
+		if self.arrays is None:
+			self.arrays = buildIndex(logFile)
+		self.logHandle = None
+		self.positionsByID = None
+
+	def __len__(self):
+		return len(self.arrays['offset'])
+
+	# Bytes of the log, memory-mapped on first use
+	def read(self, offset, length):
+		if self.logHandle is None:
+			self.logHandle = open(self.logFile, 'rb')
+			self.data = mmap.mmap(self.logHandle.fileno(), 0, access=mmap.ACCESS_READ)
+		return self.data[offset:offset+length]
+
+	def close(self):
+		if self.logHandle is not None:
+			self.data.close()
+			self.logHandle.close()
+			self.logHandle = None
+
+	def decision(self, position):
+		return Decision(self, position)
+
+	# Decisions of a parked car (usually one)
+	def decisionsOf(self, parkedCarID):
+		if self.positionsByID is None:
+			self.positionsByID = {}
+			for position, decisionID in enumerate(self.arrays['id'].tolist()):
+				self.positionsByID.setdefault(decisionID, []).append(position)
+		return [self.decision(position) for position in self.positionsByID.get(parkedCarID, [])]
+
+	# Decisions between two times (inclusive) with at least the given neighbor and combination counts
+	def query(self, startTime=None, endTime=None, minD1=None, minD2=None, minCombinations=None):
+		selected = numpy.ones(len(self), dtype=bool)
+		if startTime is not None:
+			selected &= self.arrays['time'] >= startTime
+		if endTime is not None:
+			selected &= self.arrays['time'] <= endTime
+		for field, minimum in [('d1', minD1), ('d2', minD2), ('combinations', minCombinations)]:
+			if minimum is not None:
+				selected &= self.arrays[field] >= minimum
+		return [self.decision(position) for position in numpy.flatnonzero(selected).tolist()]
+
+
+# Find every decision detail log in a folder of simulations
+def findDetailLogs(simDir):
+	logFiles = []
+	for dirpath, dirnames, filenames in os.walk(simDir):
+		dirnames[:] = [dirname for dirname in dirnames if not dirname.endswith(statsCache.columnsSuffix)]
+		logFiles += [os.path.join(dirpath, file) for file in sorted(filenames) if file in [wpmDetailLog, cceDetailLog]]
+	return logFiles
+
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage="%prog [decision detail log, or folder with simulations]")
+	parser.add_option("--from", dest="startTime", type="float", default=None, help="decisions at or after this time", metavar="TIME")
+	parser.add_option("--to", dest="endTime", type="float", default=None, help="decisions at or before this time", metavar="TIME")
+	parser.add_option("--min-d1", dest="minD1", type="int", default=None, help="decisions with at least N 1-hop neighbors (received maps, for CCE)", metavar="N")
+	parser.add_option("--min-d2", dest="minD2", type="int", default=None, help="decisions with at least N 2-hop neighbors", metavar="N")
+	parser.add_option("--id", dest="parkedCarID", type="int", default=None, help="decisions of a parked car", metavar="ID")
+	parser.add_option("--show", dest="show", action="store_true", default=False, help="print the matching decisions in full")
+	parser.add_option("--rebuild", dest="rebuild", action="store_true", default=False, help="rebuild indexes even if up to date")
+	(options, args) = parser.parse_args()
+
+	if len(args) != 1:
+		parser.print_usage()
+		sys.exit(1)
+
+	if os.path.isdir(args[0]):
+		logFiles = findDetailLogs(args[0])
+	elif os.path.isfile(args[0]):
+		logFiles = [args[0]]
+	else:
+		print("Error: Log or simulations folder not present.")
+		sys.exit(1)
+
+	if len(logFiles) == 0:
+		print("Error: No decision detail logs found.")
+		sys.exit(1)
+
+	listDecisions = options.show or any(option is not None for option in [options.startTime, options.endTime, options.minD1, options.minD2, options.parkedCarID])
+	for logFile in logFiles:
+		index = DecisionIndex(logFile, options.rebuild)
+		if index.built:
+			print("Indexed {:s} ({:d} decisions)".format(logFile, len(index)), file=sys.stderr)
+		if not listDecisions:
+			continue
+
+		decisions = index.query(options.startTime, options.endTime, options.minD1, options.minD2)
+		if options.parkedCarID is not None:
+			decisions = [decision for decision in decisions if decision.id == options.parkedCarID]
+		for decision in decisions:
+			if options.show:
+				print(decision.text().rstrip("\n"))
+			else:
+				print("\t".join([logFile, repr(decision.time), str(decision.id), str(decision.d1), str(decision.d2), str(decision.combinations)]))
+		index.close()
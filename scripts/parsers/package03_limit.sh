@@ -75,6 +75,13 @@ fi
 mkdir -p ${PACKAGEDIR}
 
 
+# Compute the data for every parser in a single pass over the statistics logs
+# The parsers fall back to the swift interpreter if this fails
+printf "\n### Running ${SCRIPTDIR}/analyzeStatistics.py\n" >> ${LOGFILE}
+if python3 ${SCRIPTDIR}/analyzeStatistics.py ${SIMDIR} ${PACKAGEDIR}/data >> ${LOGFILE} 2>&1; then
+	export STATSDATADIR=${PACKAGEDIR}/data
+fi
+
 # Run this package's parsers
 printf "Running parsers..."
 for PARSER in "${PARSERS[@]}"
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# This script replays the decisions of WeightedProductModel from the 'decisionDetailWPM' logs of a folder
+# of simulations, re-scoring them under a grid of weights without simulating again. Each decision is
+# replayed on its own, with the same neighborhood, so this shows the first-order effect of the weights:
+# later decisions depend on earlier ones, and would change in a full simulation.
+#
+# The detail log holds, for each combination evaluated by a decision, the signal, saturation and reference
+# maps after applying it (see WeightedProductModel.decide()). asig, asat and acov are computed again from
+# these, for all combinations at once; acov's reference cell count comes from the saturation added by the
+# all-on combination over the depth 2 maps. abat can't be recomputed (neighbor active times aren't logged),
+# so the logged value (2 decimals) is used. Saturation maps must have single-digit cells.
+#
+# Replays at the simulations' own weights are checked against 'decisionWPM.log'.
+# usage: ./replayWPM.py [folder with simulations] [--wsig 1] [--wsat 0.4,0.3,0.2] [--wcov ...] [--wbat ...] [--threshold ...]
+
+import itertools
+import multiprocessing
+import optparse
+import os
+import plistlib
+import re
+import sys
+
+import numpy
+
+import decisionIndex
+import statsCache
+
+# Requires Python >3.5
+assert sys.version_info >= (3,5)
+
+
+# Weights, in the order they are kept in arrays
+weightNames = ['wsig', 'wsat', 'wcov', 'wbat']
+
+decisionLog = 'decisionWPM.log'
+combinationScorePattern = re.compile(rb'^Combination \[.*\] asig (\S+) asat (\S+) acov (\S+) abat (\S+) wpm (\S+)$', re.M)
+
+
+# Combinations evaluated with a set of 'setSize' maps (ourselves first), in the order of WeightedProductModel.decide():
+# all enabled, then each single map disabled, then each pair of maps disabled
+def buildCombinations(setSize):
+	combinations = [[True]*setSize]
+	for cIndex in range(setSize):
+		combinations.append([cIndex != index for index in range(setSize)])
+	for cIndex, cIndexNext in itertools.combinations(range(setSize), 2):
+		combinations.append([index not in (cIndex, cIndexNext) for index in range(setSize)])
+	return numpy.array(combinations, dtype=bool)
+
+
+# Parameters of WeightedProductModel in a simulation's configuration
+def readAlgorithmConfig(configFile):
+	with open(configFile, 'rb') as configFileHandle:
+		configDict = plistlib.load(configFileHandle, fmt=plistlib.FMT_XML)
+	return configDict['decision']['algorithm']['WeightedProductModel']
+
+
+# Mean of the cells of each map in a stack (combination, row, column) selected by a mask of the same shape; NaN if none
+def maskedMeans(maps, mask):
+	counts = mask.sum(axis=(1,2))
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		return numpy.where(mask, maps, 0).sum(axis=(1,2))/counts
+
+
+class DecisionInputs:
+	def __init__(self, time, parkedCarID, combinations, attributes, loggedAttributes):
+		self.time = time
+		self.id = parkedCarID
+		# Combinations evaluated (combination, map), and asig, asat, acov and abat of each (combination, attribute)
+		self.combinations = combinations
+		self.attributes = attributes
+		# Attributes and score as logged (2 decimals), for checking
+		self.loggedAttributes = loggedAttributes
+
+
+# Recompute the attributes of every combination of a decision from its map panels
+def decisionInputs(decision, minRedundancy):
+	panels = decision.maps()
+	depth2Panels = [panel for panel in panels if panel[0] is None]
+	combinationPanels = [panel for panel in panels if panel[0] is not None]
+
+	combinations = buildCombinations(decision.d1+1)
+	if len(combinationPanels) != len(combinations) or any(panel[0] != combination for panel, combination in zip(combinationPanels, combinations.tolist())):
+		raise ValueError("Combinations of parked car {:d} don't match its neighborhood.".format(decision.id))
+	if any(len(set(cellMap.shape for cellMap in panel[1:])) != 1 for panel in panels):
+		raise ValueError("Maps of parked car {:d} have cells wider than one digit.".format(decision.id))
+
+	signal = numpy.array([panel[1] for panel in combinationPanels], dtype=numpy.float64)
+	saturation = numpy.array([panel[2] for panel in combinationPanels], dtype=numpy.float64)
+	reference = combinationPanels[0][3]
+
+	# Measurements on the cells the deciding car covers, ignoring empty cells
+	asig = maskedMeans(signal, reference & (signal != 0))
+	satMean = maskedMeans(saturation, reference & (saturation != 0))
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		asat = numpy.where(satMean < minRedundancy, 1.0/minRedundancy, 1.0/satMean)
+
+	# Cells covered by ourselves and depth 1 neighbors, where the all-on combination adds saturation to depth 2 maps
+	depth2Saturation = depth2Panels[0][2] if depth2Panels else numpy.zeros(reference.shape, dtype=numpy.int8)
+	baseCoveredCells = numpy.count_nonzero(saturation[0] > depth2Saturation)
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		acov = numpy.count_nonzero(signal, axis=(1,2))/numpy.float64(baseCoveredCells)
+
+	data = decision.text().encode()
+	loggedAttributes = numpy.array([[float(value) for value in match.groups()] for match in combinationScorePattern.finditer(data)], dtype=numpy.float64)
+	if len(loggedAttributes) != len(combinations):
+		raise ValueError("Scores of parked car {:d} are incomplete.".format(decision.id))
+
+	attributes = numpy.column_stack([asig, asat, acov, loggedAttributes[:,3]])
+	return DecisionInputs(decision.time, decision.id, combinations, attributes, loggedAttributes)
+
+
+# Read the inputs of every decision in a detail log (in a worker process). Returns the decisions
+# with 1-hop neighbors, the number of decisions without them, and the number that couldn't be read.
+def readDecisions(logJob):
+	logFile, minRedundancy = logJob
+	index = decisionIndex.DecisionIndex(logFile)
+	decisions = []
+	directDecisions = 0
+	unreadable = 0
+	for position in range(len(index)):
+		decision = index.decision(position)
+		if decision.d1 == 0:
+			directDecisions += 1
+			continue
+		try:
+			decisions.append(decisionInputs(decision, minRedundancy))
+		except ValueError:
+			unreadable += 1
+	index.close()
+	return decisions, directDecisions, unreadable
+
+
+# WPM scores of every combination under every weight vector (weight vector, combination)
+def scoreCombinations(attributes, weights):
+	with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+		scores = numpy.prod(numpy.power(attributes[numpy.newaxis,:,:], weights[:,numpy.newaxis,:]), axis=2)
+	# Possible scoring failures are scored zero
+	scores[numpy.isnan(scores)] = 0.0
+	return scores
+
+
+# Decision under every weight vector and threshold, as in WeightedProductModel.decide(): the best combination,
+# whether it passed the disable threshold, and whether the parked car becomes an RSU
+def decide(scores, thresholds, combinations):
+	best = numpy.argmax(scores, axis=1)
+	bestScores = scores[numpy.arange(len(scores)), best]
+	# The no-action combination disables ourselves only; a best score of zero removes the parked car
+	noActionScores = scores[:,1]
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		passThreshold = (bestScores > 0) & (best != 1) & ((bestScores-noActionScores)/noActionScores > thresholds)
+	becomesRSU = passThreshold & combinations[best,0]
+	return best, bestScores, passThreshold, becomesRSU
+
+
+# Check replays at the original weights against the decisions logged in 'decisionWPM.log'.
+# Returns the number of decisions checked, mismatches, and mismatches explained by tied scores.
+def checkDecisions(decisions, originalWeights, threshold, logFile):
+	decisionLogFile = os.path.join(os.path.dirname(logFile), decisionLog)
+	if not os.path.isfile(decisionLogFile):
+		return 0, 0, 0
+	statsColumns = statsCache.load(decisionLogFile, ['id', 'wpm', 'disabled', 'disableSelf', 'passDisableThreshold'])
+	loggedDecisions = {}
+	for row in zip(*[statsColumns.column(column).tolist() for column in ['id', 'wpm', 'disabled', 'disableSelf', 'passDisableThreshold']]):
+		loggedDecisions[int(row[0])] = (float(row[1]), int(row[2]), str(row[3]) == 'true', str(row[4]) == 'true')
+
+	checked = mismatches = ties = 0
+	for decision in decisions:
+		if decision.id not in loggedDecisions:
+			continue
+		scores = scoreCombinations(decision.attributes, originalWeights[numpy.newaxis,:])
+		best, bestScores, passThreshold, _ = decide(scores, threshold, decision.combinations)
+		combination = decision.combinations[best[0]]
+		disableSelf = not (passThreshold[0] and combination[0])
+		replayed = (bestScores[0], int(numpy.count_nonzero(~combination)), disableSelf, bool(passThreshold[0]))
+
+		wpm, disabled, loggedDisableSelf, loggedPass = loggedDecisions[decision.id]
+		checked += 1
+		# Recomputed attributes must round to the logged ones, and the best score must match to full precision
+		if not numpy.isclose(decision.attributes[:,:3], decision.loggedAttributes[:,:3], rtol=0, atol=0.0051, equal_nan=True).all():
+			mismatches += 1
+		elif not numpy.isclose(replayed[0], wpm, rtol=1e-9, atol=1e-12):
+			mismatches += 1
+		elif replayed[1:] != (disabled, loggedDisableSelf, loggedPass):
+			# Swift's sort isn't stable, so tied combinations may be picked in any order
+			if numpy.count_nonzero(scores[0] == bestScores[0]) > 1:
+				ties += 1
+			else:
+				mismatches += 1
+	return checked, mismatches, ties
+
+
+# Values of a weight option: a list, or the original value if not given
+def parseValues(option, originalValue):
+	if option is None:
+		return [float(originalValue)]
+	return [float(value) for value in option.split(',') if value]
+
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage="%prog [folder with simulations]")
+	for weightName in weightNames:
+		parser.add_option("--" + weightName, dest=weightName, default=None, help="values of " + weightName + " to replay (default: the simulations' own)", metavar="LIST")
+	parser.add_option("--threshold", dest="threshold", default=None, help="values of disableThreshold to replay (default: the simulations' own)", metavar="LIST")
+	parser.add_option("-c", "--config", dest="configFile", default=None, help="configuration the simulations ran with (default: each simulation's config.plist)", metavar="FILE")
+	parser.add_option("-o", "--output", dest="outputFile", default=None, help="write the winning combination of every decision under every weight vector to FILE", metavar="FILE")
+	parser.add_option("-p", "--processes", dest="processes", type="int", default=None, help="number of processes reading logs (default: one per core)", metavar="N")
+	(options, args) = parser.parse_args()
+
+	if len(args) != 1:
+		parser.print_usage()
+		sys.exit(1)
+	simDir = args[0]
+
+	if not os.path.isdir(simDir):
+		print("Error: Simulations folder not present.")
+		sys.exit(1)
+
+	logFiles = [logFile for logFile in decisionIndex.findDetailLogs(simDir) if os.path.basename(logFile) == decisionIndex.wpmDetailLog]
+	if len(logFiles) == 0:
+		print("Error: No decisionDetailWPM logs found.")
+		sys.exit(1)
+
+	# Original parameters, which must be the same across simulations
+	try:
+		configFiles = [options.configFile] if options.configFile is not None else [os.path.join(os.path.dirname(os.path.dirname(logFile)), 'config.plist') for logFile in logFiles]
+		algorithmConfigs = [readAlgorithmConfig(configFile) for configFile in configFiles]
+	except (OSError, KeyError) as error:
+		print("Error: Can't read the WeightedProductModel configuration:", error)
+		sys.exit(1)
+	originalParameters = [tuple(float(algorithmConfig[name]) for name in weightNames + ['disableThreshold', 'minRedundancy']) for algorithmConfig in algorithmConfigs]
+	if len(set(originalParameters)) != 1:
+		print("Error: Simulations ran with different WeightedProductModel parameters.")
+		sys.exit(1)
+	originalWeights = numpy.array(originalParameters[0][:4])
+	originalThreshold, minRedundancy = originalParameters[0][4:]
+
+	try:
+		weightValues = [parseValues(getattr(options, weightName), originalWeight) for weightName, originalWeight in zip(weightNames, originalWeights)]
+		thresholdValues = parseValues(options.threshold, originalThreshold)
+	except ValueError as error:
+		print("Error: Can't interpret weights:", error)
+		sys.exit(1)
+	grid = list(itertools.product(*(weightValues + [thresholdValues])))
+	gridWeights = numpy.array([point[:4] for point in grid])
+	gridThresholds = numpy.array([point[4] for point in grid])
+
+	if originalWeights[3] == 0 and any(value != 0 for value in weightValues[3]):
+		print("Warning: abat was not computed in these simulations (wbat = 0), replaying with abat = 1.", file=sys.stderr)
+
+	# Read every log once
+	with multiprocessing.Pool(options.processes) as pool:
+		readLogs = pool.map(readDecisions, [(logFile, minRedundancy) for logFile in logFiles], chunksize=1)
+
+	checked = mismatches = ties = unreadable = directDecisions = 0
+	for logFile, (decisions, logDirectDecisions, logUnreadable) in zip(logFiles, readLogs):
+		logChecked, logMismatches, logTies = checkDecisions(decisions, originalWeights, originalThreshold, logFile)
+		checked += logChecked
+		mismatches += logMismatches
+		ties += logTies
+		unreadable += logUnreadable
+		directDecisions += logDirectDecisions
+	print("Replayed {:d} decisions ({:d} without 1-hop neighbors, {:d} unreadable); at the original weights, {:d} of {:d} logged decisions match ({:d} ties, {:d} mismatches).".format(sum(len(decisions) for decisions, _, _ in readLogs), directDecisions, unreadable, checked-mismatches, checked, ties, mismatches), file=sys.stderr)
+
+	# Score every decision under the whole grid
+	becameRSU = numpy.zeros(len(grid), dtype=numpy.int64)
+	disabledRSUs = numpy.zeros(len(grid), dtype=numpy.int64)
+	changed = numpy.zeros(len(grid), dtype=numpy.int64)
+	outputHandle = open(options.outputFile, 'w') if options.outputFile is not None else None
+	if outputHandle is not None:
+		outputHandle.write("\t".join(weightNames + ['threshold', 'log', 'time', 'id', 'combination', 'rsu']) + "\n")
+
+	for logFile, (decisions, _, _) in zip(logFiles, readLogs):
+		for decision in decisions:
+			best, _, passThreshold, becomesRSU = decide(scoreCombinations(decision.attributes, gridWeights), gridThresholds, decision.combinations)
+			originalBest, _, originalPass, originalRSU = decide(scoreCombinations(decision.attributes, originalWeights[numpy.newaxis,:]), originalThreshold, decision.combinations)
+
+			becameRSU += becomesRSU
+			# RSUs (other than ourselves) disabled by the chosen combination
+			disabledRSUs += numpy.where(passThreshold, numpy.count_nonzero(~decision.combinations[best][:,1:], axis=1), 0)
+			changed += (best != originalBest[0]) | (becomesRSU != originalRSU[0])
+
+			if outputHandle is not None:
+				for point, combinationIndex, rsu in zip(grid, best.tolist(), becomesRSU.tolist()):
+					combination = ''.join('1' if enabled else '0' for enabled in decision.combinations[combinationIndex])
+					outputHandle.write("\t".join([repr(value) for value in point] + [logFile, repr(decision.time), str(decision.id), combination, str(rsu).lower()]) + "\n")
+	if outputHandle is not None:
+		outputHandle.close()
+
+	# Decisions without 1-hop neighbors always become RSUs
+	print("\t".join(weightNames + ['threshold', 'newRSUs', 'disabledRSUs', 'changedDecisions']))
+	for point, rsus, disabled, changes in zip(grid, becameRSU.tolist(), disabledRSUs.tolist(), changed.tolist()):
+		print("\t".join([repr(value) for value in point] + [str(rsus+directDecisions), str(disabled), str(changes)]))
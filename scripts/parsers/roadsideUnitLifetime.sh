@@ -41,8 +41,8 @@ for SIMULATIONLOG in $(find ${SIMDIR} -maxdepth 3 -type f -name 'parkedRoadsideU
 	printf "${SIMULATIONLOG}\n" >> statfilelist
 done
 
-# Call swift interpreter
-swift $(dirname $0)/aggregateColumnForHistogram.swift statfilelist lifetime ${STARTATTIME} removed > ${VISDIR}/${VISNAME}.data
+# Aggregate the lifetimes in fixed memory
+python3 $(dirname $0)/streamingAggregate.py histogram statfilelist lifetime ${STARTATTIME} removed > ${VISDIR}/${VISNAME}.data
 rm -rf statfilelist
 
 # Copy over gnuplot scaffold script
@@ -11,7 +11,7 @@ fi
 for SIMSET in $(find simulationsets -depth 1 -type d -name 'simulations*'); do
 	find ${SIMSET} -type f -name 'entityCount.log' > statfilelist
 	printf "${SIMSET}\n"
-	swift $(dirname $0)/averageColumn.swift statfilelist roadsideUnits ${STARTATTIME}
+	python3 $(dirname $0)/../streamingAggregate.py average statfilelist roadsideUnits ${STARTATTIME}
 	printf "\n"
 done
 rm statfilelist
\ No newline at end of file
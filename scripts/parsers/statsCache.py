@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# This module keeps a columnar copy of statistics logs, so that repeated analyses don't re-parse TSV text.
+# Each '<log>' gets a '<log>.columns/' folder next to it, with one memory-mappable '.npy' file per column
+# and a 'schema.json' holding the column names and types (from the header line) and the size and
+# modification time of the log it was built from. A log that changes is converted again.
+#
+# Run on its own, it converts every statistics log in a folder of simulations:
+# usage: ./statsCache.py [folder with simulations]
+
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy
+
+# Requires Python >3.5
+assert sys.version_info >= (3,5)
+
+
+columnsSuffix = '.columns'
+schemaFile = 'schema.json'
+
+
+def columnsDirectory(logFile):
+	return logFile + columnsSuffix
+
+
+def columnFile(directory, columnIndex):
+	return os.path.join(directory, "{:d}.npy".format(columnIndex))
+
+
+# Read a statistics log as text, returning its column names and the tab-separated fields of each line
+def readStatsLog(logFile):
+	with open(logFile, 'r') as logFileHandle:
+		lines = [line for line in logFileHandle.read().splitlines() if line]
+	if len(lines) == 0:
+		return [], []
+	header = [column for column in lines[0].split('\t') if column]
+	return header, [[field for field in line.split('\t') if field] for line in lines[1:]]
+
+
+# Convert a column of text fields to integers, reals or, failing both, strings
+def convertColumn(fields):
+	try:
+		return numpy.array([int(field) for field in fields], dtype=numpy.int64)
+	except (ValueError, OverflowError):
+		pass
+	try:
+		return numpy.array([float(field) for field in fields], dtype=numpy.float64)
+	except ValueError:
+		pass
+	return numpy.array(fields, dtype=numpy.str_)
+
+
+# Parse a statistics log as text, returning its column names and an array for each column
+def parseStatsLog(logFile):
+	header, rows = readStatsLog(logFile)
+	for lineNumber, row in enumerate(rows):
+		if len(row) != len(header):
+			raise ValueError("Line {:d} of {:s} has {:d} fields, expected {:d}.".format(lineNumber+2, logFile, len(row), len(header)))
+	return header, [convertColumn([row[columnIndex] for row in rows]) for columnIndex in range(len(header))]
+
+
+def sourceSignature(logFile):
+	logStat = os.stat(logFile)
+	return {'size': logStat.st_size, 'mtime': logStat.st_mtime_ns}
+
+
+# Write the columns of a log, going through a temporary folder so that readers never see a partial conversion
+def writeColumns(logFile, signature, header, columns):
+	directory = columnsDirectory(logFile)
+	temporaryDirectory = "{:s}.{:d}.tmp".format(directory, os.getpid())
+	shutil.rmtree(temporaryDirectory, ignore_errors=True)
+	os.makedirs(temporaryDirectory)
+	for columnIndex, column in enumerate(columns):
+		numpy.save(columnFile(temporaryDirectory, columnIndex), column)
+	with open(os.path.join(temporaryDirectory, schemaFile), 'w') as schemaFileHandle:
+		json.dump({'source': signature, 'columns': header, 'types': [column.dtype.str for column in columns]}, schemaFileHandle)
+
+	shutil.rmtree(directory, ignore_errors=True)
+	try:
+		os.rename(temporaryDirectory, directory)
+	except OSError:
+		# Another process got there first
+		shutil.rmtree(temporaryDirectory, ignore_errors=True)
+
+
+# Read the schema of a log's columns, or None if they are missing or out of date
+def readSchema(logFile):
+	try:
+		with open(os.path.join(columnsDirectory(logFile), schemaFile), 'r') as schemaFileHandle:
+			schema = json.load(schemaFileHandle)
+	except (OSError, ValueError):
+		return None
+	if schema.get('source') != sourceSignature(logFile):
+		return None
+	return schema
+
+
+class StatsColumns:
+	def __init__(self, header, columns, source, columnBytes, parseTime):
+		self.header = header
+		self.columns = columns
+		# How the columns were obtained: 'cached', 'converted' or 'text'
+		self.source = source
+		# Bytes read for each loaded column (the whole log, for each column, when parsed as text)
+		self.columnBytes = columnBytes
+		self.parseTime = parseTime
+
+	# Array of a column, by name
+	def column(self, columnName):
+		if columnName not in self.header:
+			raise ValueError("Can't match column '{:s}'.".format(columnName))
+		return self.columns[self.header.index(columnName)]
+
+	def bytesRead(self, columnNames=None):
+		return readBytes(self.columnBytes, self.source, columnNames)
+
+
+# Bytes read to load a set of columns (all loaded columns by default): the whole log,
+# if it was parsed as text, or the size of each column's file otherwise
+def readBytes(columnBytes, source, columnNames=None):
+	if source != 'cached':
+		return max(columnBytes.values(), default=0)
+	return sum(columnBytes[columnName] for columnName in (columnBytes.keys() if columnNames is None else columnNames))
+
+
+# Load the columns of a statistics log, converting (or reconverting) it if needed.
+# Only the requested columns are loaded, all of them by default. With 'useCache'
+# unset, the log is parsed as text and nothing is written.
+def load(logFile, columnNames=None, useCache=True):
+	startTime = time.time()
+
+	schema = readSchema(logFile) if useCache else None
+	if schema is not None:
+		header = schema['columns']
+		wantedColumns = header if columnNames is None else columnNames
+		columns = [None]*len(header)
+		columnBytes = {}
+		try:
+			for columnName in wantedColumns:
+				if columnName not in header:
+					raise ValueError("Can't match column '{:s}' in {:s}.".format(columnName, logFile))
+				columnIndex = header.index(columnName)
+				columnPath = columnFile(columnsDirectory(logFile), columnIndex)
+				columns[columnIndex] = numpy.load(columnPath, mmap_mode='r')
+				columnBytes[columnName] = os.path.getsize(columnPath)
+			return StatsColumns(header, columns, 'cached', columnBytes, time.time()-startTime)
+		except OSError:
+			# Broken conversion, redo it
+			pass
+
+	signature = sourceSignature(logFile)
+	header, columns = parseStatsLog(logFile)
+	source = 'text'
+	if useCache:
+		try:
+			writeColumns(logFile, signature, header, columns)
+			source = 'converted'
+		except OSError as error:
+			print("Warning: Could not write columns of {:s}: {:s}".format(logFile, str(error)), file=sys.stderr)
+	return StatsColumns(header, columns, source, {columnName: signature['size'] for columnName in header}, time.time()-startTime)
+
+
+# Find every statistics log in a folder of simulations ('<simulation>/stats/*.log')
+def findStatsLogs(simDir):
+	logFiles = []
+	for dirpath, dirnames, filenames in os.walk(simDir):
+		dirnames[:] = [dirname for dirname in dirnames if not dirname.endswith(columnsSuffix)]
+		logFiles += [os.path.join(dirpath, file) for file in filenames if file.endswith('.log') and os.path.basename(dirpath) == 'stats']
+	return logFiles
+
+
+if __name__ == "__main__":
+	if len(sys.argv) != 2 or not os.path.isdir(sys.argv[1]):
+		print("usage: {:s} [folder with simulations]".format(sys.argv[0]))
+		sys.exit(1)
+
+	convertedLogs = 0
+	for logFile in findStatsLogs(sys.argv[1]):
+		if readSchema(logFile) is not None:
+			continue
+		try:
+			statsColumns = load(logFile)
+		except ValueError as error:
+			print("Warning: Skipping {:s}: {:s}".format(logFile, str(error)))
+			continue
+		convertedLogs += 1
+		print("Converted {:s} ({:d} columns, {:.0f} kB, {:.3f}s)".format(logFile, len(statsColumns.header), statsColumns.bytesRead()/1024, statsColumns.parseTime))
+	print("Converted {:d} logs.".format(convertedLogs))
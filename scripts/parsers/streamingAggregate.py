@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# This module aggregates columns of statistical data files in fixed memory, streaming the files instead of
+# collecting every value. Each column keeps a running mean and variance (Welford), a fixed-width histogram
+# and an approximate quantile sketch, all of which can be merged, so files can be aggregated in parallel.
+#
+# The command line replaces 'aggregateColumnForHistogram.swift' and 'singles/averageColumn.swift', with
+# the same arguments and output formats:
+#   ./streamingAggregate.py histogram [list of data files] [column name or number] [minimum time] [time column name or number]
+#   ./streamingAggregate.py average [list of data files] [column name or number] [minimum time]
+#   ./streamingAggregate.py summary [list of data files] [column name or number] [more columns...]
+# With --partial, the aggregated state is saved to a file instead; with --merge, the arguments after the
+# mode are saved states to merge, in place of a list of data files.
+#
+# Sums are kept exactly, as the non-overlapping partials of math.fsum, so they don't depend on how files
+# are split among workers or merged, and are rounded once. averageColumn.swift adds values one by one,
+# rounding each time, so its mean can differ from this (correctly rounded) one by up to about n*2.2e-16
+# of the mean of n positive values; columns of integers summing below 2**53 give identical means.
+
+import json
+import math
+import multiprocessing
+import optparse
+import sys
+
+import numpy
+
+import statsCache
+
+# Requires Python >3.5
+assert sys.version_info >= (3,5)
+
+
+# Values are streamed through in chunks of this size
+chunkSize = 1<<16
+
+# Histogram bins, as in aggregateColumnForHistogram.swift
+defaultBinWidth = 80
+defaultBinStart = 0
+# Values past the last bin are counted in it
+defaultMaxBins = 1<<16
+
+# Quantile sketch relative accuracy and size
+defaultRelativeAccuracy = 0.01
+defaultMaxBuckets = 2048
+
+
+# Add a value to an exact sum, kept as a list of non-overlapping partials (Shewchuk's algorithm, as in
+# math.fsum); math.fsum(partials) rounds it. Non-finite values are left to the caller.
+def addToPartials(partials, value):
+	partialCount = 0
+	for partial in partials:
+		if abs(value) < abs(partial):
+			value, partial = partial, value
+		high = value + partial
+		low = partial - (high - value)
+		if low:
+			partials[partialCount] = low
+			partialCount += 1
+		value = high
+	partials[partialCount:] = [value]
+
+
+# Count, sum, mean, variance, min and max of a stream of values
+class RunningMoments:
+	def __init__(self):
+		self.count = 0
+		# Exact sum of the finite values, as partials, and the (plain) sum of the others
+		self.partials = []
+		self.nonFiniteSum = 0.0
+		# Welford's running mean and sum of squared differences
+		self.runningMean = 0.0
+		self.m2 = 0.0
+		self.min = math.inf
+		self.max = -math.inf
+
+	def addArray(self, values):
+		if len(values) == 0:
+			return
+		for value in values.tolist():
+			if math.isfinite(value):
+				addToPartials(self.partials, value)
+			else:
+				self.nonFiniteSum += value
+		self.combine(len(values), float(values.mean()), float(((values-values.mean())**2).sum()), float(values.min()), float(values.max()))
+
+	# Combine with the moments of another set of values (Chan et al.)
+	def combine(self, count, mean, m2, minValue, maxValue):
+		totalCount = self.count + count
+		delta = mean - self.runningMean
+		self.runningMean += delta*count/totalCount
+		self.m2 += m2 + delta*delta*self.count*count/totalCount
+		self.count = totalCount
+		self.min = min(self.min, minValue)
+		self.max = max(self.max, maxValue)
+
+	def merge(self, other):
+		if other.count > 0:
+			for partial in other.partials:
+				addToPartials(self.partials, partial)
+			self.nonFiniteSum += other.nonFiniteSum
+			self.combine(other.count, other.runningMean, other.m2, other.min, other.max)
+
+	def sum(self):
+		return math.fsum(self.partials) + self.nonFiniteSum
+
+	def mean(self):
+		return self.sum()/self.count if self.count > 0 else math.nan
+
+	# Maximum likelihood estimator (over N), as in the Swift parsers
+	def variance(self):
+		return self.m2/self.count if self.count > 0 else math.nan
+
+	def stdev(self):
+		return math.sqrt(self.variance())
+
+
+# Histogram with bins of a fixed width, starting at 'binStart'. Values before the first bin
+# are counted in it, and values past 'maxBins' bins are counted in the last one.
+class FixedHistogram:
+	def __init__(self, binWidth=defaultBinWidth, binStart=defaultBinStart, maxBins=defaultMaxBins):
+		self.binWidth = binWidth
+		self.binStart = binStart
+		self.maxBins = maxBins
+		self.counts = numpy.zeros(0, dtype=numpy.int64)
+
+	def addArray(self, values):
+		if len(values) == 0:
+			return
+		binIndexes = numpy.clip(numpy.floor((values-self.binStart)/self.binWidth), 0, self.maxBins-1).astype(numpy.int64)
+		self.addCounts(numpy.bincount(binIndexes))
+
+	def merge(self, other):
+		if (other.binWidth, other.binStart, other.maxBins) != (self.binWidth, self.binStart, self.maxBins):
+			raise ValueError("Can't merge histograms with different bins.")
+		self.addCounts(other.counts)
+
+	def addCounts(self, counts):
+		if len(counts) > len(self.counts):
+			self.counts = numpy.concatenate([self.counts, numpy.zeros(len(counts)-len(self.counts), dtype=numpy.int64)])
+		self.counts[:len(counts)] += counts
+
+	# (bin center, count) of every non-empty bin
+	def bins(self):
+		return [(self.binStart + binIndex*self.binWidth + self.binWidth/2, int(self.counts[binIndex])) for binIndex in numpy.flatnonzero(self.counts)]
+
+
+# Approximate quantiles with a bounded relative error, in the manner of DDSketch: values are counted in
+# logarithmically sized buckets, so any quantile is within 'relativeAccuracy' of the true value.
+# Past 'maxBuckets', the buckets nearest zero are collapsed together.
+class QuantileSketch:
+	def __init__(self, relativeAccuracy=defaultRelativeAccuracy, maxBuckets=defaultMaxBuckets):
+		self.relativeAccuracy = relativeAccuracy
+		self.maxBuckets = maxBuckets
+		self.gamma = (1+relativeAccuracy)/(1-relativeAccuracy)
+		self.logGamma = math.log(self.gamma)
+		# Bucket counts of positive values and of (the magnitude of) negative values
+		self.positiveBuckets = {}
+		self.negativeBuckets = {}
+		self.zeroCount = 0
+		self.count = 0
+		self.min = math.inf
+		self.max = -math.inf
+
+	def addBuckets(self, buckets, magnitudes):
+		bucketIndexes, bucketCounts = numpy.unique(numpy.ceil(numpy.log(magnitudes)/self.logGamma).astype(numpy.int64), return_counts=True)
+		for bucketIndex, bucketCount in zip(bucketIndexes.tolist(), bucketCounts.tolist()):
+			buckets[bucketIndex] = buckets.get(bucketIndex, 0) + bucketCount
+		self.collapse(buckets)
+
+	def collapse(self, buckets):
+		if len(buckets) <= self.maxBuckets:
+			return
+		bucketIndexes = sorted(buckets)
+		collapsedCount = sum(buckets.pop(bucketIndex) for bucketIndex in bucketIndexes[:len(bucketIndexes)-self.maxBuckets+1])
+		lowestIndex = bucketIndexes[len(bucketIndexes)-self.maxBuckets+1]
+		buckets[lowestIndex] += collapsedCount
+
+	def addArray(self, values):
+		if len(values) == 0:
+			return
+		tiny = numpy.finfo(numpy.float64).tiny
+		self.addBuckets(self.positiveBuckets, values[values > tiny])
+		self.addBuckets(self.negativeBuckets, -values[values < -tiny])
+		self.zeroCount += int(numpy.count_nonzero(numpy.abs(values) <= tiny))
+		self.count += len(values)
+		self.min = min(self.min, float(values.min()))
+		self.max = max(self.max, float(values.max()))
+
+	def merge(self, other):
+		if other.relativeAccuracy != self.relativeAccuracy:
+			raise ValueError("Can't merge sketches with different accuracies.")
+		for buckets, otherBuckets in ((self.positiveBuckets, other.positiveBuckets), (self.negativeBuckets, other.negativeBuckets)):
+			for bucketIndex, bucketCount in otherBuckets.items():
+				buckets[bucketIndex] = buckets.get(bucketIndex, 0) + bucketCount
+			self.collapse(buckets)
+		self.zeroCount += other.zeroCount
+		self.count += other.count
+		self.min = min(self.min, other.min)
+		self.max = max(self.max, other.max)
+
+	def bucketValue(self, bucketIndex):
+		return 2*self.gamma**bucketIndex/(self.gamma+1)
+
+	# Approximate value at quantile q (0 to 1)
+	def quantile(self, q):
+		if self.count == 0:
+			return math.nan
+		rank = q*(self.count-1)
+
+		seenCount = 0
+		for bucketIndex in sorted(self.negativeBuckets, reverse=True):
+			seenCount += self.negativeBuckets[bucketIndex]
+			if seenCount > rank:
+				return max(-self.bucketValue(bucketIndex), self.min)
+		seenCount += self.zeroCount
+		if seenCount > rank:
+			return 0.0
+		for bucketIndex in sorted(self.positiveBuckets):
+			seenCount += self.positiveBuckets[bucketIndex]
+			if seenCount > rank:
+				return min(self.bucketValue(bucketIndex), self.max)
+		return self.max
+
+
+# Moments, histogram and quantile sketch of a column
+class ColumnAggregate:
+	def __init__(self, binWidth=defaultBinWidth, binStart=defaultBinStart):
+		self.moments = RunningMoments()
+		self.histogram = FixedHistogram(binWidth, binStart)
+		self.sketch = QuantileSketch()
+
+	def addArray(self, values):
+		values = numpy.asarray(values, dtype=numpy.float64)
+		self.moments.addArray(values)
+		self.histogram.addArray(values)
+		self.sketch.addArray(values)
+
+	def merge(self, other):
+		self.moments.merge(other.moments)
+		self.histogram.merge(other.histogram)
+		self.sketch.merge(other.sketch)
+
+
+# Find a column's index in a header, by name or by number (counting from 1)
+def columnIndex(header, column):
+	if str(column).isdigit():
+		return int(column)-1
+	if column not in header:
+		raise ValueError("Can't match column name '{:s}' to a column number.".format(column))
+	return header.index(column)
+
+
+# Aggregates columns of data files, optionally only taking samples at or after a minimum time
+# ('minTimeInclusive', as aggregateColumnForHistogram.swift) or strictly after it (as averageColumn.swift)
+class StreamingAggregator:
+	def __init__(self, columns, minTime=None, timeColumn=None, minTimeInclusive=True, binWidth=defaultBinWidth, binStart=defaultBinStart):
+		self.columns = list(columns)
+		self.minTime = minTime
+		self.timeColumn = timeColumn
+		self.minTimeInclusive = minTimeInclusive
+		self.aggregates = {column: ColumnAggregate(binWidth, binStart) for column in self.columns}
+
+	def timeIndex(self, header):
+		if self.timeColumn is not None and (str(self.timeColumn).isdigit() or self.timeColumn in header):
+			return columnIndex(header, self.timeColumn)
+		return 0
+
+	def addChunk(self, times, columnChunks):
+		if self.minTime is not None:
+			timeMask = (times >= self.minTime) if self.minTimeInclusive else (times > self.minTime)
+			columnChunks = [columnChunk[timeMask] for columnChunk in columnChunks]
+		for column, columnChunk in zip(self.columns, columnChunks):
+			self.aggregates[column].addArray(columnChunk)
+
+	# Stream a data file through the aggregates, from its columnar copy if there is one (see statsCache)
+	# or line by line otherwise
+	def addFile(self, dataFile):
+		if statsCache.readSchema(dataFile) is not None:
+			statsColumns = statsCache.load(dataFile)
+			indexes = [columnIndex(statsColumns.header, column) for column in self.columns]
+			times = statsColumns.columns[self.timeIndex(statsColumns.header)]
+			for chunkStart in range(0, len(times), chunkSize):
+				chunk = slice(chunkStart, chunkStart+chunkSize)
+				self.addChunk(numpy.asarray(times[chunk], dtype=numpy.float64), [numpy.asarray(statsColumns.columns[index][chunk], dtype=numpy.float64) for index in indexes])
+			return
+
+		with open(dataFile, 'r') as dataFileHandle:
+			header = None
+			chunkLines = []
+			for line in dataFileHandle:
+				fields = [field for field in line.rstrip('\n').split('\t') if field]
+				if len(fields) == 0:
+					continue
+				if header is None:
+					header = fields
+					indexes = [self.timeIndex(header)] + [columnIndex(header, column) for column in self.columns]
+					continue
+				chunkLines.append([float(fields[index]) for index in indexes])
+				if len(chunkLines) == chunkSize:
+					self.addLines(chunkLines)
+					chunkLines = []
+			self.addLines(chunkLines)
+
+	def addLines(self, chunkLines):
+		if len(chunkLines) > 0:
+			chunkArray = numpy.array(chunkLines, dtype=numpy.float64)
+			self.addChunk(chunkArray[:,0], [chunkArray[:,index+1] for index in range(len(self.columns))])
+
+	def merge(self, other):
+		for column in self.columns:
+			self.aggregates[column].merge(other.aggregates[column])
+
+
+# Saved aggregator state, to merge partial results
+def saveState(aggregator, stateFile):
+	state = {'columns': aggregator.columns, 'aggregates': {}}
+	for column, aggregate in aggregator.aggregates.items():
+		moments, histogram, sketch = aggregate.moments, aggregate.histogram, aggregate.sketch
+		state['aggregates'][column] = {
+			'moments': [moments.count, [moments.partials, moments.nonFiniteSum], moments.runningMean, moments.m2, moments.min, moments.max],
+			'histogram': [histogram.binWidth, histogram.binStart, histogram.maxBins, histogram.counts.tolist()],
+			'sketch': [sketch.relativeAccuracy, sketch.maxBuckets, sketch.zeroCount, sketch.count, sketch.min, sketch.max, list(sketch.positiveBuckets.items()), list(sketch.negativeBuckets.items())]
+		}
+	with open(stateFile, 'w') as stateFileHandle:
+		json.dump(state, stateFileHandle)
+
+
+def loadState(stateFile):
+	with open(stateFile, 'r') as stateFileHandle:
+		state = json.load(stateFileHandle)
+	aggregator = StreamingAggregator(state['columns'])
+	for column, aggregateState in state['aggregates'].items():
+		aggregate = aggregator.aggregates[column]
+		moments = aggregate.moments
+		moments.count, momentsSum, moments.runningMean, moments.m2, moments.min, moments.max = aggregateState['moments']
+		# States saved before sums were exact hold a single float
+		moments.partials, moments.nonFiniteSum = momentsSum if isinstance(momentsSum, list) else ([momentsSum], 0.0)
+		binWidth, binStart, maxBins, counts = aggregateState['histogram']
+		aggregate.histogram = FixedHistogram(binWidth, binStart, maxBins)
+		aggregate.histogram.addCounts(numpy.array(counts, dtype=numpy.int64))
+		relativeAccuracy, maxBuckets, zeroCount, count, minValue, maxValue, positiveBuckets, negativeBuckets = aggregateState['sketch']
+		sketch = QuantileSketch(relativeAccuracy, maxBuckets)
+		sketch.zeroCount, sketch.count, sketch.min, sketch.max = zeroCount, count, minValue, maxValue
+		sketch.positiveBuckets = {bucketIndex: bucketCount for bucketIndex, bucketCount in positiveBuckets}
+		sketch.negativeBuckets = {bucketIndex: bucketCount for bucketIndex, bucketCount in negativeBuckets}
+		aggregate.sketch = sketch
+	return aggregator
+
+
+# Aggregate a list of data files on a pool of processes, merging the partial results in order
+def aggregateFiles(dataFiles, aggregatorArguments, processes=None):
+	aggregator = StreamingAggregator(**aggregatorArguments)
+	with multiprocessing.Pool(processes) as pool:
+		for fileAggregator in pool.imap(aggregateFile, [(dataFile, aggregatorArguments) for dataFile in dataFiles]):
+			aggregator.merge(fileAggregator)
+	return aggregator
+
+
+def aggregateFile(fileJob):
+	dataFile, aggregatorArguments = fileJob
+	aggregator = StreamingAggregator(**aggregatorArguments)
+	aggregator.addFile(dataFile)
+	return aggregator
+
+
+def formatNumber(value):
+	return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+# Output in the format of aggregateColumnForHistogram.swift
+def printHistogram(aggregate):
+	print("binCenter", "density", sep="\t")
+	for binCenter, binCount in aggregate.histogram.bins():
+		print(formatNumber(binCenter), repr(binCount/aggregate.moments.count), sep="\t")
+
+
+# Output in the format of averageColumn.swift
+def printAverage(aggregate):
+	print("mean", "count", sep="\t")
+	print(repr(aggregate.moments.mean()), repr(float(aggregate.moments.count)), sep="\t")
+
+
+def printSummary(aggregator):
+	print("column", "mean", "stdev", "var", "min", "max", "count", "p50", "p90", "p99", sep="\t")
+	for column in aggregator.columns:
+		moments, sketch = aggregator.aggregates[column].moments, aggregator.aggregates[column].sketch
+		print(column, repr(moments.mean()), repr(moments.stdev()), repr(moments.variance()), repr(moments.min), repr(moments.max), repr(float(moments.count)), repr(sketch.quantile(0.5)), repr(sketch.quantile(0.9)), repr(sketch.quantile(0.99)), sep="\t")
+
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage="%prog histogram|average|summary [list of data files] [column name or number] [...]")
+	parser.add_option("-p", "--processes", dest="processes", type="int", default=None, help="number of processes reading files (default: one per core)", metavar="N")
+	parser.add_option("--bin-width", dest="binWidth", type="float", default=defaultBinWidth, help="histogram bin width [default: %default]", metavar="WIDTH")
+	parser.add_option("--bin-start", dest="binStart", type="float", default=defaultBinStart, help="histogram start [default: %default]", metavar="START")
+	parser.add_option("--partial", dest="partialFile", default=None, help="save the aggregated state to a file, instead of printing it", metavar="FILE")
+	parser.add_option("--merge", action="store_true", default=False, help="merge saved states given in place of the list of data files")
+	(options, args) = parser.parse_args()
+
+	if len(args) < 2 or args[0] not in ('histogram', 'average', 'summary'):
+		parser.print_usage()
+		sys.exit(1)
+	mode = args[0]
+
+	try:
+		if options.merge:
+			aggregator = loadState(args[1])
+			for stateFile in args[2:]:
+				aggregator.merge(loadState(stateFile))
+		else:
+			if len(args) < 3:
+				parser.print_usage()
+				sys.exit(1)
+			with open(args[1], 'r') as fileListHandle:
+				dataFiles = [line for line in fileListHandle.read().splitlines() if line]
+
+			aggregatorArguments = {'columns': args[2:3], 'binWidth': options.binWidth, 'binStart': options.binStart}
+			if mode == 'histogram':
+				# Samples at or after the minimum time, if given
+				if len(args) > 3:
+					aggregatorArguments['minTime'] = float(args[3])
+				if len(args) > 4:
+					aggregatorArguments['timeColumn'] = args[4]
+			elif mode == 'average':
+				# Samples strictly after the minimum time, zero by default
+				aggregatorArguments['minTime'] = float(args[3]) if len(args) > 3 else 0.0
+				aggregatorArguments['minTimeInclusive'] = False
+			else:
+				aggregatorArguments['columns'] = args[2:]
+			aggregator = aggregateFiles(dataFiles, aggregatorArguments, options.processes)
+	except (OSError, ValueError, IndexError) as error:
+		print("Error:", error)
+		sys.exit(1)
+
+	if options.partialFile is not None:
+		saveState(aggregator, options.partialFile)
+	elif mode == 'histogram':
+		printHistogram(aggregator.aggregates[aggregator.columns[0]])
+	elif mode == 'average':
+		printAverage(aggregator.aggregates[aggregator.columns[0]])
+	else:
+		printSummary(aggregator)
@@ -1,24 +1,47 @@
 #!/usr/bin/env python3
 # This script runs multiple GISSUMO simulations in parallel, one for each floating car data file provided.
 
-import gzip
 import os
 import plistlib
-import re
 import shutil
-import subprocess
 import sys
-import time
-import datetime
+
+import convergence
+import fcdCrop
+import resultCache
+import resultIndex
+import runtimeHistory
+import simulationPool
+import workerTelemetry
 
 # Requires Python >3.5
 assert sys.version_info >= (3,5), "This script requires Python 3.5 or later."
 
 
+# Upper bound on the number of workers; the actual number is also limited by the
+# available cores and by the number of 'gisdb{N}' databases on the GIS server
 maxThreads = 5
 simulationDir = "simulations"
-simulationDescription = "description.txt"
 floatingCarDataDir = "fcddata"
+# Persistent history of simulation wall-times, shared by every set run from this folder
+historyFile = "simulationHistory.json"
+# Feed compressed FCD files to the simulator through named pipes, instead of decompressing them to disk
+useNamedPipes = "--fifo" in sys.argv
+# Reuse the results of identical simulations from the result cache (see resultCache)
+useResultCache = "--no-cache" not in sys.argv
+# Record the simulations in the result index (see resultIndex)
+useResultIndex = "--no-index" not in sys.argv
+# Crop the FCD files to 'stopTime' and 'innerBounds' before simulating with '--crop' (see fcdCrop; this
+# changes the results), with a margin in meters given by '--crop-margin=M' (default: the maximum radio range)
+useFcdCrop = "--crop" in sys.argv
+cropMargin = ([float(arg.split('=', 1)[1]) for arg in sys.argv if arg.startswith('--crop-margin=')] or [None])[-1]
+# Stop once the 95% confidence intervals of the key metrics are within '--converge=F' of their means
+# (see convergence), after at least '--min-replications=N' simulations
+convergenceTarget = ([float(arg.split('=', 1)[1]) for arg in sys.argv if arg.startswith('--converge=')] or [None])[-1]
+minReplications = ([int(arg.split('=', 1)[1]) for arg in sys.argv if arg.startswith('--min-replications=')] or [5])[-1]
+# Sample each simulation's resource use every '--telemetry-interval=S' seconds (see workerTelemetry)
+useTelemetry = "--no-telemetry" not in sys.argv
+telemetryInterval = ([float(arg.split('=', 1)[1]) for arg in sys.argv if arg.startswith('--telemetry-interval=')] or [1.0])[-1]
 
 
 if not os.path.isdir(floatingCarDataDir):
@@ -38,7 +61,7 @@ if not os.path.isfile('config.plist'):
 	sys.exit(1)
 
 if not os.path.isfile('obstructionMask.payload'):
-	print("Error: Please generate and provide an obstruction mask file.")
+	print("Error: Please generate and provide an obstruction mask file (see buildObstructionMask.py).")
 	sys.exit(1)
 
 
@@ -49,131 +72,42 @@ shutil.copy('../../build/gissumo_fast','./')
 os.makedirs(simulationDir, exist_ok=True)
 
 
-# Count the number of floating car data files
-fcdFiles = []
-for dirpath, dirnames, filenames in os.walk(floatingCarDataDir):
-	for file in filenames:
-		if file.endswith('fcd.tsv'):
-			fcdFiles.append( os.path.join(dirpath, file) )
-
-
-# Worker array: each worker can be 'free' or 'busy'
-workers = ['free'] * maxThreads
-# Holds Popen handles for each worker
-workerHandles = [None] * maxThreads
-# Holds the start time of each worker, for statistics
-workerStartTimes = [None] * maxThreads
-# Total number of simulations
-totalSimulations = len(fcdFiles)
-# Array to store simulation times, for statistics
-simulationTimes = []
-
-
-# Decompresses akin to 'gzip -d', erasing the original .gz
-# Returns the name (and path, if provided) of the decompressed file
-def gunzip(fileIn):
-	# Like gunzip, default output has the same base name
-	fileOut = re.sub('\.gz$', '', fileIn)
-
-	# Decompress and close
-	with gzip.open(fileIn, 'rb') as inFileGzipHandle:
-		with open(fileOut, 'wb') as outFileGzipHandle:
-			outFileGzipHandle.write( inFileGzipHandle.read() )
-
-	# Wipe compressed file
-	os.remove(fileIn)
-
-	return fileOut
-
-
-# Routine to create a new simulation
-def simulate(fcdFileIn):
-	simulationName = re.sub('\.fcd.tsv$', '', os.path.basename(fcdFileIn))
-
-	# Find a free worker and mark it busy
-	freeWorkerId = workers.index('free')
-	workers[freeWorkerId] = 'busy'
-
-	# Create the base simulation directory
-	os.makedirs(os.path.join(simulationDir, simulationName), exist_ok=True)
-
-	# Copy the FCD file over
-	fcdFile = os.path.join(simulationDir, simulationName, os.path.basename(fcdFileIn))
-	shutil.copyfile(fcdFileIn, fcdFile)
+# Size the worker pool from the available cores and databases
+with open('config.plist', 'rb') as configFileHandle:
+	configFileDict = plistlib.load(configFileHandle, fmt=plistlib.FMT_XML)
+workers = simulationPool.workerCount(maxThreads, configFileDict['gis'])
 
-	# Uncompress the FCD file
-	#fcdFile = gunzip(fcdFile)
+cache = resultCache.ResultCache() if useResultCache else None
 
-	# Copy the reference configuration file over
-	configFile = os.path.join(simulationDir, simulationName, 'config.plist')
-	shutil.copyfile('config.plist', configFile)
-
-	# Import and edit the configuration
-	with open(configFile, 'rb') as configFileHandle:
-		configFileDict = plistlib.load(configFileHandle, fmt=plistlib.FMT_XML)
-
-		# Edit 'floatingCarDataFile' and 'statsFolder' on the configuration
-		configFileDict['floatingCarDataFile'] = fcdFile
-		configFileDict['stats']['statsFolder'] = os.path.join(simulationDir, simulationName, 'stats')
-
-		# Set 'gis.database' to match the free worker id
-		configFileDict['gis']['database'] = 'gisdb{:d}'.format(freeWorkerId)
-
-	# Write to the configuration file and close
-	with open(configFile, 'wb') as configFileHandle:
-		plistlib.dump(configFileDict, configFileHandle, fmt=plistlib.FMT_XML)
-
-	# Simulate
-	workerStartTimes[freeWorkerId] = time.time()
-	runString ="./gissumo_fast {:s} > {:s} 2>&1".format(configFile, os.path.join(simulationDir, simulationName, 'gissumo.log'))
-	workerHandles[freeWorkerId] = subprocess.Popen(runString, shell=True)
-
-
-# Main loop
-simulationCount = 0
-while True:
-	# Update worker statuses
-	for workerId, worker in enumerate(workers):
-		if worker == 'busy':
-			if workerHandles[workerId].poll() != None:
-				# Worker has finished
-				workers[workerId] = 'free'
-				# Save simulation time
-				simulationTimes.append(time.time() - workerStartTimes[workerId])
-				# Update simulation count
-				simulationCount += 1
-				# Print some statistics if a simulation finished
-				meanSimulationTime = sum(simulationTimes)/len(simulationTimes)/maxThreads
-				remainingTime = meanSimulationTime*(totalSimulations-simulationCount)
-				print("{:s}  {:d}/{:d} simulations complete, ETA {:d}h{:02d}m{:02d}s".format(str(datetime.datetime.now().time()), simulationCount, totalSimulations, int(remainingTime/3600), int(remainingTime%3600/60), int(remainingTime%60)), flush=True)
-
-	# Run a simulation if a free worker is available
-	if (len(fcdFiles) > 0) and (workers.count('free') > 0):
-		# Pull a new simulation file
-		newFcdFile = fcdFiles.pop(0)
-
-		# Simulate it
-		simulate(newFcdFile)
-
-	# Iterate until no simulations remain, and no workers still busy
-	if (len(fcdFiles) == 0) and (workers.count('busy') == 0):
-		break
-
-	time.sleep(1)
+# Feed every run a copy of its FCD file cropped to the stop time and inner bounds, if asked to
+fcdFiles = simulationPool.findFcdFiles(floatingCarDataDir)
+if useFcdCrop:
+	cropBox, cropStopTime = fcdCrop.cropParameters(configFileDict, cropMargin)
+	cropCache = fcdCrop.CropCache(digest=cache.digest if cache is not None else resultCache.fileDigest)
+	fcdFiles = cropCache.cropAll(fcdFiles, cropBox, cropStopTime, workers)
+	cropCache.report()
 
+# Create a simulation job for each floating car data file
+try:
+	monitor = convergence.ConvergenceMonitor(configFileDict, convergenceTarget, minReplications) if convergenceTarget is not None else None
+except ValueError as error:
+	print("Error:", error)
+	sys.exit(1)
+simulationSet = simulationPool.SimulationSet(simulationDir, configFileDict, convergence=monitor)
+simulationJobs = [simulationPool.SimulationJob(simulationSet, fcdFile) for fcdFile in fcdFiles]
 
-# Create a file with a description of the simulation set (overwriting)
-with open(os.path.join(simulationDir, simulationDescription), 'w') as descriptionFp:
-	descriptionFp.write("simulations: {:d}\n".format(totalSimulations))
+# Run the simulations
+telemetry = workerTelemetry.WorkerTelemetry(telemetryInterval) if useTelemetry else None
+pool = simulationPool.SimulationPool(workers, runtimeHistory.RuntimeHistory(historyFile), useNamedPipes=useNamedPipes, cache=cache, telemetry=telemetry)
+pool.run(simulationJobs)
 
 # Simulation over
-print("Set complete, ran {:d} simulations.".format(totalSimulations))
+print("Set complete, ran {:d} simulations.".format(simulationSet.finishedSimulations))
 
-# Remove FCD files and simulation timetrackers in the simulation dir
-for dirpath, dirnames, filenames in os.walk(simulationDir):
-	for file in filenames:
-		if file.endswith('fcd.tsv') or file=='simulationTime.log':
-			os.remove(os.path.join(dirpath, file))
+if useResultIndex:
+	index = resultIndex.ResultIndex()
+	index.indexSet(simulationDir, 'description.template' if os.path.isfile('description.template') else resultIndex.defaultTemplate)
+	index.close()
 
 # Clean up
 os.remove('gissumo_fast')
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# This script builds the obstruction mask payload that the statistics module reads ('obstructionMaskFile'),
+# without running gissumo or querying PostGIS:
+#   ./buildObstructionMask.py [-c config.plist] [-s shapefile] [-o obstructionMask.payload]
+#
+# Cells are 1-arcsecond squares, numbered floor(coordinate*3600) as in CellMap, over the configuration's
+# 'innerBounds' (or --bounds). A cell is [B]locked if its center lies inside a building of the shapefile,
+# the point test GIS.checkForObstruction runs on PostGIS, and [O]pen otherwise. Each building is only
+# tested against the cell centers in its bounding box, all at once.
+#
+# With --from-fcd, the mask is instead built as 'buildObstructionMask' in 'src/tools.swift' does: over the
+# bounds of the floating car data (up to 'stopTime'), open on every cell where a vehicle is seen.
+#
+# Masks are cached in '<cacheDir>/<key>.payload', keyed by the contents of the input files and the bounds.
+
+import hashlib
+import math
+import optparse
+import os
+import plistlib
+import shutil
+import sys
+
+import numpy
+
+import buildings
+import fcdCrop
+import resultCache
+
+# Requires Python >3.5
+assert sys.version_info >= (3,5)
+
+
+# Default cache location, shared by every study on this machine
+defaultCacheDir = os.environ.get('GISSUMO_MASK_CACHE', os.path.expanduser('~/.cache/gissumo/masks'))
+
+
+# Top-left cell and size in cells of the map over some bounds (xMin, xMax, yMin, yMax), as City.innerTopLeftCell and City.innerCellSize
+def cellGrid(bounds):
+	xMin, xMax, yMin, yMax = bounds
+	topLeftCell = (int(math.floor(xMin*3600)), int(math.floor(yMax*3600)))
+	size = (int(math.ceil(xMax*3600) - math.floor(xMin*3600)), int(math.ceil(yMax*3600) - math.floor(yMin*3600)))
+	return topLeftCell, size
+
+
+# Map of the cells (rows from north to south) whose centers are inside a building
+def rasterizeBuildings(buildingList, topLeftCell, size):
+	blocked = numpy.zeros((size[1], size[0]), dtype=bool)
+	for building in buildingList:
+		xMin, xMax, yMin, yMax = building.bounds
+		# Columns and rows with their centers, ((tlc.x+column+0.5)/3600, (tlc.y-row+0.5)/3600), in the bounding box
+		firstColumn = max(int(math.ceil(xMin*3600 - 0.5)) - topLeftCell[0], 0)
+		lastColumn = min(int(math.floor(xMax*3600 - 0.5)) - topLeftCell[0], size[0]-1)
+		firstRow = max(int(math.ceil(topLeftCell[1] + 0.5 - yMax*3600)), 0)
+		lastRow = min(int(math.floor(topLeftCell[1] + 0.5 - yMin*3600)), size[1]-1)
+		if firstColumn > lastColumn or firstRow > lastRow:
+			continue
+
+		columns = numpy.arange(firstColumn, lastColumn+1)
+		rows = numpy.arange(firstRow, lastRow+1)
+		centerX = (topLeftCell[0] + columns + 0.5)/3600
+		centerY = (topLeftCell[1] - rows + 0.5)/3600
+		blocked[firstRow:lastRow+1, firstColumn:lastColumn+1] |= building.contains(centerX[numpy.newaxis,:], centerY[:,numpy.newaxis])
+	return blocked
+
+
+# Bounds of the floating car data up to a stop time, and the map of cells where vehicles are seen (as City.determineBounds and buildObstructionMask)
+def fcdOpenCells(fcdFile, stopTime=None):
+	positions = []
+	with fcdCrop.openFcdFile(fcdFile) as fcdFileHandle:
+		fcdFileHandle.readline()
+		for line in fcdFileHandle:
+			fields = line.split(b'\t', 4)
+			if stopTime is not None and float(fields[0]) > stopTime:
+				break
+			positions.append((float(fields[2]), float(fields[3])))
+	if len(positions) == 0:
+		raise ValueError("No vehicles in {:s}.".format(fcdFile))
+	positions = numpy.array(positions)
+
+	topLeftCell, size = cellGrid((positions[:,0].min(), positions[:,0].max(), positions[:,1].min(), positions[:,1].max()))
+
+	openCells = numpy.zeros((size[1], size[0]), dtype=bool)
+	columns = numpy.floor(positions[:,0]*3600).astype(numpy.int64) - topLeftCell[0]
+	rows = topLeftCell[1] - numpy.floor(positions[:,1]*3600).astype(numpy.int64)
+	inside = (columns < size[0]) & (rows < size[1])
+	openCells[rows[inside], columns[inside]] = True
+	return topLeftCell, openCells
+
+
+# Cell map payload of a mask ('tlc<x>;<y>p<cell>;<cell>;...p...', CellMap.toPayload in 'src/network.swift')
+def maskPayload(topLeftCell, openCells):
+	cells = numpy.where(openCells, 'O', 'B')
+	return "tlc{:d};{:d}p".format(*topLeftCell) + "p".join(";".join(row) for row in cells)
+
+
+def configuredBounds(configDict):
+	innerBounds = configDict['innerBounds']
+	return (float(innerBounds['x']['min']), float(innerBounds['x']['max']), float(innerBounds['y']['min']), float(innerBounds['y']['max']))
+
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser()
+	parser.add_option("-c", "--config", dest="configFile", default="config.plist", help="take 'innerBounds' (and 'stopTime', with --from-fcd) from configuration file", metavar="FILE")
+	parser.add_option("-s", "--shapefile", dest="shapefile", default=buildings.defaultShapefile, help="building shapefile, with or without .shp [default: %default]", metavar="FILE")
+	parser.add_option("-b", "--bounds", dest="bounds", default=None, help="bounds of the mask instead of 'innerBounds'", metavar="XMIN,XMAX,YMIN,YMAX")
+	parser.add_option("--from-fcd", dest="fcdFile", default=None, help="open the cells where vehicles are seen in a floating car data file instead, over its bounds", metavar="FILE")
+	parser.add_option("-o", "--output", dest="outputFile", default="obstructionMask.payload", help="write mask to file [default: %default]", metavar="FILE")
+	parser.add_option("--no-cache", dest="useCache", action="store_false", default=True, help="always build the mask")
+	(options, args) = parser.parse_args()
+
+	configDict = {}
+	if os.path.isfile(options.configFile):
+		with open(options.configFile, 'rb') as configFileHandle:
+			configDict = plistlib.load(configFileHandle, fmt=plistlib.FMT_XML)
+
+	# Key the mask by its inputs
+	keyDigest = hashlib.sha1()
+	try:
+		if options.fcdFile is not None:
+			stopTime = float(configDict['stopTime']) if configDict.get('stopTime', 0) > 0 else None
+			keyDigest.update(repr(('fcd', resultCache.fileDigest(options.fcdFile), stopTime)).encode())
+		else:
+			if options.bounds is not None:
+				bounds = tuple(float(value) for value in options.bounds.split(','))
+				if len(bounds) != 4:
+					raise ValueError("Bounds must be XMIN,XMAX,YMIN,YMAX.")
+			elif 'innerBounds' in configDict:
+				bounds = configuredBounds(configDict)
+			else:
+				print("Error: Please provide bounds, or a configuration file with 'innerBounds'.")
+				sys.exit(1)
+			keyDigest.update(repr(('shapefile', [resultCache.fileDigest(file) for file in buildings.shapefilePaths(options.shapefile)], bounds, buildings.buildingFeatureType)).encode())
+	except (OSError, KeyError, ValueError) as error:
+		print("Error:", error)
+		sys.exit(1)
+	cachedMask = os.path.join(defaultCacheDir, keyDigest.hexdigest() + '.payload')
+
+	if options.useCache and os.path.isfile(cachedMask):
+		shutil.copyfile(cachedMask, options.outputFile)
+		print("Copied cached obstruction mask to {:s}.".format(options.outputFile))
+		sys.exit(0)
+
+	try:
+		if options.fcdFile is not None:
+			topLeftCell, openCells = fcdOpenCells(options.fcdFile, stopTime)
+		else:
+			topLeftCell, size = cellGrid(bounds)
+			buildingList = buildings.readBuildings(options.shapefile)
+			openCells = ~rasterizeBuildings(buildingList, topLeftCell, size)
+	except (OSError, ValueError) as error:
+		print("Error:", error)
+		sys.exit(1)
+
+	payload = maskPayload(topLeftCell, openCells)
+	with open(options.outputFile, 'w') as outputFileHandle:
+		outputFileHandle.write(payload)
+	print("Wrote obstruction mask with size ({:d}, {:d}), open cells {:d}, to {:s}.".format(openCells.shape[1], openCells.shape[0], int(openCells.sum()), options.outputFile))
+
+	if options.useCache:
+		os.makedirs(defaultCacheDir, exist_ok=True)
+		temporaryFile = "{:s}.{:d}.tmp".format(cachedMask, os.getpid())
+		with open(temporaryFile, 'w') as cacheFileHandle:
+			cacheFileHandle.write(payload)
+		os.replace(temporaryFile, cachedMask)
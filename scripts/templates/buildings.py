@@ -0,0 +1,118 @@
+# This module reads building footprints straight from the ESRI shapefile that is loaded into PostGIS
+# ('data/shapefile_porto_srid4326.*', see 'scripts/00postgis/01setupPostGIS.sh'), without a database or GDAL.
+#
+# Buildings are the polygons whose 'feattyp' attribute is 9790, the same features GIS.checkForObstruction
+# and GIS.checkForLineOfSight query. Each building is kept as the rings of its polygon, as arrays of
+# (longitude, latitude) vertices, plus its bounding box and the arrays of its edges.
+
+import os
+import struct
+
+import numpy
+
+
+# Shapefile of the city, relative to a study folder
+defaultShapefile = os.path.join('..', '..', 'data', 'shapefile_porto_srid4326')
+# 'feattyp' of buildings (GIS.FeatureType.building in 'src/gis.swift')
+buildingFeatureType = 9790
+
+# Polygon, PolygonZ and PolygonM shapes all start with the 2D rings
+polygonShapeTypes = (5, 15, 25)
+
+
+class Building:
+	def __init__(self, gid, rings):
+		self.gid = gid
+		self.rings = rings
+		points = numpy.concatenate(rings)
+		self.bounds = (points[:,0].min(), points[:,0].max(), points[:,1].min(), points[:,1].max())
+		# Edges of every ring, as arrays of start and end coordinates
+		self.x0 = numpy.concatenate([ring[:-1,0] for ring in rings])
+		self.y0 = numpy.concatenate([ring[:-1,1] for ring in rings])
+		self.x1 = numpy.concatenate([ring[1:,0] for ring in rings])
+		self.y1 = numpy.concatenate([ring[1:,1] for ring in rings])
+
+	# Whether points are inside the building, by the even-odd rule over all of its rings
+	# (so that holes are left out). Takes and returns arrays.
+	def contains(self, x, y):
+		x = numpy.asarray(x, dtype=numpy.float64)[...,numpy.newaxis]
+		y = numpy.asarray(y, dtype=numpy.float64)[...,numpy.newaxis]
+		crosses = (self.y0 > y) != (self.y1 > y)
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			crossingX = self.x0 + (y-self.y0)*(self.x1-self.x0)/(self.y1-self.y0)
+		return numpy.logical_xor.reduce(crosses & (x < crossingX), axis=-1)
+
+
+def shapefilePaths(shapefile):
+	base = shapefile[:-len('.shp')] if shapefile.endswith('.shp') else shapefile
+	return base + '.shp', base + '.dbf'
+
+
+# Read the values of a field of a dBASE table, as stripped strings (None for deleted records)
+def readDbfField(dbfFile, fieldName):
+	with open(dbfFile, 'rb') as dbfFileHandle:
+		data = dbfFileHandle.read()
+	records, headerLength, recordLength = struct.unpack('<IHH', data[4:12])
+
+	# Field descriptors follow the header, 32 bytes each, up to a 0x0D terminator;
+	# record fields follow a deletion flag, in the same order
+	fields = {}
+	fieldOffset = 1
+	for descriptor in range(32, headerLength-1, 32):
+		if data[descriptor] == 0x0D:
+			break
+		name = data[descriptor:descriptor+11].split(b'\0')[0].decode('ascii', 'replace')
+		fields[name] = (fieldOffset, data[descriptor+16])
+		fieldOffset += data[descriptor+16]
+	if fieldName not in fields:
+		raise ValueError("Field '{:s}' not in {:s}.".format(fieldName, dbfFile))
+	fieldOffset, length = fields[fieldName]
+
+	values = []
+	for record in range(records):
+		start = headerLength + record*recordLength
+		if data[start:start+1] == b'*':
+			values.append(None)
+		else:
+			values.append(data[start+fieldOffset:start+fieldOffset+length].decode('latin-1').strip())
+	return values
+
+
+# Read the polygons of a shapefile, as a list of lists of rings (None for other shapes)
+def readPolygons(shpFile):
+	with open(shpFile, 'rb') as shpFileHandle:
+		data = shpFileHandle.read()
+	fileCode, = struct.unpack('>i', data[0:4])
+	if fileCode != 9994:
+		raise ValueError("{:s} is not a shapefile.".format(shpFile))
+
+	polygons = []
+	position = 100
+	while position+8 <= len(data):
+		recordNumber, contentLength = struct.unpack('>ii', data[position:position+8])
+		content = position+8
+		position = content + 2*contentLength
+
+		shapeType, = struct.unpack('<i', data[content:content+4])
+		if shapeType not in polygonShapeTypes:
+			polygons.append(None)
+			continue
+		parts, points = struct.unpack('<ii', data[content+36:content+44])
+		partStarts = numpy.frombuffer(data, dtype='<i4', count=parts, offset=content+44)
+		vertices = numpy.frombuffer(data, dtype='<f8', count=2*points, offset=content+44+4*parts).reshape(points, 2)
+		partEnds = numpy.append(partStarts[1:], points)
+		polygons.append([vertices[start:end] for start, end in zip(partStarts, partEnds) if end-start >= 2])
+	return polygons
+
+
+# Read the buildings of a shapefile (path with or without '.shp'). Their gids follow
+# shp2pgsql, which numbers records from 1.
+def readBuildings(shapefile=defaultShapefile, featureType=buildingFeatureType):
+	shpFile, dbfFile = shapefilePaths(shapefile)
+	featureTypes = readDbfField(dbfFile, 'feattyp')
+	polygons = readPolygons(shpFile)
+	if len(featureTypes) != len(polygons):
+		raise ValueError("{:s} and {:s} have different numbers of records.".format(shpFile, dbfFile))
+
+	return [Building(recordIndex+1, rings) for recordIndex, (rings, recordType) in enumerate(zip(polygons, featureTypes))
+		if rings and recordType == str(featureType)]
@@ -0,0 +1,100 @@
+# This module decides when a simulation set has run enough replications. Each finished simulation's key
+# metrics (from resultIndex.simulationMetrics) are folded into running means and variances, and the set has
+# converged once, for every metric, the half-width of the 95% confidence interval of its mean is within a
+# target fraction of the mean. The simulation pool then stops dispatching the set's queued simulations.
+# It dispatches a monitored set's simulations in a random order, so the replications run are a random
+# sample of the set's traces rather than its longest ones.
+#
+# Metrics are the mean covered cells (cityCoverageEvolution), the mean signal and saturation over time
+# (signalAndSaturationEvolution) and the final number of roadside units (entityCount). A set converges on
+# the metrics whose statistics hooks its configuration enables, and can't be monitored without any.
+
+import math
+
+import resultIndex
+
+
+# Metrics, and the statistics hooks that write them
+convergenceMetrics = [
+	('meanCoveredCells', 'cityCoverageEvolution'),
+	('meanSignal', 'signalAndSaturationEvolution'),
+	('meanSaturation', 'signalAndSaturationEvolution'),
+	('finalRoadsideUnits', 'entityCount')
+]
+
+# Two-sided 95% quantiles of Student's t distribution, by degrees of freedom (the normal quantile past 30)
+studentT95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+	2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+	2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+normal95 = 1.960
+
+
+def tQuantile95(degreesOfFreedom):
+	return studentT95[degreesOfFreedom-1] if degreesOfFreedom <= len(studentT95) else normal95
+
+
+# Running mean and variance of a metric (Welford's algorithm)
+class RunningEstimate:
+	def __init__(self):
+		self.count = 0
+		self.mean = 0.0
+		self.squares = 0.0
+
+	def add(self, value):
+		self.count += 1
+		delta = value - self.mean
+		self.mean += delta/self.count
+		self.squares += delta*(value - self.mean)
+
+	# Half-width of the 95% confidence interval of the mean, or None with less than two samples
+	def halfWidth(self):
+		if self.count < 2:
+			return None
+		return tQuantile95(self.count-1) * math.sqrt(self.squares/(self.count-1)/self.count)
+
+
+# Metrics of a configuration, those whose hooks are enabled in 'stats.hooks'
+def enabledMetrics(configDict, metrics=convergenceMetrics):
+	hooks = configDict.get('stats', {}).get('hooks', {})
+	return [metric for metric, hook in metrics if hooks.get(hook) is True]
+
+
+class ConvergenceMonitor:
+	def __init__(self, configDict, relativeHalfWidth, minReplications=5, metrics=convergenceMetrics):
+		# Target half-width of every metric's confidence interval, as a fraction of its mean
+		self.relativeHalfWidth = relativeHalfWidth
+		self.minReplications = max(minReplications, 2)
+		metricNames = enabledMetrics(configDict, metrics)
+		if len(metricNames) == 0:
+			raise ValueError("No convergence metrics, enable one of the {:s} statistics hooks.".format(", ".join(sorted(set(hook for _, hook in metrics)))))
+		self.estimates = {metric: RunningEstimate() for metric in metricNames}
+		self.replications = 0
+		# Simulations left undispatched once converged, set by the simulation pool
+		self.savedReplications = 0
+
+	# Fold in a finished simulation's metrics
+	def add(self, simulationDir):
+		metrics = resultIndex.simulationMetrics(simulationDir)
+		missing = [metric for metric in self.estimates if metric not in metrics]
+		if missing:
+			print("Warning: No {:s} in {:s}, left out of the convergence estimates.".format(", ".join(missing), simulationDir), flush=True)
+			return
+		self.replications += 1
+		for metric, estimate in self.estimates.items():
+			estimate.add(metrics[metric])
+
+	def converged(self):
+		if self.replications < self.minReplications:
+			return False
+		for estimate in self.estimates.values():
+			if estimate.halfWidth() > self.relativeHalfWidth*abs(estimate.mean):
+				return False
+		return True
+
+	# Lines for the set's description: replications run and saved, and each metric's confidence interval
+	def describe(self):
+		lines = ["replications: {:d}".format(self.replications), "replicationsSaved: {:d}".format(self.savedReplications)]
+		for metric, estimate in self.estimates.items():
+			halfWidth = estimate.halfWidth()
+			lines.append("{:s}: {:.4g} +- {:s} (95% CI, target +- {:.4g})".format(metric, estimate.mean, "{:.4g}".format(halfWidth) if halfWidth is not None else "?", self.relativeHalfWidth*abs(estimate.mean)))
+		return "\n".join(lines) + "\n"
@@ -1,76 +1,115 @@
 #!/usr/bin/env python3
 # This script will generate a description file, pulling entries from a plist config file and printing the ones that match a provided template.
-
+#
+# It can also be imported: readTemplate() compiles a template once into a getter per entry, and the
+# DescriptionTemplate it returns describes any number of configurations (as text, or as a dictionary of
+# key paths and values for JSON) without starting a new interpreter or reading the template again.
+
+import functools
+import json
+import operator
+import optparse
 import os
 import plistlib
-import shutil
 import sys
-import optparse
-import collections
 
 
 # Requires Python >3.5
 assert sys.version_info >= (3,5)
 
 
-# Process command line options
-parser = optparse.OptionParser()
-parser.add_option("-t", "--template", dest="templateFile", default="description.template", help="read list of entries from template", metavar="FILE")
-parser.add_option("-c", "--config", dest="configFile", default="config.plist", help="fetch entries from configuration file", metavar="FILE")
-parser.add_option("-o", "--output", dest="outputFile", default="description.txt", help="write description to file", metavar="FILE")
-
-(options, args) = parser.parse_args()
-
-if not os.path.isfile(options.templateFile):
-	print("Error: Please provide a template file.")
-	sys.exit(1)
-
-if not os.path.isfile(options.configFile):
-	print("Error: Please provide a configuration file.")
-	sys.exit(1)
-
-
-# Tree code
-def tree(): return collections.defaultdict(tree)
-
-def setInTree(t, path, value):
-  i = 0
-  for key in path:
-    i = i + 1
-    if i == len(path) and value != None:
-      t[key] = value
-    t = t[key]
-
-def printTree(tree, depth=0):
-	for rootKey in sorted(tree.keys()):
-		print("{:s}{:s}".format(' '*depth, rootKey),  end='')
-		if type(tree[rootKey]) == collections.defaultdict:
-			print('')
-			printTree(tree[rootKey], depth+1)
-		elif tree[rootKey] != None:
-			print(':', tree[rootKey])
-
-def getNestedTreeEntry(tree, path):
-	for key in path:
-		tree = tree[key]
-	return tree
-
-# Read template file
-with open(options.templateFile) as f_in:
-	# read and strip \n
-	entries = (line.rstrip() for line in f_in)
-	# strip empties
-	entries = list(line for line in entries if line)
-
-
-# Push template entries into a tree
-entriesTree = tree()
-
-with open(options.configFile, 'rb') as configFileHandle:
-	configFileDict = plistlib.load(configFileHandle, fmt=plistlib.FMT_XML)
-	for entry in entries:
-		entryComponents = entry.split('.')
-		getNestedTreeEntry(configFileDict, entryComponents)
-		setInTree(entriesTree, entryComponents, getNestedTreeEntry(configFileDict, entryComponents))
-
-printTree(entriesTree)
+class DescriptionTemplate:
+	def __init__(self, keyPaths):
+		self.keyPaths = keyPaths
+		# Getter of each entry, walking its key path on a configuration dictionary
+		self.getters = [functools.partial(functools.reduce, operator.getitem, keyPath.split('.')) for keyPath in keyPaths]
+
+		# Lines of the description, in order: (depth, key, index of the entry for leaves, None for branches)
+		entryTree = {}
+		for entryIndex, keyPath in enumerate(keyPaths):
+			branch = entryTree
+			for key in keyPath.split('.')[:-1]:
+				branch = branch.setdefault(key, {})
+			branch[keyPath.split('.')[-1]] = entryIndex
+		self.lines = []
+		def addLines(branch, depth):
+			for key in sorted(branch.keys()):
+				if isinstance(branch[key], dict):
+					self.lines.append((depth, key, None))
+					addLines(branch[key], depth+1)
+				else:
+					self.lines.append((depth, key, branch[key]))
+		addLines(entryTree, 0)
+
+	# Values of the entries in a configuration, by key path. Missing entries raise a KeyError, or are left out with 'skipMissing'.
+	def values(self, configDict, skipMissing=False):
+		values = {}
+		for keyPath, getter in zip(self.keyPaths, self.getters):
+			try:
+				values[keyPath] = getter(configDict)
+			except (KeyError, TypeError):
+				if not skipMissing:
+					raise KeyError("Entry '{:s}' not in configuration.".format(keyPath))
+		return values
+
+	# Text description of a configuration: the template's entries as a tree, sorted by key
+	def describe(self, configDict):
+		values = self.values(configDict)
+		outputLines = []
+		for depth, key, entryIndex in self.lines:
+			if entryIndex is None:
+				outputLines.append("{:s}{:s}".format(' '*depth, key))
+			else:
+				outputLines.append("{:s}{:s}: {:s}".format(' '*depth, key, str(values[self.keyPaths[entryIndex]])))
+		return "\n".join(outputLines) + "\n"
+
+	# Description of a configuration as JSON, an object of key paths and values
+	def describeJSON(self, configDict):
+		return json.dumps(self.values(configDict), sort_keys=True, default=str)
+
+
+# Read and compile a template file, one key path per line
+def readTemplate(templateFile):
+	with open(templateFile) as f_in:
+		# read, strip \n and empties
+		entries = [line.rstrip() for line in f_in if line.rstrip()]
+	return DescriptionTemplate(entries)
+
+
+if __name__ == "__main__":
+	# Process command line options
+	parser = optparse.OptionParser()
+	parser.add_option("-t", "--template", dest="templateFile", default="description.template", help="read list of entries from template", metavar="FILE")
+	parser.add_option("-c", "--config", dest="configFile", default="config.plist", help="fetch entries from configuration file", metavar="FILE")
+	parser.add_option("-o", "--output", dest="outputFile", default=None, help="write description to file (default: print it)", metavar="FILE")
+	parser.add_option("-j", "--json", dest="jsonFile", default=None, help="also write the entries as JSON to file", metavar="FILE")
+
+	(options, args) = parser.parse_args()
+
+	if not os.path.isfile(options.templateFile):
+		print("Error: Please provide a template file.")
+		sys.exit(1)
+
+	if not os.path.isfile(options.configFile):
+		print("Error: Please provide a configuration file.")
+		sys.exit(1)
+
+	template = readTemplate(options.templateFile)
+	with open(options.configFile, 'rb') as configFileHandle:
+		configFileDict = plistlib.load(configFileHandle, fmt=plistlib.FMT_XML)
+
+	try:
+		description = template.describe(configFileDict)
+	except KeyError as error:
+		print("Error:", error.args[0])
+		sys.exit(1)
+
+	if options.outputFile is not None:
+		with open(options.outputFile, 'w') as outputFileHandle:
+			outputFileHandle.write(description)
+	else:
+		print(description, end='')
+
+	if options.jsonFile is not None:
+		with open(options.jsonFile, 'w') as jsonFileHandle:
+			jsonFileHandle.write(template.describeJSON(configFileDict) + "\n")
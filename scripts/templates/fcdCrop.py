@@ -0,0 +1,173 @@
+# This module crops floating car data files ahead of simulation. gissumo reads the whole FCD file but
+# only loads timesteps up to 'stopTime', and only gathers statistics inside 'innerBounds'. A cropped file
+# keeps the timesteps up to 'stopTime' and the vehicles that are ever inside the inner bounds plus a margin
+# (by default, the maximum radio range: 155m * 'rangeMultiplier').
+#
+# Cropping changes simulation results, it is not a pure speed-up, and the runners only crop when asked to
+# ('--crop'): gissumo draws every parking duration from one seeded generator, in parking order, so dropping
+# vehicles shifts every later draw; the city bounds are taken from all vehicles in the file; and timesteps
+# left with no vehicles disappear, which delays the removal of vehicles that ended their trips. Results of
+# cropped runs should only be compared with other cropped runs.
+#
+# Vehicles are kept or dropped as a whole, with every row of their trips: dropping only the rows outside
+# the margin would make gissumo end their trips (and park them) where they leave it. The file is read
+# twice, once to find the vehicles that enter the margin and once to write their rows unchanged.
+#
+# Cropped files are cached in '<cacheDir>/<key>/<name>.fcd.tsv', next to an 'entry.json' with the size and
+# rows of the original file, keyed by the name and contents of the original file, the cropping box and 'stopTime',
+# and are shared by every study on this machine.
+
+import gzip
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import shutil
+
+import resultCache
+
+
+# Default cache location, shared by every study on this machine
+defaultCacheDir = os.environ.get('GISSUMO_CROP_CACHE', os.path.expanduser('~/.cache/gissumo/crops'))
+
+entryFile = 'entry.json'
+
+# Maximum radio range, in meters, before 'rangeMultiplier' (Network.maxRange in 'src/network.swift')
+maxRadioRange = 155.0
+# Earth radius used by GIS.getHaversineDistance, in meters
+earthRadius = 6372800.0
+
+
+# Cropping box and stop time of a configuration: the inner bounds grown by 'margin' meters on every side
+# (the maximum radio range, if None), or None without inner bounds; and 'stopTime', or None without one.
+def cropParameters(configDict, margin=None):
+	stopTime = float(configDict['stopTime']) if configDict.get('stopTime', 0) > 0 else None
+
+	try:
+		innerBounds = configDict['innerBounds']
+		xMin, xMax = float(innerBounds['x']['min']), float(innerBounds['x']['max'])
+		yMin, yMax = float(innerBounds['y']['min']), float(innerBounds['y']['max'])
+	except (KeyError, TypeError):
+		return None, stopTime
+
+	if margin is None:
+		margin = maxRadioRange*float(configDict.get('rangeMultiplier', 1.0))
+	# Degrees of latitude for the margin, and of longitude at the latitude farthest from the equator
+	yMargin = math.degrees(margin/earthRadius)
+	xMargin = yMargin/math.cos(math.radians(max(abs(yMin), abs(yMax))))
+	return (xMin-xMargin, xMax+xMargin, yMin-yMargin, yMax+yMargin), stopTime
+
+
+def openFcdFile(fcdFile):
+	return gzip.open(fcdFile, 'rb') if fcdFile.endswith('.gz') else open(fcdFile, 'rb')
+
+
+# Crop a (plain or compressed) FCD file into a plain one.
+# Returns the uncompressed size of the original file and the numbers of rows it has and that were kept.
+def cropFile(fcdFileIn, fcdFileOut, box, stopTime):
+	# First pass: vehicles inside the box up to the stop time, and the size of the whole file
+	keptVehicles = set()
+	readRows = 0
+	with openFcdFile(fcdFileIn) as fcdFileHandle:
+		sourceBytes = len(fcdFileHandle.readline())
+		sourceRows = 0
+		pastStopTime = False
+		for line in fcdFileHandle:
+			sourceBytes += len(line)
+			sourceRows += 1
+			if pastStopTime:
+				continue
+			fields = line.split(b'\t', 4)
+			# The file is sorted in time, nothing past the stop time is kept
+			if stopTime is not None and float(fields[0]) > stopTime:
+				pastStopTime = True
+				continue
+			readRows += 1
+			if box is None:
+				continue
+			x, y = float(fields[2]), float(fields[3])
+			if box[0] <= x <= box[1] and box[2] <= y <= box[3]:
+				keptVehicles.add(fields[1])
+
+	# Second pass: the rows of those vehicles
+	keptRows = 0
+	with openFcdFile(fcdFileIn) as fcdFileHandle, open(fcdFileOut, 'wb') as fcdFileOutHandle:
+		fcdFileOutHandle.write(fcdFileHandle.readline())
+		for lineNumber, line in enumerate(fcdFileHandle):
+			if lineNumber == readRows:
+				break
+			if box is None or line.split(b'\t', 2)[1] in keptVehicles:
+				fcdFileOutHandle.write(line)
+				keptRows += 1
+	return sourceBytes, sourceRows, keptRows
+
+
+# Crop an FCD file into its cache entry, going through a temporary folder so that
+# concurrent runs never see a partial entry
+def cropEntry(fcdFile, entryDir, croppedFile, box, stopTime):
+	temporaryDir = "{:s}.{:d}.tmp".format(entryDir, os.getpid())
+	shutil.rmtree(temporaryDir, ignore_errors=True)
+	os.makedirs(temporaryDir)
+	try:
+		sourceBytes, sourceRows, keptRows = cropFile(fcdFile, os.path.join(temporaryDir, os.path.basename(croppedFile)), box, stopTime)
+		entry = {'source': os.path.basename(fcdFile), 'box': box, 'stopTime': stopTime, 'sourceBytes': sourceBytes, 'sourceRows': sourceRows, 'keptRows': keptRows}
+		with open(os.path.join(temporaryDir, entryFile), 'w') as entryFileHandle:
+			json.dump(entry, entryFileHandle)
+		os.rename(temporaryDir, entryDir)
+	except OSError:
+		# Another run got there first
+		if not os.path.isfile(os.path.join(entryDir, entryFile)):
+			raise
+	finally:
+		shutil.rmtree(temporaryDir, ignore_errors=True)
+
+
+class CropCache:
+	def __init__(self, cacheDir=defaultCacheDir, digest=resultCache.fileDigest):
+		self.cacheDir = cacheDir
+		# Digest of a file's contents; pass ResultCache.digest to share its stored digests
+		self.digest = digest
+		os.makedirs(cacheDir, exist_ok=True)
+
+		# Statistics for this run
+		self.hits = 0
+		self.misses = 0
+		self.bytesIn = 0
+		self.bytesOut = 0
+
+	def key(self, fcdFile, box, stopTime):
+		keyDigest = hashlib.sha1()
+		keyDigest.update(self.digest(fcdFile).encode())
+		keyDigest.update(repr((os.path.basename(fcdFile), box, stopTime)).encode())
+		return keyDigest.hexdigest()
+
+	# Cache folder and cropped file of an FCD file. The cropped file keeps the original name, uncompressed.
+	def entry(self, fcdFile, box, stopTime):
+		entryDir = os.path.join(self.cacheDir, self.key(fcdFile, box, stopTime))
+		croppedName = os.path.basename(fcdFile)[:-len('.gz')] if fcdFile.endswith('.gz') else os.path.basename(fcdFile)
+		return entryDir, os.path.join(entryDir, croppedName)
+
+	# Paths to the cropped copies of a list of FCD files, cropping the missing ones on 'processes' processes
+	def cropAll(self, fcdFiles, box, stopTime, processes=1):
+		entries = [self.entry(fcdFile, box, stopTime) for fcdFile in fcdFiles]
+		missingEntries = [(fcdFile, entryDir, croppedFile, box, stopTime) for fcdFile, (entryDir, croppedFile) in zip(fcdFiles, entries) if not os.path.isfile(os.path.join(entryDir, entryFile))]
+		if processes > 1 and len(missingEntries) > 1:
+			with multiprocessing.Pool(min(processes, len(missingEntries))) as pool:
+				pool.starmap(cropEntry, missingEntries)
+		else:
+			for missingEntry in missingEntries:
+				cropEntry(*missingEntry)
+
+		self.misses += len(missingEntries)
+		self.hits += len(entries) - len(missingEntries)
+		for entryDir, croppedFile in entries:
+			with open(os.path.join(entryDir, entryFile), 'r') as entryFileHandle:
+				self.bytesIn += json.load(entryFileHandle)['sourceBytes']
+			self.bytesOut += os.path.getsize(croppedFile)
+		return [croppedFile for entryDir, croppedFile in entries]
+
+	# Print the size reduction of this run
+	def report(self):
+		reduction = (1-self.bytesOut/self.bytesIn)*100 if self.bytesIn > 0 else 0.0
+		print("FCD crop: {:d} files ({:d} cached), {:.1f} MB cropped to {:.1f} MB ({:.1f}% reduction).".format(self.hits+self.misses, self.hits, self.bytesIn/1e6, self.bytesOut/1e6, reduction), flush=True)
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+# This module precomputes line-of-sight and signal levels between the cells of the city, so that the
+# beacon and reception path (GIS.checkForLineOfSight, then portoEmpiricalDataModel) can be answered from
+# a table instead of a PostGIS round-trip per query.
+#
+# Cells are the 1-arcsecond squares of CellMap, over 'innerBounds' grown by the maximum radio range.
+# For every pair of cells whose centers are within the maximum range (155m * 'rangeMultiplier', measured as
+# GIS.getHaversineDistance does, plus a cell diagonal so that any two points in range are covered), the
+# table holds the distance between centers, whether the segment between them crosses a building (the
+# ST_Intersects test of GIS.checkForLineOfSight) and the resulting signal level. Building edges are kept in
+# a grid index over the same cells, and the rows of the table are built on a pool of processes.
+#
+# A table is a folder of memory-mappable '.npy' files in compressed sparse row form: 'indptr' (per cell),
+# then 'neighbors', 'distance', 'lineOfSight' and 'signal' (per pair, neighbors sorted), plus 'obstructed'
+# (cells whose center is inside a building) and a 'grid.json' with the grid and the inputs it was built from.
+#
+# usage: ./losTable.py [-c config.plist] [-s shapefile] [-o losTable] build
+#        ./losTable.py [-o losTable] [--port N] serve
+#        ./losTable.py [-o losTable] query [los|signal|within|obstruction] [coordinates...]
+#        ./losTable.py [-c config.plist] [--samples N] bench
+#
+# The server answers one request per line on a local TCP port, with one line per reply:
+#   los X1 Y1 X2 Y2          1 or 0, '-' if the cells are not in the table
+#   signal X1 Y1 X2 Y2       signal level 0-5, with the exact distance between the points and the table's line-of-sight
+#   within X Y               'cellX;cellY;distance;lineOfSight;signal' for every cell in range of X Y, space-separated
+#   obstruction X Y          1 if the cell's center is inside a building, 0 if not
+
+import hashlib
+import json
+import math
+import multiprocessing
+import optparse
+import os
+import plistlib
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+import numpy
+
+import buildObstructionMask
+import buildings
+import fcdCrop
+import resultCache
+
+# Requires Python >3.5
+assert sys.version_info >= (3,5)
+
+
+defaultTableDir = "losTable"
+defaultPort = 7790
+tableArrays = ['indptr', 'neighbors', 'distance', 'lineOfSight', 'signal', 'obstructed']
+gridFile = 'grid.json'
+
+# Conversion rate from meters to degrees, and Earth radius in kilometers (GIS in 'src/gis.swift')
+degreesPerMeter = 0.0000089925
+earthRadius = 6372.8
+
+
+# Distance between points, as GIS.getHaversineDistance computes it. Takes and returns arrays.
+def haversineDistance(x1, y1, x2, y2):
+	lat1rad, lon1rad = numpy.radians(y1), numpy.radians(x1)
+	lat2rad, lon2rad = numpy.radians(y2), numpy.radians(x2)
+	a = numpy.sin((lat2rad-lat1rad)/2)**2 + numpy.sin((lon2rad-lon1rad)/2)**2 * numpy.cos(lat1rad) * numpy.cos(lat2rad)
+	c = 2*numpy.arcsin(numpy.sqrt(a))
+	return earthRadius * c / degreesPerMeter / 100
+
+
+# Signal level for a distance and line-of-sight, as portoEmpiricalDataModel in 'src/network.swift'. Takes and returns arrays.
+def signalLevel(distance, lineOfSight, multiplier=1.0):
+	distance = numpy.asarray(distance)/multiplier
+	losLevel = numpy.select([distance < 70, distance < 115, distance < 135, distance < 155], [5, 4, 3, 2], 0)
+	nlosLevel = numpy.select([distance < 58, distance < 65, distance < 105, distance < 130], [5, 4, 3, 2], 0)
+	return numpy.where(lineOfSight, losLevel, nlosLevel).astype(numpy.int8)
+
+
+# Building edges, bucketed by the cells of the grid their bounding boxes touch
+class EdgeIndex:
+	def __init__(self, buildingList, topLeftCell, size):
+		self.topLeftCell = topLeftCell
+		self.size = size
+		edges = numpy.stack([numpy.concatenate([getattr(building, coordinate) for building in buildingList]) for coordinate in ['x0', 'y0', 'x1', 'y1']], axis=1) if buildingList else numpy.zeros((0,4))
+
+		# Cell ranges of each edge, clipped to the grid
+		firstColumn = numpy.floor(numpy.minimum(edges[:,0], edges[:,2])*3600).astype(numpy.int64) - topLeftCell[0]
+		lastColumn = numpy.floor(numpy.maximum(edges[:,0], edges[:,2])*3600).astype(numpy.int64) - topLeftCell[0]
+		firstRow = topLeftCell[1] - numpy.floor(numpy.maximum(edges[:,1], edges[:,3])*3600).astype(numpy.int64)
+		lastRow = topLeftCell[1] - numpy.floor(numpy.minimum(edges[:,1], edges[:,3])*3600).astype(numpy.int64)
+		inGrid = (lastColumn >= 0) & (firstColumn < size[0]) & (lastRow >= 0) & (firstRow < size[1])
+		self.edges = edges[inGrid]
+		firstColumn, lastColumn = numpy.clip(firstColumn[inGrid], 0, size[0]-1), numpy.clip(lastColumn[inGrid], 0, size[0]-1)
+		firstRow, lastRow = numpy.clip(firstRow[inGrid], 0, size[1]-1), numpy.clip(lastRow[inGrid], 0, size[1]-1)
+
+		# (cell, edge) pairs, sorted by cell into compressed rows
+		cellEdges = [(row*size[0] + column, edgeIndex)
+			for edgeIndex in range(len(self.edges))
+			for row in range(firstRow[edgeIndex], lastRow[edgeIndex]+1)
+			for column in range(firstColumn[edgeIndex], lastColumn[edgeIndex]+1)]
+		cellEdges = numpy.array(cellEdges, dtype=numpy.int64).reshape(-1, 2)
+		cellEdges = cellEdges[numpy.argsort(cellEdges[:,0], kind='stable')]
+		self.indptr = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(cellEdges[:,0], minlength=size[0]*size[1]))])
+		self.cellEdges = cellEdges[:,1]
+
+	# Edges touching any cell in a window of rows and columns
+	def window(self, firstRow, lastRow, firstColumn, lastColumn):
+		rows = numpy.arange(firstRow, lastRow+1)[:,numpy.newaxis]*self.size[0]
+		cells = (rows + numpy.arange(firstColumn, lastColumn+1)).ravel()
+		edgeIndices = numpy.concatenate([self.cellEdges[self.indptr[cell]:self.indptr[cell+1]] for cell in cells])
+		return self.edges[numpy.unique(edgeIndices)]
+
+
+# Whether segments from (x, y) to (x2, y2) intersect (or touch) any of a set of edges. Returns an array over the segments.
+def segmentsCrossEdges(x, y, x2, y2, edges):
+	crosses = numpy.zeros(len(x2), dtype=bool)
+	if len(edges) == 0 or len(x2) == 0:
+		return crosses
+
+	# Only pairs whose bounding boxes overlap can intersect
+	ex0, ey0, ex1, ey1 = (edges[:,column][numpy.newaxis,:] for column in range(4))
+	sx, sy = x2[:,numpy.newaxis], y2[:,numpy.newaxis]
+	overlap = (numpy.minimum(x, sx) <= numpy.maximum(ex0, ex1)) & (numpy.maximum(x, sx) >= numpy.minimum(ex0, ex1)) & \
+		(numpy.minimum(y, sy) <= numpy.maximum(ey0, ey1)) & (numpy.maximum(y, sy) >= numpy.minimum(ey0, ey1))
+	segmentIndex, edgeIndex = numpy.nonzero(overlap)
+	if len(segmentIndex) == 0:
+		return crosses
+
+	px, py = x2[segmentIndex], y2[segmentIndex]
+	qx0, qy0, qx1, qy1 = (edges[edgeIndex,column] for column in range(4))
+	orientation = lambda ax, ay, bx, by, cx, cy: numpy.sign((bx-ax)*(cy-ay) - (by-ay)*(cx-ax))
+	# Each segment's ends on opposite sides (or on) the other's line; collinear pairs overlap by their bounding boxes
+	intersects = (orientation(qx0, qy0, qx1, qy1, x, y) * orientation(qx0, qy0, qx1, qy1, px, py) <= 0) & \
+		(orientation(x, y, px, py, qx0, qy0) * orientation(x, y, px, py, qx1, qy1) <= 0)
+	crosses[segmentIndex[intersects]] = True
+	return crosses
+
+
+# State shared by the processes building a table
+buildState = {}
+
+def initializeBuild(state):
+	buildState.update(state)
+
+
+# Pairs (source, neighbor, distance, lineOfSight) of a range of source cells, with neighbors after the source
+def buildRows(firstCell, lastCell):
+	topLeftCell, size, tableRange = buildState['topLeftCell'], buildState['size'], buildState['tableRange']
+	window, edgeIndex, obstructed = buildState['window'], buildState['edgeIndex'], buildState['obstructed']
+	centerX = (topLeftCell[0] + numpy.arange(size[0]) + 0.5)/3600
+	centerY = (topLeftCell[1] - numpy.arange(size[1]) + 0.5)/3600
+
+	pairs = []
+	for cell in range(firstCell, lastCell):
+		row, column = divmod(cell, size[0])
+		firstRow, lastRow = row, min(row+window[1], size[1]-1)
+		firstColumn, lastColumn = max(column-window[0], 0), min(column+window[0], size[0]-1)
+
+		rows, columns = numpy.meshgrid(numpy.arange(firstRow, lastRow+1), numpy.arange(firstColumn, lastColumn+1), indexing='ij')
+		neighbors = (rows*size[0] + columns).ravel()
+		rows, columns = rows.ravel(), columns.ravel()
+		later = neighbors > cell
+		neighbors, rows, columns = neighbors[later], rows[later], columns[later]
+
+		distance = haversineDistance(centerX[column], centerY[row], centerX[columns], centerY[rows])
+		inRange = distance < tableRange
+		neighbors, rows, columns, distance = neighbors[inRange], rows[inRange], columns[inRange], distance[inRange]
+
+		crosses = segmentsCrossEdges(centerX[column], centerY[row], centerX[columns], centerY[rows], edgeIndex.window(max(row-window[1], 0), lastRow, firstColumn, lastColumn))
+		lineOfSight = ~(crosses | obstructed[row, column] | obstructed[rows, columns])
+		pairs.append((numpy.full(len(neighbors), cell), neighbors, distance, lineOfSight))
+
+	if len(pairs) == 0:
+		return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0), numpy.zeros(0, dtype=bool)
+	return tuple(numpy.concatenate(column) for column in zip(*pairs))
+
+
+# Build a table over some bounds from a list of buildings, into 'tableDir'
+def buildTable(buildingList, bounds, multiplier, tableDir, processes=None, inputs=None):
+	topLeftCell, size = buildObstructionMask.cellGrid(bounds)
+	maxRange = fcdCrop.maxRadioRange*multiplier
+	# Distance across one cell (its diagonal), from the top-left corner, so that any two points in range have their cells in the table
+	cellDiagonal = float(haversineDistance(topLeftCell[0]/3600, (topLeftCell[1]+1)/3600, (topLeftCell[0]+1)/3600, topLeftCell[1]/3600))
+	tableRange = maxRange + cellDiagonal
+
+	# Half-size of the window of cells around a cell that can be in range
+	latitude = math.radians(max(abs(bounds[2]), abs(bounds[3])))
+	cellHeight = float(haversineDistance(0.0, 0.0, 0.0, 1/3600))
+	window = (int(math.ceil(tableRange/(cellHeight*math.cos(latitude))))+1, int(math.ceil(tableRange/cellHeight))+1)
+
+	obstructed = buildObstructionMask.rasterizeBuildings(buildingList, topLeftCell, size)
+	state = {'topLeftCell': topLeftCell, 'size': size, 'tableRange': tableRange, 'window': window, 'edgeIndex': EdgeIndex(buildingList, topLeftCell, size), 'obstructed': obstructed}
+
+	# Build rows in chunks, each pair once, then mirror the pairs
+	cells = size[0]*size[1]
+	processes = processes if processes is not None else multiprocessing.cpu_count()
+	chunks = [(firstCell, min(firstCell+size[0], cells)) for firstCell in range(0, cells, size[0])]
+	if processes > 1:
+		with multiprocessing.Pool(processes, initializer=initializeBuild, initargs=(state,)) as pool:
+			results = pool.starmap(buildRows, chunks)
+	else:
+		initializeBuild(state)
+		results = [buildRows(*chunk) for chunk in chunks]
+	sources, neighbors, distance, lineOfSight = (numpy.concatenate(column) for column in zip(*results))
+	sources, neighbors = numpy.concatenate([sources, neighbors]), numpy.concatenate([neighbors, sources])
+	distance, lineOfSight = numpy.concatenate([distance, distance]), numpy.concatenate([lineOfSight, lineOfSight])
+	order = numpy.lexsort((neighbors, sources))
+
+	arrays = {
+		'indptr': numpy.concatenate([[0], numpy.cumsum(numpy.bincount(sources, minlength=cells))]).astype(numpy.int64),
+		'neighbors': neighbors[order].astype(numpy.int32),
+		'distance': distance[order].astype(numpy.float32),
+		'lineOfSight': lineOfSight[order],
+		'signal': signalLevel(distance[order], lineOfSight[order], multiplier),
+		'obstructed': obstructed,
+	}
+	grid = {'topLeftCell': topLeftCell, 'size': size, 'multiplier': multiplier, 'maxRange': maxRange, 'tableRange': tableRange, 'bounds': bounds, 'inputs': inputs}
+
+	# Write to a temporary folder and move it into place
+	temporaryDir = "{:s}.{:d}.tmp".format(tableDir.rstrip(os.sep), os.getpid())
+	shutil.rmtree(temporaryDir, ignore_errors=True)
+	os.makedirs(temporaryDir)
+	for arrayName, array in arrays.items():
+		numpy.save(os.path.join(temporaryDir, arrayName + '.npy'), array)
+	with open(os.path.join(temporaryDir, gridFile), 'w') as gridFileHandle:
+		json.dump(grid, gridFileHandle)
+	shutil.rmtree(tableDir, ignore_errors=True)
+	os.rename(temporaryDir, tableDir)
+	return len(order)
+
+
+class LOSTable:
+	def __init__(self, tableDir=defaultTableDir):
+		with open(os.path.join(tableDir, gridFile), 'r') as gridFileHandle:
+			self.grid = json.load(gridFileHandle)
+		self.topLeftCell = tuple(self.grid['topLeftCell'])
+		self.size = tuple(self.grid['size'])
+		self.multiplier = self.grid['multiplier']
+		self.maxRange = self.grid['maxRange']
+		arrays = {arrayName: numpy.load(os.path.join(tableDir, arrayName + '.npy'), mmap_mode='r') for arrayName in tableArrays}
+		self.indptr, self.neighbors, self.distances = arrays['indptr'], arrays['neighbors'], arrays['distance']
+		self.sightLines, self.signals, self.obstructedCells = arrays['lineOfSight'], arrays['signal'], arrays['obstructed']
+
+	# Index of the cell of a point, or None outside the grid
+	def cell(self, x, y):
+		column = int(math.floor(x*3600)) - self.topLeftCell[0]
+		row = self.topLeftCell[1] - int(math.floor(y*3600))
+		if not (0 <= column < self.size[0] and 0 <= row < self.size[1]):
+			return None
+		return row*self.size[0] + column
+
+	# Position of the pair of two cells in the table, or None if they are not in range
+	def pair(self, source, neighbor):
+		start, end = int(self.indptr[source]), int(self.indptr[source+1])
+		position = start + int(numpy.searchsorted(self.neighbors[start:end], neighbor))
+		return position if position < end and self.neighbors[position] == neighbor else None
+
+	# Line-of-sight between two points (between the centers of their cells), or None if not in the table
+	def lineOfSight(self, x1, y1, x2, y2):
+		source, neighbor = self.cell(x1, y1), self.cell(x2, y2)
+		if source is None or neighbor is None:
+			return None
+		if source == neighbor:
+			return not bool(self.obstructedCells.flat[source])
+		position = self.pair(source, neighbor)
+		return bool(self.sightLines[position]) if position is not None else None
+
+	# Signal level between two points, from their distance and the table's line-of-sight (None if not in the table)
+	def signal(self, x1, y1, x2, y2):
+		distance = float(haversineDistance(x1, y1, x2, y2))
+		if distance >= self.maxRange:
+			return 0
+		lineOfSight = self.lineOfSight(x1, y1, x2, y2)
+		return int(signalLevel(distance, lineOfSight, self.multiplier)) if lineOfSight is not None else None
+
+	# Cells in range of a point: (cell x, cell y, distance, lineOfSight, signal) for the pairs of its cell
+	def within(self, x, y):
+		source = self.cell(x, y)
+		if source is None:
+			return []
+		start, end = int(self.indptr[source]), int(self.indptr[source+1])
+		rows, columns = numpy.divmod(numpy.asarray(self.neighbors[start:end]), self.size[0])
+		inRange = numpy.asarray(self.distances[start:end]) < self.maxRange
+		return [(self.topLeftCell[0]+int(column), self.topLeftCell[1]-int(row), float(distance), bool(lineOfSight), int(signal))
+			for column, row, distance, lineOfSight, signal, keep in zip(columns, rows, self.distances[start:end], self.sightLines[start:end], self.signals[start:end], inRange) if keep]
+
+	def obstruction(self, x, y):
+		source = self.cell(x, y)
+		return bool(self.obstructedCells.flat[source]) if source is not None else None
+
+	# Answer a request line of the server protocol
+	def answer(self, request):
+		fields = request.split()
+		try:
+			command, coordinates = fields[0], [float(field) for field in fields[1:]]
+			if command == 'los' and len(coordinates) == 4:
+				lineOfSight = self.lineOfSight(*coordinates)
+				return '-' if lineOfSight is None else str(int(lineOfSight))
+			elif command == 'signal' and len(coordinates) == 4:
+				signal = self.signal(*coordinates)
+				return '-' if signal is None else str(signal)
+			elif command == 'within' and len(coordinates) == 2:
+				return " ".join("{:d};{:d};{:.2f};{:d};{:d}".format(cellX, cellY, distance, int(lineOfSight), signal) for cellX, cellY, distance, lineOfSight, signal in self.within(*coordinates))
+			elif command == 'obstruction' and len(coordinates) == 2:
+				obstruction = self.obstruction(*coordinates)
+				return '-' if obstruction is None else str(int(obstruction))
+		except (IndexError, ValueError):
+			pass
+		return "error Unknown request '{:s}'.".format(request.strip())
+
+
+class LOSRequestHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		for request in self.rfile:
+			self.wfile.write((self.server.table.answer(request.decode()) + "\n").encode())
+
+
+class LOSServer(socketserver.ThreadingTCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, table, port=defaultPort):
+		self.table = table
+		socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', port), LOSRequestHandler)
+
+
+# Inputs a table is built from, to tell whether it is up to date
+def tableInputs(shapefile, bounds, multiplier):
+	inputsDigest = hashlib.sha1()
+	inputsDigest.update(repr(([resultCache.fileDigest(file) for file in buildings.shapefilePaths(shapefile)], bounds, multiplier, buildings.buildingFeatureType)).encode())
+	return inputsDigest.hexdigest()
+
+
+# Time line-of-sight queries on random pairs of the table: straight from the table, through the server, and
+# (if the GIS server is reachable) through PostGIS, as GIS.checkForLineOfSight runs them. Prints a summary.
+def benchmark(table, gisConfig, samples=1000, port=defaultPort, seed=0):
+	random = numpy.random.RandomState(seed)
+	sources = random.randint(0, table.size[0]*table.size[1], samples)
+	sources = sources[numpy.asarray(table.indptr[sources+1]) > numpy.asarray(table.indptr[sources])]
+	positions = numpy.asarray(table.indptr[sources]) + (random.random_sample(len(sources)) * (numpy.asarray(table.indptr[sources+1]) - numpy.asarray(table.indptr[sources]))).astype(numpy.int64)
+	neighbors = numpy.asarray(table.neighbors[positions])
+	center = lambda cell: ((table.topLeftCell[0] + int(cell) % table.size[0] + 0.5)/3600, (table.topLeftCell[1] - int(cell) // table.size[0] + 0.5)/3600)
+	segments = [center(source) + center(neighbor) for source, neighbor in zip(sources, neighbors)]
+	results = []
+
+	startTime = time.time()
+	tableLineOfSight = [table.lineOfSight(*segment) for segment in segments]
+	results.append(('table', time.time()-startTime, 1.0))
+
+	server = LOSServer(table, port)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	with socket.create_connection(('127.0.0.1', port)) as connection:
+		connectionFile = connection.makefile('rwb')
+		startTime = time.time()
+		serverLineOfSight = []
+		for segment in segments:
+			connectionFile.write("los {!r} {!r} {!r} {!r}\n".format(*segment).encode())
+			connectionFile.flush()
+			serverLineOfSight.append(connectionFile.readline().decode().strip() == '1')
+		results.append(('server', time.time()-startTime, numpy.mean(numpy.array(serverLineOfSight) == numpy.array(tableLineOfSight))))
+	server.shutdown()
+	server.server_close()
+
+	# One psql session, as gissumo keeps one connection; its startup time is measured separately and left out
+	psqlEnvironment = dict(os.environ, PGPASSWORD=str(gisConfig.get('password', '')))
+	psqlCommand = ['psql', '--host', str(gisConfig.get('host', 'localhost')), '--port', str(gisConfig.get('port', 5432)), '--username', str(gisConfig.get('user', '')),
+		'--dbname', str(gisConfig.get('database', 'gisdb0')), '--tuples-only', '--no-align', '--quiet', '--set', 'ON_ERROR_STOP=1']
+	queries = "".join("SELECT COUNT(id) FROM buildings WHERE ST_Intersects(geom, ST_GeomFromText('LINESTRING({!r} {!r},{!r} {!r})',4326)) and feattyp='{:d}';\n".format(*segment, buildings.buildingFeatureType) for segment in segments)
+	try:
+		startTime = time.time()
+		subprocess.run(psqlCommand, input=b"SELECT 1;\n", env=psqlEnvironment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60, check=True)
+		sessionTime = time.time()-startTime
+		startTime = time.time()
+		output = subprocess.run(psqlCommand, input=queries.encode(), env=psqlEnvironment, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=3600, check=True).stdout
+		postgisTime = max(time.time()-startTime-sessionTime, 0.0)
+		postgisLineOfSight = [int(count) == 0 for count in output.decode().split()]
+		if len(postgisLineOfSight) != len(segments):
+			raise ValueError("PostGIS answered {:d} of {:d} queries.".format(len(postgisLineOfSight), len(segments)))
+		results.append(('postgis', postgisTime, numpy.mean(numpy.array(postgisLineOfSight) == numpy.array(tableLineOfSight))))
+	except (OSError, ValueError, subprocess.SubprocessError):
+		print("Warning: Could not query PostGIS, leaving it out of the benchmark.")
+
+	print("path\tqueries\ttotalTime\tmicrosecondsPerQuery\tagreement")
+	for path, elapsedTime, agreement in results:
+		print("{:s}\t{:d}\t{:.3f}\t{:.1f}\t{:.4f}".format(path, len(segments), elapsedTime, elapsedTime/max(len(segments), 1)*1e6, agreement))
+
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage="%prog [options] build\n       %prog [options] serve\n       %prog [options] query [los|signal|within|obstruction] [coordinates...]\n       %prog [options] bench")
+	parser.add_option("-c", "--config", dest="configFile", default="config.plist", help="take 'innerBounds', 'rangeMultiplier' and 'gis' from configuration file [default: %default]", metavar="FILE")
+	parser.add_option("-s", "--shapefile", dest="shapefile", default=buildings.defaultShapefile, help="building shapefile, with or without .shp [default: %default]", metavar="FILE")
+	parser.add_option("-o", "--table", dest="tableDir", default=defaultTableDir, help="table folder [default: %default]", metavar="DIR")
+	parser.add_option("-p", "--processes", dest="processes", type="int", default=None, help="number of processes building the table (default: one per core)", metavar="N")
+	parser.add_option("--port", dest="port", type="int", default=defaultPort, help="local port of the query server [default: %default]", metavar="N")
+	parser.add_option("--samples", dest="samples", type="int", default=1000, help="number of queries to benchmark [default: %default]", metavar="N")
+	parser.add_option("--rebuild", dest="rebuild", action="store_true", default=False, help="build the table even if it is up to date")
+	# Options go before the command, so that negative coordinates are not taken for options
+	parser.disable_interspersed_args()
+	(options, args) = parser.parse_args()
+
+	if len(args) == 0 or args[0] not in ['build', 'serve', 'query', 'bench']:
+		parser.print_usage()
+		sys.exit(1)
+	command, args = args[0], args[1:]
+
+	configDict = {}
+	if os.path.isfile(options.configFile):
+		with open(options.configFile, 'rb') as configFileHandle:
+			configDict = plistlib.load(configFileHandle, fmt=plistlib.FMT_XML)
+
+	if command == 'build':
+		multiplier = float(configDict.get('rangeMultiplier', 1.0))
+		bounds, _ = fcdCrop.cropParameters(configDict, fcdCrop.maxRadioRange*multiplier)
+		if bounds is None:
+			print("Error: Please provide a configuration file with 'innerBounds'.")
+			sys.exit(1)
+		try:
+			inputs = tableInputs(options.shapefile, bounds, multiplier)
+			if not options.rebuild and os.path.isfile(os.path.join(options.tableDir, gridFile)) and LOSTable(options.tableDir).grid['inputs'] == inputs:
+				print("Table {:s} is up to date.".format(options.tableDir))
+				sys.exit(0)
+			startTime = time.time()
+			buildingList = buildings.readBuildings(options.shapefile)
+			pairs = buildTable(buildingList, bounds, multiplier, options.tableDir, options.processes, inputs)
+		except (OSError, ValueError) as error:
+			print("Error:", error)
+			sys.exit(1)
+		table = LOSTable(options.tableDir)
+		tableBytes = sum(os.path.getsize(os.path.join(options.tableDir, arrayName + '.npy')) for arrayName in tableArrays)
+		print("Built {:s}: {:d}x{:d} cells, {:d} pairs ({:.1f}% in line-of-sight), {:.1f} MB, from {:d} buildings in {:.1f}s.".format(options.tableDir, table.size[0], table.size[1], pairs, 100*float(numpy.mean(table.sightLines)) if pairs else 0.0, tableBytes/1e6, len(buildingList), time.time()-startTime))
+		sys.exit(0)
+
+	try:
+		table = LOSTable(options.tableDir)
+	except (OSError, ValueError) as error:
+		print("Error: Unable to load table, build it first:", error)
+		sys.exit(1)
+
+	if command == 'serve':
+		server = LOSServer(table, options.port)
+		print("Serving {:s} on 127.0.0.1:{:d}.".format(options.tableDir, options.port), flush=True)
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			server.server_close()
+
+	elif command == 'query':
+		reply = table.answer(" ".join(args))
+		print(reply)
+		if reply.startswith('error'):
+			sys.exit(1)
+
+	elif command == 'bench':
+		benchmark(table, configDict.get('gis', {}), options.samples, options.port)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# This script runs simulation sets over a grid of configuration parameters. Every (configuration, floating car data file) pair in the grid goes through one shared pool of workers, so no cores sit idle between sets.
+#
+# Parameters are given as '[label:]key.path=value1,value2,...', e.g.:
+#   ./parameterSweep.py -p wsat:decision.algorithm.WeightedProductModel.wsat=0.1,0.5,1.0 -p rmulti:rangeMultiplier=0.5,1.0
+# Each combination of values is stored in 'simulationsets/simulations_<label>_<value>[_<label>_<value>...]'.
+
+import copy
+import itertools
+import optparse
+import os
+import plistlib
+import shutil
+import sqlite3
+import sys
+
+import convergence
+import descriptionGenerator
+import fcdCrop
+import resultCache
+import resultIndex
+import runtimeHistory
+import simulationPool
+import workerTelemetry
+
+# Requires Python >3.5
+assert sys.version_info >= (3,5)
+
+
+simulationDir = "simulations"
+simulationSetDir = "simulationsets"
+floatingCarDataDir = "fcddata"
+historyFile = "simulationHistory.json"
+# Entries of a set's description, for indexing
+setDescriptionJSON = "description.json"
+# Upper bound on the number of workers, see 01simulateParallel
+maxThreads = 5
+
+
+# Convert a value from the command line to an integer, real, boolean or string
+def parseValue(valueString):
+	for valueType in (int, float):
+		try:
+			return valueType(valueString)
+		except ValueError:
+			pass
+	if valueString.lower() in ('true', 'false'):
+		return valueString.lower() == 'true'
+	return valueString
+
+
+# Format a value for a simulation set folder name, as the individual sweep scripts did
+def formatValue(value):
+	if isinstance(value, bool):
+		return str(value).lower()
+	elif isinstance(value, int):
+		return "{:d}".format(value)
+	elif isinstance(value, float):
+		return "{:f}".format(value)
+	return str(value)
+
+
+# Parse a '[label:]key.path=value1,value2,...' parameter into (label, key path, values)
+# The label defaults to the last component of the key path
+def parseParameter(parameterString):
+	if '=' not in parameterString:
+		raise ValueError("Missing '=' in parameter '{:s}'.".format(parameterString))
+	keyString, valuesString = parameterString.split('=', 1)
+	if ':' in keyString:
+		label, keyString = keyString.split(':', 1)
+	else:
+		label = keyString.split('.')[-1]
+	return label, keyString.split('.'), [parseValue(value) for value in valuesString.split(',') if value]
+
+
+# Convert a parsed value to the type of the configuration entry it replaces, so that e.g. '1' stays a
+# <real> for a real-valued key (gissumo reads entries with 'as? Double')
+def coerceValue(value, existingValue, keyPath):
+	keyName = '.'.join(keyPath)
+	if isinstance(existingValue, bool):
+		if not isinstance(value, bool):
+			raise ValueError("Configuration key '{:s}' takes true or false, not '{}'.".format(keyName, value))
+		return value
+	if isinstance(existingValue, float):
+		if isinstance(value, bool) or not isinstance(value, (int, float)):
+			raise ValueError("Configuration key '{:s}' takes a real number, not '{}'.".format(keyName, value))
+		return float(value)
+	if isinstance(existingValue, int):
+		if isinstance(value, bool) or not isinstance(value, (int, float)) or not float(value).is_integer():
+			raise ValueError("Configuration key '{:s}' takes an integer, not '{}'.".format(keyName, value))
+		return int(value)
+	if isinstance(existingValue, str):
+		return formatValue(value) if isinstance(value, bool) else str(value)
+	return value
+
+
+# Set an existing configuration entry, returning the value set (converted to the entry's type)
+def setNestedEntry(configDict, keyPath, value):
+	for key in keyPath[:-1]:
+		configDict = configDict[key]
+	if keyPath[-1] not in configDict:
+		raise KeyError("Unknown configuration key '{:s}'.".format('.'.join(keyPath)))
+	value = coerceValue(value, configDict[keyPath[-1]], keyPath)
+	configDict[keyPath[-1]] = value
+	return value
+
+
+# Expand a grid of parameters into (set folder name, configuration, [(label, value), ...]) tuples
+def expandGrid(parameters, templateConfig):
+	simulationSets = []
+	for values in itertools.product(*[parameterValues for (_, _, parameterValues) in parameters]):
+		configDict = copy.deepcopy(templateConfig)
+		setName = simulationDir
+		setValues = []
+		for (label, keyPath, _), value in zip(parameters, values):
+			value = setNestedEntry(configDict, keyPath, value)
+			setName += "_{:s}_{:s}".format(label, formatValue(value))
+			setValues.append((label, value))
+		simulationSets.append((setName, configDict, setValues))
+	return simulationSets
+
+
+# Append the description of a set's configuration, with a compiled 'descriptionGenerator' template if available
+# (also writing its entries to 'description.json'), or a 'label: value' line per parameter otherwise
+def describeSet(setDir, configDict, setValues, template):
+	descriptionFile = os.path.join(setDir, simulationPool.simulationDescription)
+	if template is not None:
+		try:
+			description = template.describe(configDict)
+		except KeyError as error:
+			# Don't stop the sweep over a description
+			print("Warning: Could not describe set {:s}: {:s}".format(setDir, error.args[0]), flush=True)
+			return
+		with open(descriptionFile, 'a') as descriptionFp:
+			descriptionFp.write(description)
+		with open(os.path.join(setDir, setDescriptionJSON), 'w') as descriptionJSONFp:
+			descriptionJSONFp.write(template.describeJSON(configDict) + "\n")
+	else:
+		with open(descriptionFile, 'a') as descriptionFp:
+			for label, value in setValues:
+				descriptionFp.write("{:s}: {:s}\n".format(label, formatValue(value)))
+
+
+# Record a finished set's simulations in the result index
+def indexSet(index, setDir, descriptionTemplate):
+	try:
+		index.indexSet(setDir, descriptionTemplate if os.path.isfile(descriptionTemplate) else resultIndex.defaultTemplate)
+	except (OSError, sqlite3.Error) as error:
+		# Don't stop the sweep over the index either
+		print("Warning: Could not index set {:s}: {:s}".format(setDir, str(error)), flush=True)
+
+
+# Wrap up a finished set
+def finishSet(simulationSet, setValues, template, descriptionTemplate, index):
+	describeSet(simulationSet.setDir, simulationSet.configDict, setValues, template)
+	if index is not None:
+		indexSet(index, simulationSet.setDir, descriptionTemplate)
+
+
+def main(argv):
+	parser = optparse.OptionParser(usage="%prog -p [label:]key.path=value1,value2,... [-p ...] [options]")
+	parser.add_option("-p", "--param", dest="parameters", action="append", default=[], help="sweep a configuration parameter over a list of values", metavar="PARAM")
+	parser.add_option("-c", "--config", dest="configFile", default="config.template.plist", help="reference configuration file", metavar="FILE")
+	parser.add_option("-t", "--template", dest="templateFile", default="description.template", help="description template for each set", metavar="FILE")
+	parser.add_option("--overwrite", action="store_true", default=False, help="erase previous simulation sets")
+	parser.add_option("--append", action="store_true", default=False, help="add to previous simulation sets, skipping existing ones")
+	parser.add_option("--fifo", action="store_true", default=False, help="feed compressed FCD files through named pipes")
+	parser.add_option("--no-cache", dest="useResultCache", action="store_false", default=True, help="always simulate, ignoring the result cache")
+	parser.add_option("--no-index", dest="useResultIndex", action="store_false", default=True, help="don't record finished sets in the result index")
+	parser.add_option("--crop", dest="useFcdCrop", action="store_true", default=False, help="crop the FCD files to each set's 'stopTime' and 'innerBounds' (see fcdCrop; changes the results)")
+	parser.add_option("--crop-margin", dest="cropMargin", type="float", default=None, help="margin around 'innerBounds' kept when cropping, in meters (default: the maximum radio range)", metavar="M")
+	parser.add_option("--converge", dest="converge", type="float", default=None, help="stop each set once the 95% confidence intervals of its key metrics are within this fraction of their means", metavar="FRACTION")
+	parser.add_option("--no-telemetry", dest="useTelemetry", action="store_false", default=True, help="don't sample the resource use of simulations")
+	parser.add_option("--telemetry-interval", dest="telemetryInterval", type="float", default=1.0, help="seconds between resource samples [default: %default]", metavar="S")
+	parser.add_option("--min-replications", dest="minReplications", type="int", default=5, help="simulations each set runs before it can converge [default: %default]", metavar="N")
+	(options, args) = parser.parse_args(argv)
+
+	if len(options.parameters) == 0:
+		print("Error: Please specify at least one parameter to sweep.")
+		sys.exit(1)
+
+	try:
+		parameters = [parseParameter(parameterString) for parameterString in options.parameters]
+	except ValueError as error:
+		print("Error:", error)
+		sys.exit(1)
+
+	if os.path.isdir(simulationSetDir):
+		if options.overwrite:
+			shutil.rmtree(simulationSetDir)
+		elif options.append:
+			pass
+		else:
+			print("Error: Folder with previous simulation sets exists, move it before proceeding.")
+			print("Specify --overwrite on the command line to clear folder.")
+			print("Specify --append to use the existing folder.")
+			sys.exit(1)
+
+	if not os.path.isfile(options.configFile):
+		print("Error: Please provide a reference configuration file.")
+		sys.exit(1)
+
+	if not os.path.isdir(floatingCarDataDir):
+		print("Error: No floating car data directory.")
+		sys.exit(1)
+
+	if not os.path.isfile('obstructionMask.payload'):
+		print("Error: Please generate and provide an obstruction mask file (see buildObstructionMask.py).")
+		sys.exit(1)
+
+	with open(options.configFile, 'rb') as configFileHandle:
+		templateConfig = plistlib.load(configFileHandle, fmt=plistlib.FMT_XML)
+
+	try:
+		simulationSets = expandGrid(parameters, templateConfig)
+	except (KeyError, ValueError) as error:
+		print("Error:", error.args[0])
+		sys.exit(1)
+
+	# Pull the latest binary
+	shutil.copy('../../build/gissumo_fast','./')
+
+	# Create the simulation set directory
+	os.makedirs(simulationSetDir, exist_ok=True)
+
+	index = resultIndex.ResultIndex() if options.useResultIndex else None
+	template = descriptionGenerator.readTemplate(options.templateFile) if os.path.isfile(options.templateFile) else None
+
+	workers = simulationPool.workerCount(maxThreads, templateConfig['gis'])
+	cache = resultCache.ResultCache() if options.useResultCache else None
+	cropCache = fcdCrop.CropCache(digest=cache.digest if cache is not None else resultCache.fileDigest) if options.useFcdCrop else None
+
+	# Expand the grid into (configuration, floating car data file) jobs
+	fcdFiles = simulationPool.findFcdFiles(floatingCarDataDir)
+	simulationJobs = []
+	for setName, configDict, setValues in simulationSets:
+		setDir = os.path.join(simulationSetDir, setName)
+		if os.path.isdir(setDir):
+			print("Skipping existing set {:s}.".format(setName))
+			continue
+		os.makedirs(setDir)
+
+		onFinished = lambda simulationSet, setValues=setValues: finishSet(simulationSet, setValues, template, options.templateFile, index)
+		try:
+			monitor = convergence.ConvergenceMonitor(configDict, options.converge, options.minReplications) if options.converge is not None else None
+		except ValueError as error:
+			print("Error: Set {:s}: {:s}".format(setName, str(error)))
+			sys.exit(1)
+		simulationSet = simulationPool.SimulationSet(setDir, configDict, onFinished=onFinished, convergence=monitor)
+		# Sets crop to their own stop time and bounds; sets sharing them share the cropped files
+		setFcdFiles = fcdFiles
+		if cropCache is not None:
+			cropBox, cropStopTime = fcdCrop.cropParameters(configDict, options.cropMargin)
+			setFcdFiles = cropCache.cropAll(fcdFiles, cropBox, cropStopTime, workers)
+		simulationJobs += [simulationPool.SimulationJob(simulationSet, fcdFile) for fcdFile in setFcdFiles]
+
+	print("Sweeping {:d} sets, {:d} simulations.".format(len(simulationSets), len(simulationJobs)), flush=True)
+
+	if cropCache is not None:
+		cropCache.report()
+
+	# Run every simulation through a single pool
+	telemetry = workerTelemetry.WorkerTelemetry(options.telemetryInterval) if options.useTelemetry else None
+	pool = simulationPool.SimulationPool(workers, runtimeHistory.RuntimeHistory(historyFile), useNamedPipes=options.fifo, cache=cache, telemetry=telemetry)
+	pool.run(simulationJobs)
+
+	# Clean up
+	os.remove('gissumo_fast')
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
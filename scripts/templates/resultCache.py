@@ -0,0 +1,199 @@
+# This module keeps a content-addressed cache of simulation results. A result is keyed by the configuration
+# (without path-only keys), the floating car data file contents, the simulator binary and the obstruction
+# mask the statistics are masked with ('stats.obstructionMaskFile'), so re-running an
+# identical simulation can reuse the previous 'stats' folder instead of simulating again.
+#
+# Each entry is a folder '<cacheDir>/<key>/' holding a copy of the 'stats' folder and an 'entry.json' with
+# the original wall-time and usage times. Results are placed and taken by hardlink wherever possible, so
+# cached files must be treated as read-only (parsers only ever create new files next to them).
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import runtimeHistory
+
+
+# Default cache location, shared by every study on this machine
+defaultCacheDir = os.environ.get('GISSUMO_RESULT_CACHE', os.path.expanduser('~/.cache/gissumo/results'))
+# Entries unused for longer than this are evicted
+defaultMaxAge = 30*24*3600
+# The cache is trimmed to this size, least recently used entries first
+defaultMaxBytes = 20*(1<<30)
+
+entryFile = 'entry.json'
+digestFile = 'digests.json'
+sweepLogFile = 'sweeps.log'
+
+
+# Hash a file's contents
+def fileDigest(filename):
+	digest = hashlib.sha1()
+	with open(filename, 'rb') as fileHandle:
+		for chunk in iter(lambda: fileHandle.read(1<<20), b''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+# Replicate a folder tree, hardlinking files (or copying them, across filesystems)
+def linkTree(sourceDir, destinationDir):
+	shutil.copytree(sourceDir, destinationDir, copy_function=linkOrCopy)
+
+
+def linkOrCopy(source, destination):
+	try:
+		os.link(source, destination)
+	except OSError:
+		shutil.copy2(source, destination)
+
+
+# Size of a folder tree, in bytes
+def treeSize(directory):
+	totalSize = 0
+	for dirpath, dirnames, filenames in os.walk(directory):
+		for file in filenames:
+			totalSize += os.path.getsize(os.path.join(dirpath, file))
+	return totalSize
+
+
+class ResultCache:
+	def __init__(self, cacheDir=defaultCacheDir, maxAge=defaultMaxAge, maxBytes=defaultMaxBytes):
+		self.cacheDir = cacheDir
+		self.maxAge = maxAge
+		self.maxBytes = maxBytes
+		os.makedirs(cacheDir, exist_ok=True)
+
+		# File digests, cached by path, size and modification time
+		self.fileDigests = {}
+		digestFilePath = os.path.join(cacheDir, digestFile)
+		if os.path.isfile(digestFilePath):
+			try:
+				with open(digestFilePath, 'r') as digestFileHandle:
+					self.fileDigests = json.load(digestFileHandle)
+			except ValueError:
+				pass
+
+		# Statistics for this sweep
+		self.hits = 0
+		self.misses = 0
+		self.savedTime = 0.0
+
+	def saveDigests(self):
+		digestFilePath = os.path.join(self.cacheDir, digestFile)
+		temporaryFile = "{:s}.{:d}.tmp".format(digestFilePath, os.getpid())
+		with open(temporaryFile, 'w') as digestFileHandle:
+			json.dump(self.fileDigests, digestFileHandle)
+		os.replace(temporaryFile, digestFilePath)
+
+	# Digest of a file's contents, only rehashed when the file changes
+	def digest(self, filename):
+		fileStat = os.stat(filename)
+		fileKey = "{:s}:{:d}:{:d}".format(os.path.abspath(filename), fileStat.st_size, fileStat.st_mtime_ns)
+		if fileKey not in self.fileDigests:
+			self.fileDigests[fileKey] = fileDigest(filename)
+			self.saveDigests()
+		return self.fileDigests[fileKey]
+
+	# Cache key of a simulation
+	def key(self, configDict, fcdFile, binary):
+		keyDigest = hashlib.sha1()
+		keyDigest.update(runtimeHistory.configDigest(configDict).encode())
+		keyDigest.update(self.digest(fcdFile).encode())
+		keyDigest.update(self.digest(binary).encode())
+		# Coverage and saturation statistics are masked with the obstruction mask, read relative to where the simulator runs
+		maskFile = configDict.get('stats', {}).get('obstructionMaskFile')
+		keyDigest.update((self.digest(maskFile) if maskFile is not None and os.path.isfile(maskFile) else 'noMask').encode())
+		return keyDigest.hexdigest()
+
+	def entryDir(self, key):
+		return os.path.join(self.cacheDir, key)
+
+	def readEntry(self, key):
+		with open(os.path.join(self.entryDir(key), entryFile), 'r') as entryFileHandle:
+			return json.load(entryFileHandle)
+
+	def writeEntry(self, key, entry):
+		entryFilePath = os.path.join(self.entryDir(key), entryFile)
+		temporaryFile = "{:s}.{:d}.tmp".format(entryFilePath, os.getpid())
+		with open(temporaryFile, 'w') as entryFileHandle:
+			json.dump(entry, entryFileHandle)
+		os.replace(temporaryFile, entryFilePath)
+
+	# Place a cached 'stats' folder at 'statsDir'. Returns the entry's original wall-time, or None on a miss.
+	def fetch(self, key, statsDir):
+		try:
+			entry = self.readEntry(key)
+			linkTree(os.path.join(self.entryDir(key), 'stats'), statsDir)
+		except (OSError, ValueError):
+			# Missing or broken entry, discard any partial copy
+			shutil.rmtree(statsDir, ignore_errors=True)
+			self.misses += 1
+			return None
+
+		entry['lastUsed'] = time.time()
+		entry['hits'] = entry.get('hits', 0) + 1
+		self.writeEntry(key, entry)
+
+		self.hits += 1
+		self.savedTime += entry['wallTime']
+		return entry['wallTime']
+
+	# Store a simulation's 'stats' folder, going through a temporary folder so that
+	# concurrent sweeps never see a partial entry
+	def store(self, key, statsDir, wallTime, name):
+		if not os.path.isdir(statsDir) or os.path.isdir(self.entryDir(key)):
+			return
+
+		temporaryDir = "{:s}.{:d}.tmp".format(self.entryDir(key), os.getpid())
+		shutil.rmtree(temporaryDir, ignore_errors=True)
+		try:
+			linkTree(statsDir, os.path.join(temporaryDir, 'stats'))
+			now = time.time()
+			entry = {'name': name, 'wallTime': wallTime, 'created': now, 'lastUsed': now, 'hits': 0, 'size': treeSize(temporaryDir)}
+			with open(os.path.join(temporaryDir, entryFile), 'w') as entryFileHandle:
+				json.dump(entry, entryFileHandle)
+			os.rename(temporaryDir, self.entryDir(key))
+		except OSError:
+			# Another sweep got there first, or the cache is unwritable
+			shutil.rmtree(temporaryDir, ignore_errors=True)
+
+	# Remove entries unused for longer than 'maxAge', then the least recently used
+	# entries until the cache fits in 'maxBytes'. Returns the number of entries removed.
+	def evict(self):
+		entries = []
+		for key in os.listdir(self.cacheDir):
+			if not os.path.isdir(self.entryDir(key)) or key.endswith('.tmp'):
+				continue
+			try:
+				entry = self.readEntry(key)
+			except (OSError, ValueError):
+				entry = {'lastUsed': 0.0, 'size': treeSize(self.entryDir(key))}
+			entries.append((entry['lastUsed'], entry['size'], key))
+		entries.sort()
+
+		now = time.time()
+		totalSize = sum(size for (_, size, _) in entries)
+		evictedEntries = 0
+		for lastUsed, size, key in entries:
+			if now-lastUsed <= self.maxAge and totalSize <= self.maxBytes:
+				break
+			shutil.rmtree(self.entryDir(key), ignore_errors=True)
+			totalSize -= size
+			evictedEntries += 1
+
+		# Forget digests of files that no longer exist
+		for fileKey in list(self.fileDigests.keys()):
+			if not os.path.exists(fileKey.rsplit(':', 2)[0]):
+				del self.fileDigests[fileKey]
+		self.saveDigests()
+
+		return evictedEntries
+
+	# Print and log the hits of this sweep
+	def report(self):
+		reportLine = "Result cache: {:d} hits, {:d} misses, saved {:d}h{:02d}m{:02d}s of simulation time.".format(self.hits, self.misses, int(self.savedTime/3600), int(self.savedTime%3600/60), int(self.savedTime%60))
+		print(reportLine, flush=True)
+		with open(os.path.join(self.cacheDir, sweepLogFile), 'a') as sweepLogHandle:
+			sweepLogHandle.write("{:s}\t{:s}\t{:d}\t{:d}\t{:.0f}\n".format(time.strftime('%Y-%m-%d %H:%M:%S'), os.getcwd(), self.hits, self.misses, self.savedTime))
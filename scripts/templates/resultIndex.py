@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# This module keeps an index of simulation results in a single SQLite database, shared by every study on this
+# machine, so that comparisons across sets and studies are a query instead of a walk over 'stats' folders.
+#
+# Each simulation is recorded with its set and study, its configuration parameters (the key paths listed in
+# the study's description template, read through descriptionGenerator), its wall-time (from the set's
+# 'runTimes.log', see simulationPool) and summary metrics taken from its statistics logs. Simulations are
+# only read again when their logs change, and sets are indexed as the sweep engine finishes them. The
+# database is in write-ahead-log mode, so sweeps and readers can use it at the same time.
+#
+# usage: ./resultIndex.py index [folders with simulation sets]
+#        ./resultIndex.py compare [metric] [parameter] [--study name] [--name pattern]
+#        ./resultIndex.py sql [query]
+
+import hashlib
+import json
+import math
+import optparse
+import os
+import plistlib
+import sqlite3
+import sys
+import time
+
+import descriptionGenerator
+import runtimeHistory
+import simulationPool
+
+# Statistics logs are read through their columnar copies
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'parsers'))
+import statsCache
+
+# Requires Python >3.5
+assert sys.version_info >= (3,5)
+
+
+# Default database, shared by every study on this machine
+defaultDatabase = os.environ.get('GISSUMO_RESULT_INDEX', os.path.expanduser('~/.cache/gissumo/results.sqlite'))
+defaultTemplate = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'description.template')
+
+# Summary metrics of a column of a statistics log: (metric, log, column, reduction)
+summaryMetrics = [
+	('meanVehicles', 'entityCount.log', 'vehicles', 'mean'),
+	('finalRoadsideUnits', 'entityCount.log', 'roadsideUnits', 'last'),
+	('maxRoadsideUnits', 'entityCount.log', 'roadsideUnits', 'max'),
+	('finalParkedCars', 'entityCount.log', 'parkedCars', 'last'),
+	('finalCoveredCells', 'cityCoverageEvolution.log', '#covered', 'last'),
+	('meanCoveredCells', 'cityCoverageEvolution.log', '#covered', 'mean'),
+	('finalPercentCovered', 'cityCoverageEvolution.log', '%covered', 'last'),
+	('meanPercentCovered', 'cityCoverageEvolution.log', '%covered', 'mean'),
+	('finalMeanSignal', 'signalAndSaturationEvolution.log', 'meanSig', 'last'),
+	('meanSignal', 'signalAndSaturationEvolution.log', 'meanSig', 'mean'),
+	('meanSaturation', 'signalAndSaturationEvolution.log', 'meanSat', 'mean'),
+	('finalMeanSaturation', 'signalAndSaturationEvolution.log', 'meanSat', 'last'),
+	('finalSigToSat', 'signalAndSaturationEvolution.log', 'sigToSat', 'last'),
+	('parkedRoadsideUnits', 'parkedRoadsideUnitLifetime.log', 'lifetime', 'count'),
+	('meanParkedRoadsideUnitLifetime', 'parkedRoadsideUnitLifetime.log', 'lifetime', 'mean')
+]
+
+# Metrics of the final statistics logs, written as 'key<tab>value' lines: (metric prefix, log, keys)
+finalStatistics = [
+	('finalCoverage', 'finalCityCoverageStats.log', ['count', 'mean', 'stdev']),
+	('finalSaturation', 'finalCitySaturationStats.log', ['count', 'mean', 'stdev'])
+]
+
+schema = [
+	"CREATE TABLE IF NOT EXISTS sets (id INTEGER PRIMARY KEY, path TEXT UNIQUE, study TEXT, name TEXT, indexed REAL)",
+	"CREATE TABLE IF NOT EXISTS simulations (id INTEGER PRIMARY KEY, setId INTEGER REFERENCES sets(id), name TEXT, path TEXT UNIQUE, configDigest TEXT, wallTime REAL, source TEXT, signature TEXT)",
+	"CREATE TABLE IF NOT EXISTS parameters (simulationId INTEGER, key TEXT, value, PRIMARY KEY (simulationId, key)) WITHOUT ROWID",
+	"CREATE TABLE IF NOT EXISTS metrics (simulationId INTEGER, metric TEXT, value REAL, PRIMARY KEY (simulationId, metric)) WITHOUT ROWID",
+	"CREATE INDEX IF NOT EXISTS simulationsBySet ON simulations (setId)",
+	"CREATE INDEX IF NOT EXISTS parametersByKey ON parameters (key, value)",
+	"CREATE INDEX IF NOT EXISTS metricsByName ON metrics (metric, simulationId)"
+]
+
+
+# Folder of the study a set belongs to: the one holding 'simulationsets' (parameterSweep) or the set (01simulateParallel)
+def studyDir(setDir):
+	parentDir = os.path.dirname(os.path.abspath(setDir))
+	if os.path.basename(parentDir) == 'simulationsets':
+		return os.path.dirname(parentDir)
+	return parentDir
+
+
+# Simulation folders of a set: those with a configuration and a 'stats' folder
+def findSimulations(setDir):
+	return sorted(os.path.join(setDir, entry) for entry in os.listdir(setDir) if os.path.isfile(os.path.join(setDir, entry, 'config.plist')) and os.path.isdir(os.path.join(setDir, entry, 'stats')))
+
+
+# Find the simulation sets in a folder, not descending into simulations
+def findSets(folder):
+	setDirs = []
+	for dirpath, dirnames, filenames in os.walk(folder):
+		if any(os.path.isfile(os.path.join(dirpath, dirname, 'config.plist')) and os.path.isdir(os.path.join(dirpath, dirname, 'stats')) for dirname in dirnames):
+			setDirs.append(dirpath)
+			dirnames[:] = []
+	return sorted(setDirs)
+
+
+# Wall-time and source of each simulation in a set, from its 'runTimes.log'
+def readRunTimes(setDir):
+	runTimes = {}
+	runTimeLog = os.path.join(setDir, simulationPool.runTimeLog)
+	if os.path.isfile(runTimeLog):
+		with open(runTimeLog, 'r') as runTimeLogHandle:
+			for line in runTimeLogHandle.read().splitlines()[1:]:
+				fields = line.split('\t')
+				if len(fields) == 4:
+					runTimes[fields[0]] = (float(fields[1]), fields[3])
+	return runTimes
+
+
+# Logs a simulation's index entry is built from
+def sourceFiles(simulationDir):
+	statsDir = os.path.join(simulationDir, 'stats')
+	logNames = sorted(set([logName for (_, logName, _, _) in summaryMetrics] + [logName for (_, logName, _) in finalStatistics]))
+	return [os.path.join(simulationDir, 'config.plist'), os.path.join(simulationDir, 'gissumo.log')] + [os.path.join(statsDir, logName) for logName in logNames]
+
+
+# Signature of a simulation's logs, to tell when it must be read again. Logs are named relative to the
+# simulation folder, so the signature doesn't depend on how the folder was spelled.
+def simulationSignature(simulationDir, runTime):
+	signature = hashlib.sha1(repr(runTime).encode())
+	for sourceFile in sourceFiles(simulationDir):
+		if os.path.isfile(sourceFile):
+			sourceStat = os.stat(sourceFile)
+			signature.update("{:s}:{:d}:{:d}\n".format(os.path.relpath(sourceFile, simulationDir), sourceStat.st_size, sourceStat.st_mtime_ns).encode())
+	return signature.hexdigest()
+
+
+def reduceColumn(values, reduction):
+	if reduction == 'count':
+		return float(len(values))
+	if len(values) == 0:
+		return None
+	if reduction == 'last':
+		return float(values[-1])
+	if reduction == 'max':
+		return float(max(values))
+	return math.fsum(values)/len(values)
+
+
+# Summary metrics of a simulation, as a dictionary
+def simulationMetrics(simulationDir):
+	statsDir = os.path.join(simulationDir, 'stats')
+	metrics = {}
+
+	logNames = []
+	for _, logName, _, _ in summaryMetrics:
+		if logName not in logNames:
+			logNames.append(logName)
+	for logName in logNames:
+		logFile = os.path.join(statsDir, logName)
+		if not os.path.isfile(logFile):
+			continue
+		# Load every column the log has (memory-mapped, if cached), and look metrics up one by one below
+		try:
+			statsColumns = statsCache.load(logFile)
+		except (OSError, ValueError):
+			continue
+		for metric, metricLog, column, reduction in summaryMetrics:
+			if metricLog != logName:
+				continue
+			# A log missing a column (an older simulator, or a truncated header) only loses that metric
+			try:
+				value = reduceColumn(statsColumns.column(column).tolist(), reduction)
+			except (OSError, ValueError):
+				continue
+			if value is not None:
+				metrics[metric] = value
+
+	for metricPrefix, logName, keys in finalStatistics:
+		logFile = os.path.join(statsDir, logName)
+		if not os.path.isfile(logFile):
+			continue
+		with open(logFile, 'r') as logFileHandle:
+			for line in logFileHandle:
+				fields = line.rstrip('\n').split('\t')
+				if len(fields) == 2 and fields[0] in keys:
+					try:
+						metrics[metricPrefix + '.' + fields[0]] = float(fields[1])
+					except ValueError:
+						pass
+
+	# Simulated time, from the simulator's last words
+	gissumoLog = os.path.join(simulationDir, 'gissumo.log')
+	if os.path.isfile(gissumoLog):
+		with open(gissumoLog, 'rb') as gissumoLogHandle:
+			gissumoLogHandle.seek(max(os.path.getsize(gissumoLog)-4096, 0))
+			for line in gissumoLogHandle.read().decode('utf-8', 'replace').splitlines():
+				if line.startswith("Simulation complete at time "):
+					metrics['simulatedTime'] = float(line[len("Simulation complete at time "):].rstrip('.'))
+
+	return metrics
+
+
+# Plist values as stored in the database
+def parameterValue(value):
+	if isinstance(value, bool):
+		return int(value)
+	if isinstance(value, (int, float, str)):
+		return value
+	return json.dumps(value, sort_keys=True, default=str)
+
+
+class ResultIndex:
+	def __init__(self, database=defaultDatabase):
+		self.database = database
+		if os.path.dirname(database):
+			os.makedirs(os.path.dirname(database), exist_ok=True)
+		self.connection = sqlite3.connect(database, timeout=60)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("PRAGMA synchronous=NORMAL")
+		with self.connection:
+			for statement in schema:
+				self.connection.execute(statement)
+		# Compiled description templates, by file
+		self.templates = {}
+
+	def close(self):
+		self.connection.close()
+
+	# Record the simulations of a set, reading only those that changed since they were last recorded.
+	# Parameters are the key paths of a description template. Returns the number of simulations read.
+	def indexSet(self, setDir, templateFile=defaultTemplate):
+		setPath = os.path.abspath(setDir)
+		if templateFile not in self.templates:
+			self.templates[templateFile] = descriptionGenerator.readTemplate(templateFile) if os.path.isfile(templateFile) else descriptionGenerator.DescriptionTemplate([])
+		template = self.templates[templateFile]
+		runTimes = readRunTimes(setDir)
+
+		# Read simulations outside the write transaction, so readers aren't held up
+		simulations = []
+		knownSignatures = dict(self.connection.execute("SELECT path, signature FROM simulations WHERE path LIKE ?", (setPath + os.sep + '%',)).fetchall())
+		for simulationDir in findSimulations(setDir):
+			simulationPath = os.path.abspath(simulationDir)
+			runTime = runTimes.get(os.path.basename(simulationDir), (None, None))
+			signature = simulationSignature(simulationDir, runTime)
+			if knownSignatures.get(simulationPath) == signature:
+				continue
+			try:
+				with open(os.path.join(simulationDir, 'config.plist'), 'rb') as configFileHandle:
+					configDict = plistlib.load(configFileHandle, fmt=plistlib.FMT_XML)
+			except (OSError, ValueError) as error:
+				print("Warning: Skipping {:s}: {:s}".format(simulationDir, str(error)), file=sys.stderr)
+				continue
+			parameters = {keyPath: parameterValue(value) for keyPath, value in template.values(configDict, skipMissing=True).items()}
+			parameters['floatingCarDataFile'] = os.path.basename(configDict.get('floatingCarDataFile', ''))
+			simulations.append((simulationPath, signature, runTime, runtimeHistory.configDigest(configDict), parameters, simulationMetrics(simulationDir)))
+
+		with self.connection:
+			self.connection.execute("INSERT INTO sets (path, study, name, indexed) VALUES (?, ?, ?, ?) ON CONFLICT(path) DO UPDATE SET indexed=excluded.indexed", (setPath, os.path.basename(studyDir(setDir)), os.path.basename(setPath), time.time()))
+			setId = self.connection.execute("SELECT id FROM sets WHERE path = ?", (setPath,)).fetchone()[0]
+			for simulationPath, signature, (wallTime, source), configDigest, parameters, metrics in simulations:
+				self.connection.execute("INSERT INTO simulations (setId, name, path, configDigest, wallTime, source, signature) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(path) DO UPDATE SET setId=excluded.setId, configDigest=excluded.configDigest, wallTime=excluded.wallTime, source=excluded.source, signature=excluded.signature", (setId, os.path.basename(simulationPath), simulationPath, configDigest, wallTime, source, signature))
+				simulationId = self.connection.execute("SELECT id FROM simulations WHERE path = ?", (simulationPath,)).fetchone()[0]
+				self.connection.execute("DELETE FROM parameters WHERE simulationId = ?", (simulationId,))
+				self.connection.execute("DELETE FROM metrics WHERE simulationId = ?", (simulationId,))
+				self.connection.executemany("INSERT INTO parameters VALUES (?, ?, ?)", [(simulationId, key, value) for key, value in parameters.items()])
+				self.connection.executemany("INSERT INTO metrics VALUES (?, ?, ?)", [(simulationId, metric, value) for metric, value in metrics.items()])
+			# Forget simulations that were removed from the set
+			for (simulationPath,) in self.connection.execute("SELECT path FROM simulations WHERE setId = ?", (setId,)).fetchall():
+				if not os.path.isdir(simulationPath):
+					self.forgetSimulation(simulationPath)
+		return len(simulations)
+
+	def forgetSimulation(self, simulationPath):
+		simulationId = self.connection.execute("SELECT id FROM simulations WHERE path = ?", (simulationPath,)).fetchone()[0]
+		for table, column in [('parameters', 'simulationId'), ('metrics', 'simulationId'), ('simulations', 'id')]:
+			self.connection.execute("DELETE FROM {:s} WHERE {:s} = ?".format(table, column), (simulationId,))
+
+	# Mean, standard deviation and count of a metric for each value of a parameter (a key path,
+	# or its last component), optionally restricted to a study and to simulation names matching a pattern
+	def compare(self, metric, parameter, study=None, namePattern=None):
+		# Resolve the parameter to full keys first, so that the query below can use the parameter index
+		keys = [key for (key,) in self.connection.execute("SELECT DISTINCT key FROM parameters").fetchall() if key == parameter or key.endswith('.' + parameter)]
+		if not keys:
+			return []
+		query = ("SELECT parameters.value, count(*), avg(metrics.value), avg(metrics.value*metrics.value) FROM metrics "
+			"JOIN parameters ON parameters.simulationId = metrics.simulationId "
+			"JOIN simulations ON simulations.id = metrics.simulationId "
+			"JOIN sets ON sets.id = simulations.setId "
+			"WHERE metrics.metric = ? AND parameters.key IN ({:s})".format(", ".join("?"*len(keys))))
+		arguments = [metric] + keys
+		if study is not None:
+			query += " AND sets.study = ?"
+			arguments.append(study)
+		if namePattern is not None:
+			query += " AND simulations.name LIKE ?"
+			arguments.append('%' + namePattern + '%')
+		query += " GROUP BY parameters.value ORDER BY parameters.value"
+
+		comparison = []
+		for value, count, mean, meanSquare in self.connection.execute(query, arguments).fetchall():
+			comparison.append((value, mean, math.sqrt(max(meanSquare-mean*mean, 0.0)), count))
+		return comparison
+
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage="%prog index [folders with simulation sets]\n       %prog compare [metric] [parameter]\n       %prog sql [query]")
+	parser.add_option("-d", "--database", dest="database", default=defaultDatabase, help="index database [default: %default]", metavar="FILE")
+	parser.add_option("-t", "--template", dest="templateFile", default=None, help="description template with the parameters to record (default: each study's, or the one in templates)", metavar="FILE")
+	parser.add_option("--study", dest="study", default=None, help="compare within a study", metavar="NAME")
+	parser.add_option("--name", dest="namePattern", default=None, help="compare simulations whose name contains PATTERN", metavar="PATTERN")
+	(options, args) = parser.parse_args()
+
+	if len(args) == 0 or args[0] not in ['index', 'compare', 'sql']:
+		parser.print_usage()
+		sys.exit(1)
+	command, args = args[0], args[1:]
+
+	index = ResultIndex(options.database)
+
+	if command == 'index':
+		for folder in args or ['.']:
+			if not os.path.isdir(folder):
+				print("Error: Folder {:s} not present.".format(folder))
+				sys.exit(1)
+			for setDir in findSets(folder):
+				templateFile = options.templateFile
+				if templateFile is None:
+					studyTemplate = os.path.join(studyDir(setDir), 'description.template')
+					templateFile = studyTemplate if os.path.isfile(studyTemplate) else defaultTemplate
+				indexedSimulations = index.indexSet(setDir, templateFile)
+				print("Indexed {:s} ({:d} simulations updated)".format(setDir, indexedSimulations))
+
+	elif command == 'compare':
+		if len(args) != 2:
+			print("Error: Please specify a metric and a parameter.")
+			sys.exit(1)
+		comparison = index.compare(args[0], args[1], options.study, options.namePattern)
+		if len(comparison) == 0:
+			print("Error: No simulations with metric '{:s}' and parameter '{:s}'.".format(args[0], args[1]))
+			sys.exit(1)
+		print("\t".join([args[1], 'mean', 'stdev', 'count']))
+		for value, mean, stdev, count in comparison:
+			print("\t".join([str(value), repr(mean), repr(stdev), str(count)]))
+
+	elif command == 'sql':
+		if len(args) != 1:
+			print("Error: Please specify a query.")
+			sys.exit(1)
+		try:
+			cursor = index.connection.execute(args[0])
+		except sqlite3.Error as error:
+			print("Error:", error)
+			sys.exit(1)
+		if cursor.description is not None:
+			print("\t".join(column[0] for column in cursor.description))
+		for row in cursor:
+			print("\t".join(str(value) for value in row))
+
+	index.close()
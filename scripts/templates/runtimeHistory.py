@@ -0,0 +1,96 @@
+# This module keeps a persistent history of simulation wall-times, used to order simulation queues longest-first and to estimate their remaining time.
+
+import copy
+import gzip
+import hashlib
+import heapq
+import json
+import os
+import plistlib
+
+
+# Configuration keys that only hold paths or per-worker settings, and don't affect simulation results
+pathOnlyConfigKeys = [['floatingCarDataFile'], ['stats', 'statsFolder'], ['gis', 'database']]
+
+
+# Hash a configuration dictionary, ignoring path-only keys
+def configDigest(configDict, ignoredKeys=pathOnlyConfigKeys):
+	configCopy = copy.deepcopy(configDict)
+	for keyPath in ignoredKeys:
+		subDict = configCopy
+		for key in keyPath[:-1]:
+			subDict = subDict.get(key, {})
+		subDict.pop(keyPath[-1], None)
+	return hashlib.sha1(plistlib.dumps(configCopy, fmt=plistlib.FMT_XML, sort_keys=True)).hexdigest()
+
+
+# Count the samples (lines, minus the header) in a floating car data file
+def countSamples(fcdFile):
+	lineCount = 0
+	openFunction = gzip.open if fcdFile.endswith('.gz') else open
+	with openFunction(fcdFile, 'rb') as fcdFileHandle:
+		for chunk in iter(lambda: fcdFileHandle.read(1<<20), b''):
+			lineCount += chunk.count(b'\n')
+	return max(lineCount-1, 0)
+
+
+class RuntimeHistory:
+	def __init__(self, historyFile):
+		self.historyFile = historyFile
+		self.runs = []
+		self.fcdSamples = {}
+		if os.path.isfile(historyFile):
+			with open(historyFile, 'r') as historyFileHandle:
+				history = json.load(historyFileHandle)
+			self.runs = history.get('runs', [])
+			self.fcdSamples = history.get('fcdSamples', {})
+
+	def save(self):
+		temporaryFile = "{:s}.{:d}.tmp".format(self.historyFile, os.getpid())
+		with open(temporaryFile, 'w') as historyFileHandle:
+			json.dump({'runs': self.runs, 'fcdSamples': self.fcdSamples}, historyFileHandle)
+		os.replace(temporaryFile, self.historyFile)
+
+	# Number of samples in an FCD file, cached by path, size and modification time
+	def samples(self, fcdFile):
+		fcdStat = os.stat(fcdFile)
+		fcdKey = "{:s}:{:d}:{:d}".format(os.path.abspath(fcdFile), fcdStat.st_size, int(fcdStat.st_mtime))
+		if fcdKey not in self.fcdSamples:
+			self.fcdSamples[fcdKey] = countSamples(fcdFile)
+		return self.fcdSamples[fcdKey]
+
+	def record(self, config, fcdFile, wallTime):
+		self.runs.append({'config': config, 'fcdName': os.path.basename(fcdFile), 'fcdSize': os.path.getsize(fcdFile), 'fcdSamples': self.samples(fcdFile), 'wallTime': wallTime})
+
+	# Predict the wall-time of simulating an FCD file with a configuration. In order of preference:
+	# the mean time of previous runs of the same file and configuration; time proportional to the
+	# number of samples, fitted to runs with the same configuration, or with any configuration.
+	# Returns None with no history.
+	def predict(self, config, fcdFile):
+		fcdName = os.path.basename(fcdFile)
+		fcdSize = os.path.getsize(fcdFile)
+
+		sameRuns = [run['wallTime'] for run in self.runs if run['config'] == config and run['fcdName'] == fcdName and run['fcdSize'] == fcdSize]
+		if len(sameRuns) > 0:
+			return sum(sameRuns)/len(sameRuns)
+
+		fcdSamples = self.samples(fcdFile)
+		for matchingRuns in ([run for run in self.runs if run['config'] == config], self.runs):
+			totalSamples = sum(run['fcdSamples'] for run in matchingRuns)
+			if totalSamples > 0:
+				return sum(run['wallTime'] for run in matchingRuns)/totalSamples*fcdSamples
+
+		return None
+
+
+# Makespan of running jobs with the given durations, in order, each on the first free worker.
+# 'workerTimes' holds the time at which each worker becomes free.
+def listScheduleMakespan(durations, workerTimes):
+	workerTimes = list(workerTimes)
+	heapq.heapify(workerTimes)
+	makespan = max(workerTimes) if len(workerTimes) > 0 else 0.0
+	for duration in durations:
+		finishTime = heapq.heappop(workerTimes) + duration
+		makespan = max(makespan, finishTime)
+		heapq.heappush(workerTimes, finishTime)
+	return makespan
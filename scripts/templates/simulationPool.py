@@ -0,0 +1,433 @@
+# This module runs GISSUMO simulations on a pool of workers, each pinned to its own 'gisdb{N}' database.
+# Simulations are grouped in sets, each with its own configuration and folder; simulations from all
+# sets share the same workers and are run longest-first, except that sets which stop once converged take
+# their simulations in a seeded random order, so that their estimates aren't drawn from the longest traces.
+
+import copy
+import datetime
+import gzip
+import os
+import plistlib
+from queue import Queue
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import runtimeHistory
+import workerTelemetry
+
+
+simulationDescription = "description.txt"
+# Log of how each simulation's FCD input was staged
+inputStageLog = "inputStage.log"
+# Log of each simulation's wall-time, and whether it was simulated or taken from the result cache
+runTimeLog = "runTimes.log"
+
+
+# Find the floating car data files in a folder
+def findFcdFiles(floatingCarDataDir):
+	fcdFiles = []
+	for dirpath, dirnames, filenames in os.walk(floatingCarDataDir):
+		for file in filenames:
+			if file.endswith('fcd.tsv') or file.endswith('fcd.tsv.gz'):
+				fcdFiles.append( os.path.join(dirpath, file) )
+	return fcdFiles
+
+
+# Count the 'gisdb{N}' databases (gisdb0, gisdb1, ...) on the GIS server, so that
+# each worker is pinned to its own database. Returns None if the server can't be queried.
+def countWorkerDatabases(gisConfig):
+	psqlEnvironment = dict(os.environ, PGPASSWORD=str(gisConfig['password']))
+	psqlCommand = ['psql', '--host', str(gisConfig['host']), '--port', str(gisConfig['port']), '--username', str(gisConfig['user']),
+		'--dbname', 'postgres', '--tuples-only', '--no-align',
+		'--command', "SELECT datname FROM pg_database WHERE datname ~ '^gisdb[0-9]+$';"]
+	try:
+		databaseNames = subprocess.check_output(psqlCommand, env=psqlEnvironment, stderr=subprocess.DEVNULL, timeout=30).decode().split()
+	except (OSError, subprocess.SubprocessError):
+		return None
+
+	databaseCount = 0
+	while 'gisdb{:d}'.format(databaseCount) in databaseNames:
+		databaseCount += 1
+	return databaseCount
+
+
+# Size the worker pool from the available cores and databases, up to 'maxWorkers'
+def workerCount(maxWorkers, gisConfig):
+	try:
+		availableCores = len(os.sched_getaffinity(0))
+	except AttributeError:
+		availableCores = os.cpu_count() or 1
+
+	workerDatabases = countWorkerDatabases(gisConfig)
+	if workerDatabases == 0:
+		print("Error: No 'gisdb0..gisdbN' databases found on the GIS server (see scripts/00postgis/provisionDatabases.py).")
+		sys.exit(1)
+	elif workerDatabases is None:
+		print("Warning: Could not count the GIS databases, assuming {:d}.".format(maxWorkers))
+		workerDatabases = maxWorkers
+
+	workers = min(maxWorkers, availableCores, workerDatabases)
+	print("Running {:d} workers ({:d} cores, {:d} databases).".format(workers, availableCores, workerDatabases), flush=True)
+	return workers
+
+
+# Peak memory use of this process, in bytes (ru_maxrss is in kilobytes on Linux, bytes on macOS)
+def peakRss():
+	peakRssValue = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peakRssValue if sys.platform == 'darwin' else peakRssValue*1024
+
+
+# Decompresses akin to 'gzip -dc', in bounded chunks
+# Returns the number of decompressed bytes written
+def gunzip(fileIn, fileOut, chunkSize=1<<20):
+	writtenBytes = 0
+	with gzip.open(fileIn, 'rb') as inFileGzipHandle:
+		with open(fileOut, 'wb') as outFileGzipHandle:
+			for chunk in iter(lambda: inFileGzipHandle.read(chunkSize), b''):
+				outFileGzipHandle.write(chunk)
+				writtenBytes += len(chunk)
+	return writtenBytes
+
+
+# Places an FCD file at 'fcdFile' without copying it, if possible: uncompressed files are
+# hardlinked (or reflinked, across filesystems), compressed files are decompressed in chunks
+# or streamed through a named pipe. Returns the staging method and the bytes written to disk.
+def stageFcdFile(fcdFileIn, fcdFile, useNamedPipes=False):
+	if fcdFileIn.endswith('.gz'):
+		if useNamedPipes:
+			# The simulator reads the decompressed data straight from the pipe;
+			# opening the pipe blocks until it does, so feed it from a thread
+			os.mkfifo(fcdFile)
+			threading.Thread(target=gunzip, args=(fcdFileIn, fcdFile), daemon=True).start()
+			return 'fifo', 0
+		return 'gunzip', gunzip(fcdFileIn, fcdFile)
+
+	try:
+		os.link(fcdFileIn, fcdFile)
+		return 'hardlink', 0
+	except OSError:
+		pass
+
+	if subprocess.call(['cp', '--reflink=always', fcdFileIn, fcdFile], stderr=subprocess.DEVNULL) == 0:
+		return 'reflink', 0
+
+	shutil.copyfile(fcdFileIn, fcdFile)
+	return 'copy', os.path.getsize(fcdFile)
+
+
+# A set of simulations sharing a configuration, stored in 'setDir'.
+# 'onFinished', if set, is called with the set once all of its simulations are complete.
+# 'convergence', if set (see convergence.ConvergenceMonitor), is given each successful simulation, and
+# the set's queued simulations are dropped once it has converged.
+class SimulationSet:
+	def __init__(self, setDir, configDict, onFinished=None, convergence=None):
+		self.setDir = setDir
+		self.configDict = configDict
+		self.configDigest = runtimeHistory.configDigest(configDict)
+		self.onFinished = onFinished
+		self.convergence = convergence
+		self.totalSimulations = 0
+		self.finishedSimulations = 0
+
+
+# A single simulation of an FCD file, belonging to a simulation set
+class SimulationJob:
+	def __init__(self, simulationSet, fcdFile):
+		self.simulationSet = simulationSet
+		self.fcdFile = fcdFile
+		self.name = re.sub('\.fcd.tsv(\.gz)?$', '', os.path.basename(fcdFile))
+		self.predictedTime = None
+		self.measuredTime = None
+		self.returnCode = None
+		self.cacheKey = None
+		# Simulator rusage and last backend sample, with telemetry (see workerTelemetry)
+		self.resourceUsage = None
+		simulationSet.totalSimulations += 1
+
+	def simulationDir(self):
+		return os.path.join(self.simulationSet.setDir, self.name)
+
+
+class SimulationPool:
+	def __init__(self, workers, history, useNamedPipes=False, binary='./gissumo_fast', cache=None, telemetry=None):
+		self.workers = workers
+		self.history = history
+		# Result cache, see resultCache; None to always simulate
+		self.cache = cache
+		# Resource sampler, see workerTelemetry; None to only record wall-times
+		self.telemetry = telemetry
+		self.useNamedPipes = useNamedPipes
+		self.binary = binary
+		# Free worker ids; worker N always uses database 'gisdbN'
+		self.freeWorkers = list(range(workers))
+		# Running simulations, indexed by process id: (worker id, Popen handle, start time, job)
+		self.runningWorkers = {}
+		# (pid, exit status, rusage) of workers that exited, see waitForExit
+		self.exitedWorkers = Queue()
+		# Array to store simulation times, for statistics
+		self.simulationTimes = []
+
+	# Log the bytes written to stage a simulation's input, and our peak memory use
+	def logInputStage(self, job, stageMethod, stagedBytes):
+		with open(os.path.join(job.simulationSet.setDir, inputStageLog), 'a') as inputStageLogHandle:
+			if inputStageLogHandle.tell() == 0:
+				inputStageLogHandle.write("simulation\tmethod\tbytesWritten\tpeakRSS\n")
+			inputStageLogHandle.write("{:s}\t{:s}\t{:d}\t{:d}\n".format(job.name, stageMethod, stagedBytes, peakRss()))
+
+	# Log a simulation's wall-time (the original one, for cached results)
+	def logRunTime(self, job, source):
+		with open(os.path.join(job.simulationSet.setDir, runTimeLog), 'a') as runTimeLogHandle:
+			if runTimeLogHandle.tell() == 0:
+				runTimeLogHandle.write("simulation\twallTime\treturnCode\tsource\n")
+			runTimeLogHandle.write("{:s}\t{:.3f}\t{:d}\t{:s}\n".format(job.name, job.measuredTime, job.returnCode, source))
+
+	# Log a simulation's resource totals: the simulator's from its rusage, its backend's from the last sample
+	def logResourceUsage(self, job, resourceUsage, backendSample):
+		# ru_maxrss is in kilobytes on Linux, bytes on macOS; ru_inblock and ru_oublock count 512-byte blocks
+		peakRssKilobytes = resourceUsage.ru_maxrss//1024 if sys.platform == 'darwin' else resourceUsage.ru_maxrss
+		backendSample = backendSample if backendSample is not None else {'cpuTime': -1, 'peakRss': -1, 'readBytes': -1, 'writeBytes': -1}
+		usage = [job.measuredTime, resourceUsage.ru_utime+resourceUsage.ru_stime, peakRssKilobytes, resourceUsage.ru_inblock*512, resourceUsage.ru_oublock*512,
+			resourceUsage.ru_nvcsw, resourceUsage.ru_nivcsw, backendSample['cpuTime'], backendSample['peakRss'], backendSample['readBytes'], backendSample['writeBytes']]
+		with open(os.path.join(job.simulationSet.setDir, workerTelemetry.resourceUsageLog), 'a') as resourceUsageLogHandle:
+			if resourceUsageLogHandle.tell() == 0:
+				resourceUsageLogHandle.write("\t".join(['simulation'] + workerTelemetry.usageColumns) + "\n")
+			resourceUsageLogHandle.write("\t".join([job.name] + [repr(round(value, 3)) if isinstance(value, float) else str(value) for value in usage]) + "\n")
+
+	# Write a simulation's configuration file, setting 'floatingCarDataFile', 'statsFolder' and 'gis.database'
+	# on a copy of the set's configuration, which is shared by its simulations. Returns the configuration file.
+	def writeConfig(self, job, fcdFile, database):
+		simulationDir = job.simulationDir()
+		configFileDict = copy.deepcopy(job.simulationSet.configDict)
+		configFileDict['floatingCarDataFile'] = fcdFile
+		configFileDict['stats']['statsFolder'] = os.path.join(simulationDir, 'stats')
+		configFileDict['gis']['database'] = database
+
+		configFile = os.path.join(simulationDir, 'config.plist')
+		with open(configFile, 'wb') as configFileHandle:
+			plistlib.dump(configFileDict, configFileHandle, fmt=plistlib.FMT_XML)
+		return configFile
+
+	# Take a simulation's results from the cache, if present. Returns whether there was a hit.
+	def fetchCachedResult(self, job):
+		job.cacheKey = self.cache.key(job.simulationSet.configDict, job.fcdFile, self.binary)
+		simulationDir = job.simulationDir()
+		os.makedirs(simulationDir, exist_ok=True)
+		wallTime = self.cache.fetch(job.cacheKey, os.path.join(simulationDir, 'stats'))
+		if wallTime is None:
+			return False
+
+		job.measuredTime = wallTime
+		job.returnCode = 0
+		self.logInputStage(job, 'cached', 0)
+		self.logRunTime(job, 'cached')
+		self.writeConfig(job, os.path.join(simulationDir, job.name + '.fcd.tsv'), job.simulationSet.configDict['gis']['database'])
+		return True
+
+	# Routine to create a new simulation on a free worker
+	def simulate(self, job, freeWorkerId):
+		simulationDir = job.simulationDir()
+
+		# Create the base simulation directory
+		os.makedirs(simulationDir, exist_ok=True)
+
+		# Bring the (uncompressed) FCD file over
+		fcdFile = os.path.join(simulationDir, job.name + '.fcd.tsv')
+		stageMethod, stagedBytes = stageFcdFile(job.fcdFile, fcdFile, self.useNamedPipes)
+
+		self.logInputStage(job, stageMethod, stagedBytes)
+
+		# Set 'gis.database' to match the free worker id
+		database = 'gisdb{:d}'.format(freeWorkerId)
+		configFile = self.writeConfig(job, fcdFile, database)
+
+		# Simulate
+		with open(os.path.join(simulationDir, 'gissumo.log'), 'wb') as logFileHandle:
+			workerHandle = subprocess.Popen([self.binary, configFile], stdout=logFileHandle, stderr=subprocess.STDOUT)
+		self.runningWorkers[workerHandle.pid] = (freeWorkerId, workerHandle, time.time(), job)
+		if self.telemetry is not None:
+			self.telemetry.start(workerHandle.pid, database, os.path.join(simulationDir, workerTelemetry.telemetryLog))
+		threading.Thread(target=self.waitForExit, args=(workerHandle.pid,), daemon=True).start()
+
+	# Reap a worker once it exits (in a thread of its own), and queue its pid, exit status and rusage.
+	# Each worker is waited on by its pid, so other children (psql, decompressors) are left to whoever
+	# started them, and the runner sleeps on the queue until a worker exits.
+	def waitForExit(self, pid):
+		self.exitedWorkers.put(os.wait4(pid, 0))
+
+	# Block until any simulation finishes, and return its worker id, start time and job
+	def waitForWorker(self):
+		pid, status, resourceUsage = self.exitedWorkers.get()
+		workerId, workerHandle, workerStartTime, job = self.runningWorkers.pop(pid)
+		if self.telemetry is not None:
+			job.resourceUsage = (resourceUsage, self.telemetry.stop(pid))
+
+		# The process was reaped by os.wait4(), record its exit code on the handle
+		workerHandle.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+		job.returnCode = workerHandle.returncode
+		if workerHandle.returncode != 0:
+			print("Warning: Worker {:d} exited with code {:d} on {:s}.".format(workerId, workerHandle.returncode, job.simulationDir()), flush=True)
+
+		return workerId, workerStartTime, job
+
+	# Estimate the remaining time by scheduling the queued simulations on the workers,
+	# using predicted times (or the mean simulation time, without history)
+	def remainingTimeEstimate(self, queue):
+		meanSimulationTime = sum(self.simulationTimes)/len(self.simulationTimes)
+		expectedTime = lambda job: job.predictedTime if job.predictedTime is not None else meanSimulationTime
+
+		now = time.time()
+		workerTimes = [0.0]*len(self.freeWorkers)
+		workerTimes += [max(expectedTime(job)-(now-startTime), 0.0) for (_, _, startTime, job) in self.runningWorkers.values()]
+		return runtimeHistory.listScheduleMakespan([expectedTime(job) for job in queue], workerTimes)
+
+	# Wrap up a simulation set: describe it and remove FCD files and simulation timetrackers
+	def finishSet(self, simulationSet):
+		# Create a file with a description of the simulation set (overwriting)
+		with open(os.path.join(simulationSet.setDir, simulationDescription), 'w') as descriptionFp:
+			descriptionFp.write("simulations: {:d}\n".format(simulationSet.finishedSimulations))
+			if simulationSet.convergence is not None:
+				descriptionFp.write(simulationSet.convergence.describe())
+
+		if self.telemetry is not None:
+			summaryRows = {row[0]: row for row in workerTelemetry.summarizeSet(simulationSet.setDir)}
+			if 'wallTime' in summaryRows and 'peakRss' in summaryRows:
+				print("Set {:s}: wall-time p50 {:.0f}s, p95 {:.0f}s, peak RSS {:.0f} MB.".format(simulationSet.setDir, summaryRows['wallTime'][1], summaryRows['wallTime'][2], summaryRows['peakRss'][3]/1024), flush=True)
+
+		for dirpath, dirnames, filenames in os.walk(simulationSet.setDir):
+			for file in filenames:
+				if file.endswith('fcd.tsv') or file=='simulationTime.log':
+					os.remove(os.path.join(dirpath, file))
+
+		if simulationSet.onFinished is not None:
+			simulationSet.onFinished(simulationSet)
+
+	# Fold a successful simulation into its set's convergence estimates, and once the set has converged,
+	# remove its simulations from the queue. Returns the number of simulations removed.
+	def checkConvergence(self, job, queue):
+		convergence = job.simulationSet.convergence
+		if convergence is None or job.returnCode != 0:
+			return 0
+		convergence.add(job.simulationDir())
+		if not convergence.converged():
+			return 0
+
+		cancelledJobs = [queuedJob for queuedJob in queue if queuedJob.simulationSet is job.simulationSet]
+		if len(cancelledJobs) == 0:
+			return 0
+		queue[:] = [queuedJob for queuedJob in queue if queuedJob.simulationSet is not job.simulationSet]
+		job.simulationSet.totalSimulations -= len(cancelledJobs)
+		convergence.savedReplications += len(cancelledJobs)
+		print("Set {:s} converged after {:d} simulations, {:d} queued simulations cancelled.".format(job.simulationSet.setDir, convergence.replications, len(cancelledJobs)), flush=True)
+		return len(cancelledJobs)
+
+	# Run a list of simulation jobs to completion, longest predicted time first (in a random order
+	# within sets with a convergence monitor)
+	def run(self, jobs):
+		simulationCount = 0
+		totalSimulations = len(jobs)
+
+		# Take the results of previously run simulations from the cache
+		queue = list(jobs)
+		if self.cache is not None:
+			queue = []
+			cachedJobs = []
+			for job in jobs:
+				if not self.fetchCachedResult(job):
+					queue.append(job)
+					continue
+				cachedJobs.append(job)
+				simulationCount += 1
+				job.simulationSet.finishedSimulations += 1
+			# Cached results count towards convergence, and may leave nothing to simulate for a set
+			for job in cachedJobs:
+				totalSimulations -= self.checkConvergence(job, queue)
+			finishedSets = []
+			for job in cachedJobs:
+				if job.simulationSet not in finishedSets and job.simulationSet.finishedSimulations == job.simulationSet.totalSimulations:
+					finishedSets.append(job.simulationSet)
+					self.finishSet(job.simulationSet)
+			if simulationCount > 0:
+				print("{:d}/{:d} simulations taken from the result cache.".format(simulationCount, totalSimulations), flush=True)
+		simulatedJobs = list(queue)
+
+		# Predict each simulation's wall-time from previous runs with the same configuration,
+		# and order the queue longest-first so that long simulations don't run last
+		for job in queue:
+			job.predictedTime = self.history.predict(job.simulationSet.configDigest, job.fcdFile)
+		if any(job.predictedTime is None for job in queue):
+			# No history: longer traces take longer to simulate
+			queue.sort(key=lambda job: self.history.samples(job.fcdFile), reverse=True)
+		else:
+			queue.sort(key=lambda job: job.predictedTime, reverse=True)
+		# Sets that may stop early would otherwise converge on their longest traces alone: they keep their
+		# places in the queue, but take their simulations in a random order, seeded by their configuration
+		monitoredSets = []
+		for job in queue:
+			if job.simulationSet.convergence is not None and job.simulationSet not in monitoredSets:
+				monitoredSets.append(job.simulationSet)
+		for simulationSet in monitoredSets:
+			positions = [position for position, job in enumerate(queue) if job.simulationSet is simulationSet]
+			setJobs = sorted((queue[position] for position in positions), key=lambda job: job.fcdFile)
+			random.Random(simulationSet.configDigest).shuffle(setJobs)
+			for position, job in zip(positions, setJobs):
+				queue[position] = job
+		queueOrder = list(queue)
+		self.history.save()
+
+		# Main loop
+		runStartTime = time.time()
+		while (len(queue) > 0) or (len(self.runningWorkers) > 0):
+			# Start simulations on every free worker
+			while (len(queue) > 0) and (len(self.freeWorkers) > 0):
+				self.simulate(queue.pop(0), self.freeWorkers.pop(0))
+
+			# Sleep until a simulation finishes
+			finishedWorkerId, finishedStartTime, finishedJob = self.waitForWorker()
+			self.freeWorkers.append(finishedWorkerId)
+
+			# Save simulation time
+			finishedJob.measuredTime = time.time() - finishedStartTime
+			self.simulationTimes.append(finishedJob.measuredTime)
+			self.history.record(finishedJob.simulationSet.configDigest, finishedJob.fcdFile, finishedJob.measuredTime)
+			self.history.save()
+			self.logRunTime(finishedJob, 'simulated')
+			if self.telemetry is not None:
+				self.logResourceUsage(finishedJob, *finishedJob.resourceUsage)
+			# Cache the results of successful simulations
+			if self.cache is not None and finishedJob.returnCode == 0:
+				self.cache.store(finishedJob.cacheKey, os.path.join(finishedJob.simulationDir(), 'stats'), finishedJob.measuredTime, finishedJob.name)
+			# Update simulation counts
+			simulationCount += 1
+			finishedJob.simulationSet.finishedSimulations += 1
+			totalSimulations -= self.checkConvergence(finishedJob, queue)
+			# Print some statistics
+			remainingTime = self.remainingTimeEstimate(queue)
+			print("{:s}  {:d}/{:d} simulations complete, ETA {:d}h{:02d}m{:02d}s".format(str(datetime.datetime.now().time()), simulationCount, totalSimulations, int(remainingTime/3600), int(remainingTime%3600/60), int(remainingTime%60)), flush=True)
+
+			if finishedJob.simulationSet.finishedSimulations == finishedJob.simulationSet.totalSimulations:
+				self.finishSet(finishedJob.simulationSet)
+
+		# Compare the makespan against running the simulations in the order they were given,
+		# leaving out those cancelled by converged sets
+		simulatedJobs = [job for job in simulatedJobs if job.measuredTime is not None]
+		queueOrder = [job for job in queueOrder if job.measuredTime is not None]
+		if len(simulatedJobs) > 0:
+			runMakespan = time.time() - runStartTime
+			givenOrderMakespan = runtimeHistory.listScheduleMakespan([job.measuredTime for job in simulatedJobs], [0.0]*self.workers)
+			scheduledMakespan = runtimeHistory.listScheduleMakespan([job.measuredTime for job in queueOrder], [0.0]*self.workers)
+			print("Makespan {:.0f}s (scheduled {:.0f}s, {:.0f}s in discovery order, {:.1f}% reduction).".format(runMakespan, scheduledMakespan, givenOrderMakespan, (1-scheduledMakespan/givenOrderMakespan)*100 if givenOrderMakespan > 0 else 0.0))
+
+		if self.telemetry is not None:
+			self.telemetry.close()
+
+		if self.cache is not None:
+			self.cache.report()
+			evictedEntries = self.cache.evict()
+			if evictedEntries > 0:
+				print("Evicted {:d} old result cache entries.".format(evictedEntries))
@@ -0,0 +1,195 @@
+# This module samples the resource use of running simulations from '/proc', so that a set can be told apart as
+# CPU-, memory-, PostGIS- or disk-bound. Every 'interval' seconds, it reads the simulator process and the
+# PostgreSQL backend serving its 'gisdb{N}' database (when the GIS server runs on this machine): CPU time,
+# resident and peak resident memory, bytes read from and written to disk, and context switches.
+#
+# Samples go to a timeline in each simulation's folder ('telemetry.log'), one line per process and sample:
+#   time  process  cpuTime  rss  peakRss  readBytes  writeBytes  voluntarySwitches  involuntarySwitches
+# with time in seconds since the simulation started and memory in kilobytes. Disk bytes are -1 when
+# '/proc/<pid>/io' can't be read (backends owned by another user, unless run as root or as that user).
+#
+# The simulation pool adds each simulation's totals to the set's 'resourceUsage.log' (the simulator's from the
+# rusage the kernel returns when it is reaped, its backend's from the last sample; memory in kilobytes, -1 when
+# not known), and summarizes them into 'resourceSummary.log' (see summarizeSet) once the set is complete.
+
+import math
+import os
+import threading
+import time
+
+
+telemetryLog = "telemetry.log"
+resourceUsageLog = "resourceUsage.log"
+resourceSummaryLog = "resourceSummary.log"
+
+# Per-simulation totals, in the order of 'resourceUsage.log'
+usageColumns = ['wallTime', 'cpuTime', 'peakRss', 'readBytes', 'writeBytes', 'voluntarySwitches', 'involuntarySwitches',
+	'backendCpuTime', 'backendPeakRss', 'backendReadBytes', 'backendWriteBytes']
+
+clockTicks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+# Resource use of a process, from '/proc/<pid>', or None if it is gone (or there is no '/proc')
+def readProcess(pid):
+	try:
+		with open('/proc/{:d}/stat'.format(pid), 'rb') as statHandle:
+			# Fields after the command name, which is in parentheses and may hold spaces; utime and stime are 14th and 15th
+			statFields = statHandle.read().rsplit(b')', 1)[1].split()
+		with open('/proc/{:d}/status'.format(pid), 'r') as statusHandle:
+			status = dict(line.split(':', 1) for line in statusHandle if ':' in line)
+	except (OSError, IndexError, ValueError):
+		return None
+
+	sample = {
+		'cpuTime': (int(statFields[11]) + int(statFields[12]))/clockTicks,
+		'rss': int(status.get('VmRSS', '0 kB').split()[0]),
+		'peakRss': int(status.get('VmHWM', '0 kB').split()[0]),
+		'voluntarySwitches': int(status.get('voluntary_ctxt_switches', '0')),
+		'involuntarySwitches': int(status.get('nonvoluntary_ctxt_switches', '0')),
+		'readBytes': -1,
+		'writeBytes': -1
+	}
+	try:
+		with open('/proc/{:d}/io'.format(pid), 'r') as ioHandle:
+			io = dict(line.split(':', 1) for line in ioHandle if ':' in line)
+		sample['readBytes'] = int(io['read_bytes'])
+		sample['writeBytes'] = int(io['write_bytes'])
+	except (OSError, KeyError, ValueError):
+		pass
+	return sample
+
+
+# Process id of the PostgreSQL backend connected to a database, found by its process title
+# ('postgres: <user> <database> <host> <state>'), or None
+def findBackend(database):
+	try:
+		pids = [int(entry) for entry in os.listdir('/proc') if entry.isdigit()]
+	except OSError:
+		return None
+	for pid in pids:
+		try:
+			with open('/proc/{:d}/cmdline'.format(pid), 'rb') as cmdlineHandle:
+				title = cmdlineHandle.read().replace(b'\0', b' ').decode('utf-8', 'replace').split()
+		except OSError:
+			continue
+		if len(title) > 2 and title[0] == 'postgres:' and title[2] == database:
+			return pid
+	return None
+
+
+# A running simulation being sampled
+class SampledRun:
+	def __init__(self, pid, database, timelineFile):
+		self.pid = pid
+		self.database = database
+		self.startTime = time.time()
+		self.backendPid = None
+		self.lastBackendSample = None
+		self.timelineHandle = open(timelineFile, 'w')
+		self.timelineHandle.write("time\tprocess\tcpuTime\trss\tpeakRss\treadBytes\twriteBytes\tvoluntarySwitches\tinvoluntarySwitches\n")
+
+	def writeSample(self, now, process, sample):
+		self.timelineHandle.write("{:.2f}\t{:s}\t{:.2f}\t{:d}\t{:d}\t{:d}\t{:d}\t{:d}\t{:d}\n".format(now-self.startTime, process, sample['cpuTime'],
+			sample['rss'], sample['peakRss'], sample['readBytes'], sample['writeBytes'], sample['voluntarySwitches'], sample['involuntarySwitches']))
+
+	def sample(self):
+		now = time.time()
+		simulatorSample = readProcess(self.pid)
+		if simulatorSample is not None:
+			self.writeSample(now, 'gissumo', simulatorSample)
+
+		# The simulator connects shortly after it starts; look for its backend until found
+		if self.backendPid is None:
+			self.backendPid = findBackend(self.database)
+		if self.backendPid is not None:
+			backendSample = readProcess(self.backendPid)
+			if backendSample is not None:
+				self.writeSample(now, 'postgres', backendSample)
+				self.lastBackendSample = backendSample
+		self.timelineHandle.flush()
+
+
+class WorkerTelemetry:
+	def __init__(self, interval=1.0):
+		self.interval = interval
+		# Sampled runs, by simulator process id
+		self.runs = {}
+		self.lock = threading.Lock()
+		self.stopEvent = threading.Event()
+		self.thread = None
+
+	def sampleAll(self):
+		while not self.stopEvent.wait(self.interval):
+			with self.lock:
+				for run in self.runs.values():
+					run.sample()
+
+	# Start sampling a simulation, writing its timeline to 'timelineFile'
+	def start(self, pid, database, timelineFile):
+		with self.lock:
+			self.runs[pid] = SampledRun(pid, database, timelineFile)
+		if self.thread is None:
+			self.thread = threading.Thread(target=self.sampleAll, daemon=True)
+			self.thread.start()
+
+	# Stop sampling a simulation, once it has exited. Returns the last sample of its backend, or None.
+	def stop(self, pid):
+		with self.lock:
+			run = self.runs.pop(pid, None)
+		if run is None:
+			return None
+		# The backend outlives the simulator for a moment, take its final totals
+		if run.backendPid is not None:
+			backendSample = readProcess(run.backendPid)
+			if backendSample is not None:
+				run.writeSample(time.time(), 'postgres', backendSample)
+				run.lastBackendSample = backendSample
+		run.timelineHandle.close()
+		return run.lastBackendSample
+
+	def close(self):
+		self.stopEvent.set()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+		self.stopEvent.clear()
+		with self.lock:
+			for run in self.runs.values():
+				run.timelineHandle.close()
+			self.runs = {}
+
+
+# Value at a percentile of a list of values (nearest rank)
+def percentile(values, fraction):
+	orderedValues = sorted(values)
+	return orderedValues[max(int(math.ceil(fraction*len(orderedValues)))-1, 0)]
+
+
+# Summarize a set's 'resourceUsage.log' into 'resourceSummary.log': p50, p95, maximum and total of every
+# column, plus the share of wall-time the simulator and its backend spent on a CPU. Returns the summary rows.
+def summarizeSet(setDir):
+	usageFile = os.path.join(setDir, resourceUsageLog)
+	if not os.path.isfile(usageFile):
+		return []
+	columns = {column: [] for column in usageColumns + ['cpuShare', 'backendCpuShare']}
+	with open(usageFile, 'r') as usageFileHandle:
+		for line in usageFileHandle.read().splitlines()[1:]:
+			fields = line.split('\t')
+			if len(fields) != len(usageColumns)+1:
+				continue
+			values = dict(zip(usageColumns, [float(field) for field in fields[1:]]))
+			for column in usageColumns:
+				# Missing values (no backend found, unreadable I/O) are negative
+				if values[column] >= 0:
+					columns[column].append(values[column])
+			if values['wallTime'] > 0:
+				columns['cpuShare'].append(values['cpuTime']/values['wallTime'])
+				if values['backendCpuTime'] >= 0:
+					columns['backendCpuShare'].append(values['backendCpuTime']/values['wallTime'])
+
+	summaryRows = [(column, percentile(values, 0.5), percentile(values, 0.95), max(values), math.fsum(values)) for column, values in columns.items() if values]
+	with open(os.path.join(setDir, resourceSummaryLog), 'w') as summaryFileHandle:
+		summaryFileHandle.write("metric\tp50\tp95\tmax\ttotal\n")
+		for summaryRow in summaryRows:
+			summaryFileHandle.write("{:s}\t{:.6g}\t{:.6g}\t{:.6g}\t{:.6g}\n".format(*summaryRow))
+	return summaryRows